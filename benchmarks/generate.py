@@ -0,0 +1,173 @@
+"""
+Generates synthetic but realistic ETCa programs of a given size for the benchmarks.
+
+The programs look like hand-written assembly: mostly ALU operations and moves, loops and branches between nearby labels,
+functions that get called from anywhere, constants set with `.set`, invocations of user macros, and extensions enabled
+part way through. Everything can be tuned through `ProgramShape`, and the same shape and seed always produce the same
+program.
+
+    python benchmarks/generate.py 1000 --seed 1 > program.s
+"""
+from __future__ import annotations
+
+import argparse
+import random
+from bisect import bisect_left
+from dataclasses import dataclass, fields
+
+ALU = ["add", "sub", "rsub", "cmp", "or", "xor", "and", "test"]
+CONDITIONS = ["z", "nz", "n", "nn", "c", "nc", "v", "nv", "be", "a", "l", "ge", "le", "g", "mp"]
+# Enabled in this order. Branches can only go further than the window once functions (and with it `.relax`) is
+# enabled, which is why it comes first.
+EXTENSIONS = ["functions", "byte_operations", "dword_operations", "qword_operations"]
+SIZES = {"byte_operations": "h", "dword_operations": "d", "qword_operations": "q"}
+RELAX_REGISTER = "%r7"
+
+MACROS = """\
+.macro putc 1
+            mov     %rx0, {0}
+            stx     %r0, OUTPUT
+.endmacro
+
+.macro clear 1
+            xor     %r{0}, %r{0}
+.endmacro
+
+.macro inc 1
+            add     %r{0}, 1
+.endmacro
+"""
+
+
+@dataclass
+class ProgramShape:
+    lines: int = 1000
+    seed: int = 0
+    # Average number of lines between labels
+    label_every: int = 6
+    # How far (in lines) branches reach, which keeps them encodable without relaxation
+    branch_window: int = 16
+    # The share of branches and constants that refer to something defined further down
+    forward_references: float = 0.5
+    # The shares of lines that are branches, moves of large immediates and macro invocations
+    branches: float = 0.12
+    large_immediates: float = 0.08
+    macros: float = 0.05
+    # How many of the extensions in EXTENSIONS are enabled, spread evenly over the program
+    extension_switches: int = 3
+    # The share of lines that are calls (or push/pop) once functions are enabled, which also enables `.relax`
+    calls: float = 0.04
+    # Number of `.set` constants
+    constants: int = 32
+
+
+def generate(shape: ProgramShape) -> str:
+    rng = random.Random(shape.seed)
+    n = max(shape.lines, 1)
+    switches = {(i + 1) * n // (shape.extension_switches + 1): EXTENSIONS[i]
+                for i in range(min(shape.extension_switches, len(EXTENSIONS)))}
+    labels = {i: f"L{i}" for i in range(n) if i % shape.label_every == 0 or rng.random() < 1 / shape.label_every}
+    label_lines = sorted(labels)
+    constant_lines = {rng.randrange(n): f"K{k}" for k in range(shape.constants)}
+    constant_values = {name: rng.randrange(1 << 16) for name in constant_lines.values()}
+
+    out = [
+        "; generated by benchmarks/generate.py",
+        *(f"; {f.name} = {getattr(shape, f.name)}" for f in fields(shape)),
+        "",
+        ".set OUTPUT 3",
+        "",
+        MACROS,
+        "start:",
+    ]
+    enabled: list[str] = []
+    functions: list[str] = []
+    defined_constants: set[str] = set()
+
+    def register():
+        return f"%r{rng.randrange(7)}"
+
+    def size():
+        return rng.choice(["", "x", *(SIZES[e] for e in enabled if e in SIZES)])
+
+    def nearby_label(i):
+        forward = rng.random() < shape.forward_references
+        lo, hi = (i + 1, i + shape.branch_window) if forward else (i - shape.branch_window, i)
+        candidates = label_lines[bisect_left(label_lines, lo):bisect_left(label_lines, hi + 1)]
+        return labels[rng.choice(candidates)] if candidates else None
+
+    def large_immediate():
+        if constant_values and rng.random() < 0.3:
+            # Constants defined further down are forward references like any other
+            name = rng.choice(list(constant_values))
+            if name in defined_constants or rng.random() < shape.forward_references:
+                return name
+        bits = 32 if "dword_operations" in enabled and rng.random() < 0.3 else 16
+        return hex(rng.randrange(32, 1 << bits))
+
+    for i in range(n):
+        if i in switches:
+            enabled.append(switches[i])
+            out.append(f".extension {switches[i]}")
+            if switches[i] == "functions":
+                out.append(f".relax {RELAX_REGISTER}")
+        if i in constant_lines:
+            name = constant_lines[i]
+            defined_constants.add(name)
+            out.append(f".set {name} {constant_values[name]:#x}")
+        if i in labels:
+            if "functions" in enabled and rng.random() < 0.2:
+                functions.append(name := f"fn{i}")
+                out.append(f"{name}:")
+            out.append(f"{labels[i]}:")
+
+        r = rng.random()
+        if (r := r - shape.branches) < 0:
+            target = nearby_label(i)
+            line = f"j{rng.choice(CONDITIONS)} {target}" if target else "nop"
+        elif (r := r - shape.large_immediates) < 0:
+            line = f"mov {register()}, {large_immediate()}"
+        elif (r := r - shape.macros) < 0:
+            line = rng.choice([f"putc '{chr(rng.randrange(0x61, 0x7B))}'", f"clear {rng.randrange(7)}",
+                               f"inc {rng.randrange(7)}"])
+        elif "functions" in enabled and (r := r - shape.calls) < 0:
+            line = rng.choice([f"call {rng.choice(functions)}" if functions else "ret",
+                               f"push {register()}", f"pop {register()}", "ret"])
+        else:
+            kind = rng.random()
+            if kind < 0.45:
+                line = f"{rng.choice(ALU)}{size()} {register()}, {register()}"
+            elif kind < 0.8:
+                line = f"{rng.choice(ALU)}{size()} {register()}, {rng.randrange(-16, 16)}"
+            elif kind < 0.9:
+                line = f"mov{size()} {register()}, [{register()}]"
+            else:
+                line = f"mov{size()} [{register()}], {register()}"
+        out.append(f"            {line}")
+
+    out.append("end:")
+    out.append("            hlt")
+    return "\n".join(out) + "\n"
+
+
+def shape_arguments(parser: argparse.ArgumentParser):
+    """Adds an option for every field of ProgramShape except `lines`."""
+    for f in fields(ProgramShape):
+        if f.name != "lines":
+            parser.add_argument(f"--{f.name.replace('_', '-')}", type=type(f.default), default=f.default)
+
+
+def shape_from(args: argparse.Namespace, lines: int) -> ProgramShape:
+    return ProgramShape(lines, **{f.name: getattr(args, f.name) for f in fields(ProgramShape) if f.name != "lines"})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("lines", type=int)
+    shape_arguments(parser)
+    args = parser.parse_args()
+    print(generate(shape_from(args, args.lines)), end="")
+
+
+if __name__ == "__main__":
+    main()
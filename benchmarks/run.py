@@ -0,0 +1,143 @@
+"""
+Measures how assembly time, passes and memory scale with program size.
+
+Programs of each size are generated by generate.py, and assembled by `Assembler.n_pass` of the etc_as in this
+checkout. Parsers are loaded once before the first measurement, so that the numbers are about assembling and not
+about building (or loading) parsers. Every measurement uses a fresh Assembler. Peak memory is measured with
+tracemalloc in a separate run, since tracing slows everything down.
+
+    python benchmarks/run.py --sizes 100,1000,10000 --output results.json
+    python benchmarks/run.py --compare results.json
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from dataclasses import asdict
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+# Benchmark the working tree, not whatever version happens to be installed
+sys.path.insert(0, str(ROOT / "src"))
+
+import lark  # noqa: E402
+
+from etc_as import __version__  # noqa: E402
+import etc_as.core as core  # noqa: E402
+from generate import ProgramShape, generate, shape_arguments, shape_from  # noqa: E402
+
+DEFAULT_SIZES = [100, 300, 1000, 3000, 10000, 30000, 100000]
+
+
+def assemble(text: str) -> core.AssemblyResult:
+    assembler = core.Assembler()
+    assembler.context.modes = {"prefix"}
+    assembler.reload_extensions()
+    return assembler.n_pass(text)
+
+
+def measure(shape: ProgramShape, repeat: int, memory: bool) -> dict:
+    text = generate(shape)
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = assemble(text)
+        seconds.append(time.perf_counter() - start)
+    peak = None
+    if memory:
+        tracemalloc.start()
+        try:
+            assemble(text)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return {
+        "lines": shape.lines,
+        "source_lines": text.count("\n"),
+        "bytes": result.size(),
+        "passes": result.passes,
+        "seconds": min(seconds),
+        "lines_per_second": shape.lines / min(seconds),
+        "peak_memory": peak,
+    }
+
+
+def metadata(shape: ProgramShape) -> dict:
+    def git(*args):
+        try:
+            return subprocess.run(["git", *args], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    return {
+        "etc_as": __version__,
+        "commit": git("rev-parse", "HEAD"),
+        "dirty": bool(git("status", "--porcelain", "--untracked-files=no")),
+        "python": platform.python_version(),
+        "lark": lark.__version__,
+        "platform": platform.platform(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "shape": {k: v for k, v in asdict(shape).items() if k != "lines"},
+    }
+
+
+def print_row(row: dict, file=sys.stdout):
+    peak = "-" if row["peak_memory"] is None else f"{row['peak_memory'] / 2**20:.1f} MiB"
+    print(f"{row['lines']:>8} {row['bytes']:>9} {row['passes']:>6} {row['seconds']:>10.3f} "
+          f"{row['lines_per_second']:>10.0f} {peak:>11}", file=file, flush=True)
+
+
+def compare(old: dict, new: dict):
+    old_rows = {row["lines"]: row for row in old["results"]}
+    print(f"\ncompared to {old['meta'].get('commit') or 'unknown commit'} from {old['meta'].get('date')}:")
+    print(f"{'lines':>8} {'before':>10} {'after':>10} {'speedup':>8} {'passes':>9}")
+    for row in new["results"]:
+        before = old_rows.get(row["lines"])
+        if before is None:
+            continue
+        print(f"{row['lines']:>8} {before['seconds']:>10.3f} {row['seconds']:>10.3f} "
+              f"{before['seconds'] / row['seconds']:>7.2f}x {before['passes']:>4} -> {row['passes']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=lambda s: [int(n) for n in s.split(",")], default=DEFAULT_SIZES,
+                        help="comma separated program sizes in lines")
+    parser.add_argument("--repeat", type=int, default=1, help="assemble every program this many times, keep the best")
+    parser.add_argument("--no-memory", dest="memory", action="store_false", help="don't measure peak memory")
+    parser.add_argument("--budget", type=float, default=600,
+                        help="skip the remaining sizes once assembling one takes longer than this many seconds")
+    parser.add_argument("--output", type=Path, help="write the results to this JSON file")
+    parser.add_argument("--compare", type=Path, help="compare with the results in this JSON file")
+    shape_arguments(parser)
+    args = parser.parse_args()
+
+    results = {"meta": metadata(shape_from(args, 0)), "results": []}
+    start = time.perf_counter()
+    assemble(generate(shape_from(args, 200)))
+    results["meta"]["warmup_seconds"] = time.perf_counter() - start
+
+    print(f"{'lines':>8} {'bytes':>9} {'passes':>6} {'seconds':>10} {'lines/s':>10} {'peak memory':>11}")
+    for lines in args.sizes:
+        row = measure(shape_from(args, lines), args.repeat, args.memory)
+        results["results"].append(row)
+        print_row(row)
+        if row["seconds"] > args.budget:
+            skipped = args.sizes[args.sizes.index(lines) + 1:]
+            if skipped:
+                print(f"over the budget of {args.budget:g}s, skipping {', '.join(map(str, skipped))}")
+            break
+
+    if args.output:
+        args.output.write_text(json.dumps(results, indent=2) + "\n")
+    if args.compare:
+        compare(json.loads(args.compare.read_text()), results)
+
+
+if __name__ == "__main__":
+    main()
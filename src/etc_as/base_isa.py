@@ -1,7 +1,6 @@
-from bitarray import bitarray
-from bitarray.util import int2ba
-
 from etc_as.core import Extension, reject, resolve_register_size, oneof
+from etc_as import objects
+from etc_as.relax import external_branch, relaxed_branch
 
 base = Extension(None, "base", "Base Instruction Set", True)
 
@@ -39,15 +38,47 @@ INSTRUCTIONS = {
 }
 
 
+class Layout:
+    """
+    The format of an instruction, given as the widths of its fields in bits, most significant field first.
+
+    The fields are packed with plain integer arithmetic. Layouts with few possible encodings can keep a `table` of
+    everything they encoded so far.
+    """
+
+    def __init__(self, *widths: int, table: bool = False):
+        size = sum(widths)
+        assert size % 8 == 0, "Instruction length must be multiple of a byte"
+        self.widths = widths
+        self.size = size // 8
+        self.table = {} if table else None
+
+    def encode(self, *values: int) -> bytes:
+        if self.table is not None:
+            try:
+                return self.table[values]
+            except KeyError:
+                pass
+        assert len(values) == len(self.widths), (values, self.widths)
+        word = 0
+        for value, width in zip(values, self.widths):
+            if value >> width:
+                raise OverflowError(f"{value} does not fit into {width} bits")
+            word = word << width | value
+        result = word.to_bytes(self.size, "big")
+        if self.table is not None:
+            self.table[values] = result
+        return result
+
+
 def build(*parts: tuple[int, int]):
-    size = sum(w for v, w in parts)
-    assert size % 8 == 0, "Instruction length must be multiple of a byte"
-    data = bitarray(endian="big")
-    i = 0
-    for v, w in parts:
-        data.extend(int2ba(v, w, endian="big"))
-        i += w
-    return data.tobytes()
+    return Layout(*(w for v, w in parts)).encode(*(v for v, w in parts))
+
+
+# The formats shared by the base instructions and the extensions building on them
+REG_REG = Layout(2, 2, 4, 3, 3, 2, table=True)
+REG_IMM = Layout(2, 2, 4, 3, 5, table=True)
+NEAR_JUMP = Layout(3, 1, 4, 8)
 
 
 def validate_registers(context, *registers, inst_size: str = None, register_range=range(8)) -> \
@@ -55,7 +86,7 @@ def validate_registers(context, *registers, inst_size: str = None, register_rang
     out_registers = []
     out_sizes = []
     for rs, r in registers:
-        reject(r not in register_range, f"Register {r!r} out of valid range ({register_range})")
+        reject(r not in register_range, lambda: f"Register {r!r} out of valid range ({register_range})")
         out_registers.append(r)
         out_sizes.append(rs)
     size = resolve_register_size(context, inst_size, *out_sizes)
@@ -79,6 +110,20 @@ def strict(context):
     context.reload_extensions()
 
 
+@base.inst('".relax" register_raw')
+def relax(context, register: str):
+    reject(not any(e.strid == 'functions' for e in context.enabled_extensions),
+           "Branch relaxation needs the functions extension for register jumps and calls")
+    context.relax_register = register
+    context.state_version += 1
+
+
+@base.inst('".norelax"')
+def norelax(context):
+    context.relax_register = None
+    context.state_version += 1
+
+
 # We need a negative lookbehind here to prevent "%r 7" from being valid.
 @base.reg(fr'"%r" size_infix /(?!<\s)[0-9]+/', prefix=True)
 @base.reg(fr'"r" size_infix /(?!<\s)[0-9]+/', prefix=False)
@@ -104,16 +149,16 @@ def size_prefix_x(context, x=None):
     return 'x' if x else None
 
 
-@base.inst(f'/{oneof(*INSTRUCTIONS)}/ size_postfix register "," register')
+@base.inst(f'/{oneof(*INSTRUCTIONS)}/ size_postfix register "," register', min_size=2)
 def base_computations_2reg(context, inst: str, inst_size, a: tuple[int | None, int], b: tuple[int | None, int]):
     size, (a, b) = validate_registers(context, a, b, inst_size=inst_size)
 
     op = INSTRUCTIONS[inst]
-    reject(op >= 12, f"Opcode {inst} doesn't have a 2 register form")
-    return build((0b00, 2), (context.register_sizes[size], 2), (op, 4), (a, 3), (b, 3), (0, 2))
+    reject(op >= 12, lambda: f"Opcode {inst} doesn't have a 2 register form")
+    return REG_REG.encode(0b00, context.register_sizes[size], op, a, b, 0)
 
 
-@base.inst(f'/{oneof(*INSTRUCTIONS)}/ size_postfix register "," immediate')
+@base.inst(f'/{oneof(*INSTRUCTIONS)}/ size_postfix register "," immediate', min_size=2)
 def base_computations_imm(context, inst: str, inst_size: str | None, reg: tuple[str | None, int], imm: int):
     size, (a,) = validate_registers(context, reg, inst_size=inst_size)
 
@@ -121,11 +166,12 @@ def base_computations_imm(context, inst: str, inst_size: str | None, reg: tuple[
 
     if op <= 7 or op == 9:
         reject(not isinstance(imm, int) or not (-16 <= imm < 16),
-               f"Invalid immediate for base-isa {imm} with opcode {inst}")
+               lambda: f"Invalid immediate for base-isa {imm} with opcode {inst}")
     else:
-        reject(not isinstance(imm, int) or not (0 <= imm < 32), f"Invalid immediate for base-isa {imm} with opcode {inst}")
+        reject(not isinstance(imm, int) or not (0 <= imm < 32),
+               lambda: f"Invalid immediate for base-isa {imm} with opcode {inst}")
 
-    return build((0b01, 2), (context.register_sizes[size], 2), (op, 4), (a, 3), (imm & 0x1F, 5))
+    return REG_IMM.encode(0b01, context.register_sizes[size], op, a, imm & 0x1F)
 
 
 @base.register_syntax("control_register", "/cr[0-9]+/", prefix=False)
@@ -147,7 +193,7 @@ def named_cr(context, name):
     return NAMED_CRS[name.removeprefix('%')]
 
 
-@base.inst('"mov" size_postfix register_raw "," control_register')
+@base.inst('"mov" size_postfix register_raw "," control_register', min_size=2)
 def mov_from_cr(context, size, reg, cr):
     if size == None:
         size = ''
@@ -156,7 +202,7 @@ def mov_from_cr(context, size, reg, cr):
     """)
 
 
-@base.inst('"mov" size_postfix control_register "," register_raw')
+@base.inst('"mov" size_postfix control_register "," register_raw', min_size=2)
 def mov_to_cr(context, size, cr, reg):
     if size == None:
         size = ''
@@ -165,7 +211,7 @@ def mov_to_cr(context, size, cr, reg):
     """)
 
 
-@base.inst('"mov" size_postfix register_raw "," "[" (register_raw|immediate_raw) "]"')
+@base.inst('"mov" size_postfix register_raw "," "[" (register_raw|immediate_raw) "]"', min_size=2)
 def mov_from_mem(context, size, dest, source):
     if size == None:
         size = ''
@@ -174,7 +220,7 @@ def mov_from_mem(context, size, dest, source):
     """)
 
 
-@base.inst('"mov" size_postfix "[" (register_raw|immediate_raw) "]" "," register_raw')
+@base.inst('"mov" size_postfix "[" (register_raw|immediate_raw) "]" "," register_raw', min_size=2)
 def mov_to_mem(context, size, dest, source):
     if size == None:
         size = ''
@@ -201,36 +247,43 @@ CONDITION_NAMES = {
     "mp": 14, "": 14,
 }
 
-@base.inst(f'/j{oneof(*CONDITION_NAMES, exclude=("",))}/ symbol')
+@base.inst(f'/j{oneof(*CONDITION_NAMES, exclude=("",))}/ symbol', min_size=2)
 def base_jumps(context, inst: str, symbol: tuple[int, str]):
     inst = inst.removeprefix('j')
     op = CONDITION_NAMES[inst]
-    target = context.resolve_symbol(symbol)
+    resolved = target = context.resolve_symbol(symbol)
     if target is None:
         target = context.ip
 
+    if context.is_external(symbol):
+        return external_branch(context, symbol, objects.NEAR_JUMP, NEAR_JUMP.encode(0b100, 0, op, 0),
+                               f"j{inst} {{}}")
+
     offset = target - context.ip
+    if context.relax_register is not None:
+        return relaxed_branch(context, f"j{inst}", context.symbol_id(symbol), resolved, range(-256, 256),
+                              lambda: NEAR_JUMP.encode(0b100, offset < 0, op, offset & 0xFF), f"j{inst} {{}}")
     reject(not (-256 <= offset < 256),
-        f"""Cannot encode near jump:
+        lambda: f"""Cannot encode near jump:
     from `j{inst} {context.symbol_short_name(symbol)}' at 0x{context.ip:04x}
     to `{context.symbol_full_name(symbol)}' resolved to 0x{target:04x}"""
     )
-    return build((0b100, 3), (offset < 0, 1), (op, 4), (offset & 0xFF, 8))
+    return NEAR_JUMP.encode(0b100, offset < 0, op, offset & 0xFF)
 
 
-@base.inst('"nop"')
+@base.inst('"nop"', min_size=2)
 def base_nop(context):
     return b"\x8f\x00"  # jump nowhere, never
 
 
-@base.inst('"halt" | "hlt"')
+@base.inst('"halt" | "hlt"', min_size=2)
 def base_halt(context):
     return b"\x8e\x00"  # jump nowhere, always
 
 
-@base.inst(f'/hlt{oneof(*(name for name in CONDITION_NAMES if name not in ("mp", "")))}/')
+@base.inst(f'/hlt{oneof(*(name for name in CONDITION_NAMES if name not in ("mp", "")))}/', min_size=2)
 def cond_halt(context, inst: str):
     inst = inst.removeprefix('hlt')
     op = CONDITION_NAMES[inst]
 
-    return build((0b1000, 4), (op, 4), (0, 8))
+    return NEAR_JUMP.encode(0b100, 0, op, 0)
@@ -0,0 +1,268 @@
+"""
+Persistent on-disk cache shared between etc-as invocations.
+
+Entries are pickled (or, with `load_json` and `store_json`, written as JSON) into a per-user cache directory
+(``$ETC_AS_CACHE_DIR``, ``$XDG_CACHE_HOME/etc_as`` or ``~/.cache/etc_as``). Every namespace lives in a subdirectory
+tagged with the etc_as and lark versions, so that upgrading either of them invalidates everything written by older
+versions. Entries holding the output of the assembler (included files and lines) are keyed with the
+`source_fingerprint` of the code producing them as well, since the version doesn't change while working on etc_as or
+an extension. They are written as JSON, so that reading them can't run any code. Only the parsers and the dispatch
+indexes built from the grammar are pickled.
+
+Since unpickling an entry can run code, and a forged JSON entry would end up in the output, entries are only read if
+they and every directory above them up to the cache directory belong to the current user and no one else can write to
+them. Anything else is a miss. The cache directory is created accessible to its owner only.
+"""
+from __future__ import annotations
+
+import hashlib
+import importlib
+import importlib.util
+import io
+import json
+import os
+import pickle
+import shutil
+import stat
+import tempfile
+import types
+from functools import lru_cache
+from pathlib import Path
+
+from etc_as import __version__
+
+enabled = True
+
+
+@lru_cache(maxsize=None)
+def version_tag() -> str:
+    # lark is only imported when the cache is actually used, which is when parsers are needed anyway
+    import lark
+    return f"{__version__}-lark{lark.__version__}"
+
+
+@lru_cache(maxsize=None)
+def source_fingerprint(module: str) -> str:
+    """A hash of the source files of `module` (of all of them, for a package), which changes whenever its code does."""
+    spec = importlib.util.find_spec(module)
+    if spec is None or spec.origin is None:
+        return ""
+    if spec.submodule_search_locations:
+        roots = [Path(location) for location in spec.submodule_search_locations]
+        paths = sorted(path for root in roots for path in root.rglob("*")
+                       if path.suffix in (".py", ".lark") and "__pycache__" not in path.parts)
+    else:
+        paths = [Path(spec.origin)]
+    h = hashlib.sha256()
+    for path in paths:
+        h.update(path.name.encode("utf-8"))
+        h.update(b"\0")
+        h.update(path.read_bytes())
+    return h.hexdigest()
+
+
+def cache_dir() -> Path:
+    if "ETC_AS_CACHE_DIR" in os.environ:
+        return Path(os.environ["ETC_AS_CACHE_DIR"])
+    base = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(base) / "etc_as"
+
+
+def fingerprint(*parts) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(repr(part).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class _Pickler(pickle.Pickler):
+    # Lark parsers keep a reference to the regex module they use, which pickle can't handle by itself.
+    def persistent_id(self, obj):
+        if isinstance(obj, types.ModuleType):
+            return "module", obj.__name__
+        return None
+
+
+class _Unpickler(pickle.Unpickler):
+    def persistent_load(self, pid):
+        kind, name = pid
+        assert kind == "module", pid
+        return importlib.import_module(name)
+
+
+def _namespace_dir(namespace: str) -> Path:
+    return cache_dir() / namespace / version_tag()
+
+
+# Directories `_is_private` found to be safe in this process
+_private_dirs: set[Path] = set()
+
+
+def _owned(st: os.stat_result) -> bool:
+    """Whether the file with the status `st` belongs to the current user, and no one else can change it."""
+    return not hasattr(os, "getuid") or (st.st_uid == os.getuid() and not st.st_mode & 0o022)
+
+
+def _is_private(directory: Path) -> bool:
+    """Whether `directory` and every directory above it up to the cache directory are `_owned`."""
+    root = cache_dir()
+    path = directory
+    while path not in _private_dirs:
+        try:
+            # The cache directory itself may be a link, but nothing in it may be
+            st = os.stat(path) if path == root else os.lstat(path)
+        except OSError:
+            return False
+        if not stat.S_ISDIR(st.st_mode) or not _owned(st):
+            return False
+        if path == root or path == path.parent:
+            break
+        path = path.parent
+    _private_dirs.add(directory)
+    return True
+
+
+def _open(namespace: str, key: str):
+    """
+    Opens the entry stored under `key` for reading. Raises PermissionError for entries someone else could have written,
+    so that they are never read.
+    """
+    path = _namespace_dir(namespace) / key
+    if not _is_private(path.parent):
+        raise PermissionError(f"{path.parent} can be changed by other users")
+    f = open(path, "rb")
+    if not _owned(os.fstat(f.fileno())):
+        f.close()
+        raise PermissionError(f"{path} can be changed by other users")
+    return f
+
+
+def load(namespace: str, key: str):
+    """
+    Returns the entry stored under `key`, or None if there is none (or it can't be unpickled, e.g. because it was cut
+    short). Keys may contain a `/` to spread the entries of a namespace over subdirectories.
+    """
+    if not enabled:
+        return None
+    try:
+        with _open(namespace, key) as f:
+            return _Unpickler(f).load()
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError):
+        return None
+
+
+def load_json(namespace: str, key: str):
+    """Like `load`, for entries written with `store_json`, which can't run any code when they are read."""
+    if not enabled:
+        return None
+    try:
+        with _open(namespace, key) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def store(namespace: str, key: str, value) -> None:
+    """Atomically writes `value` under `key`. Failing to write the cache is never an error."""
+    if not enabled:
+        return
+    buffer = io.BytesIO()
+    try:
+        _Pickler(buffer, protocol=pickle.HIGHEST_PROTOCOL).dump(value)
+    except (pickle.PicklingError, TypeError, AttributeError):
+        return
+    _write(namespace, key, buffer.getvalue())
+
+
+def store_json(namespace: str, key: str, value) -> None:
+    """Like `store`, writing `value` as JSON."""
+    if not enabled:
+        return
+    _write(namespace, key, json.dumps(value, separators=(",", ":")).encode("utf-8"))
+
+
+def _write(namespace: str, key: str, data: bytes) -> None:
+    directory = _namespace_dir(namespace)
+    path = directory / key
+    try:
+        if not directory.is_dir():
+            # Only the cache directory has to be private for everything in it to be
+            cache_dir().mkdir(mode=0o700, parents=True, exist_ok=True)
+            directory.mkdir(mode=0o700, parents=True, exist_ok=True)
+            _remove_stale_versions(directory.parent)
+        if not path.parent.is_dir():
+            path.parent.mkdir(mode=0o700, parents=True, exist_ok=True)
+        if not _is_private(path.parent):
+            return
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+    except OSError:
+        pass
+
+
+def touch(namespace: str, key: str) -> None:
+    """Marks the entry stored under `key` as used, which keeps `evict` from removing it for a while."""
+    if not enabled:
+        return
+    try:
+        os.utime(_namespace_dir(namespace) / key)
+    except OSError:
+        pass
+
+
+def evict(namespace: str, subdirectory: str, max_size: int) -> int:
+    """
+    Removes the least recently stored or touched entries in `subdirectory` of `namespace` until the rest take at most
+    `max_size` bytes. Returns how many were removed. Entries removed by someone else at the same time are skipped.
+    """
+    if not enabled:
+        return 0
+    directory = _namespace_dir(namespace) / subdirectory
+    if not _is_private(directory):
+        return 0
+    entries = []
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                if entry.name.startswith(".tmp-"):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, entry.path))
+    except OSError:
+        return 0
+    size = sum(entry_size for _, entry_size, _ in entries)
+    removed = 0
+    entries.sort()
+    for _, entry_size, path in entries:
+        if size <= max_size:
+            break
+        try:
+            os.unlink(path)
+        except OSError:
+            continue
+        size -= entry_size
+        removed += 1
+    return removed
+
+
+def _remove_stale_versions(namespace_root: Path) -> None:
+    for entry in namespace_root.iterdir():
+        if entry.name != version_tag() and entry.is_dir():
+            shutil.rmtree(entry, ignore_errors=True)
+
+
+def clear(namespace: str = None) -> None:
+    """Removes `namespace` (or every namespace) from the on-disk cache."""
+    target = cache_dir() if namespace is None else cache_dir() / namespace
+    shutil.rmtree(target, ignore_errors=True)
+    _private_dirs.clear()
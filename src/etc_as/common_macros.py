@@ -13,9 +13,9 @@ def split_into_bit_groups(imm):
         groups.append((imm >> i) & 0x1F)
     return groups
 
-@common_macros.inst('"mov" register_raw "," immediate')
+@common_macros.inst('"mov" register_raw "," immediate', min_size=2)
 def mov_large_immediate(context, reg, imm):
-    reject_msg = f'Immediate is too large to fit in a register: {imm}'
+    reject_msg = lambda: f'Immediate is too large to fit in a register: {imm}'
     if -2**7 <= imm <= 2**8 - 1 and 'h' in reg:
         size = 'h'
         imm = sign_extend(imm, 8)
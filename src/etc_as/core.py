@@ -3,33 +3,138 @@ from __future__ import annotations
 from ast import literal_eval
 
 import copy
+import hashlib
+import io
 import logging
-from collections import defaultdict
+import os
+import re
+from bisect import bisect_right
+from collections import defaultdict, OrderedDict
 from dataclasses import dataclass, field
-from functools import partial, reduce
+from functools import cached_property, reduce
+from itertools import product
 from pathlib import Path
 from pprint import pformat
-from string import Template
+from string import Formatter, Template
 from textwrap import indent
-from types import SimpleNamespace
-from typing import Callable, NamedTuple, Iterable
+from typing import AbstractSet, Callable, NamedTuple, Iterable
 
 from frozendict import frozendict
-from lark import Lark, Transformer, GrammarError, Tree
-from lark.exceptions import VisitError
-from lark.load_grammar import GrammarBuilder
-from lark.visitors import CollapseAmbiguities
+from lark import Token, Tree, UnexpectedInput
+
+from etc_as import cache, extensions, objects, profiling
+from etc_as.line_cache import LineCache, Variant, binary_from_json, binary_to_json
+from etc_as.parser import InstructionParser
+from etc_as.relax import BranchSites
+from etc_as.symbols import ROOT, SymbolTable
+
+
+# Context fields that stay the same for a whole assembly and are not part of snapshots
+_SHARED_CONTEXT_FIELDS = frozenset({'verbosity', 'logger', 'available_extensions', 'reload_extensions', 'macro',
+                                    'symbol_reads', 'ip_reads', 'branches', 'symbols', 'external_symbols',
+                                    'symbol_log'})
+# The pass state an included file may change and still be reused, see Assembler.include
+_UNIT_RESULT_FIELDS = frozenset({'full_ip', 'symbol_scopes', 'missing_symbols', 'changed_symbols', 'defined_symbols',
+                                 'known_macros', 'macro_table', 'state_version', 'output'})
+
+
+@dataclass(eq=False)
+class Context:
+    """
+    The state instruction handlers work with.
+
+    Everything but the shared fields above is pass state, which Assembler.n_pass saves with `snapshot` and resets
+    with `restore` between passes. Extensions may attach additional attributes, which are treated as pass state too.
+    """
+    verbosity: int = 0
+    logger: logging.Logger | None = None
+    # The strids of the extensions that can be enabled, extensions.known for all of them
+    available_extensions: AbstractSet[str] = frozenset()
+    reload_extensions: Callable[[], None] | None = None
+    macro: Callable[[str, MacroInvocation | None], bytes] | None = None
+    # Symbols read by the line currently being recorded, see Assembler.handle_line
+    symbol_reads: dict[int, int | None] | None = None
+    # Every definition of a symbol while an included file is being recorded, see Assembler.include
+    symbol_log: list[tuple[int, str, int, int]] | None = None
+    # Counts reads of `ip`, so that Assembler.macro can tell whether an expansion depends on where it is placed
+    ip_reads: int = 0
+    # Which branches need their long form, kept across passes, see etc_as.relax
+    branches: BranchSites | None = None
+    # The symbols keep their values across passes, so that forward references resolve in the next one
+    symbols: SymbolTable = field(default_factory=SymbolTable)
+    # The symbols left to the linker when assembling an object, None otherwise, see etc_as.objects
+    external_symbols: set[int] | None = None
+
+    full_ip: int = 0
+    ip_mask: int = 0xFFFF
+    modes: set[str] = field(default_factory=set)
+    enabled_extensions: list[Extension] = field(default_factory=list)
+    default_size: str = 'x'
+    register_sizes: dict[str, int] = field(default_factory=dict)
+    # The ids of the current label and all of its prefixes, starting with the root, see set_symbol
+    symbol_scopes: list[int] = field(default_factory=lambda: [ROOT])
+    missing_symbols: set[int] = field(default_factory=set)
+    changed_symbols: set[int] = field(default_factory=set)
+    illegal_symbols: set[int] = field(default_factory=set)
+    # The symbols defined so far in this pass
+    defined_symbols: set[int] = field(default_factory=set)
+    exported_symbols: set[int] = field(default_factory=set)
+    known_macros: dict[str, MacroDefinition] = field(default_factory=dict)
+    macro_table: int = 0
+    # The scratch register for long branches selected with `.relax`, None if branches aren't relaxed
+    relax_register: str | None = None
+    # Bumped whenever a line changes state other lines depend on (symbols, modes, extensions)
+    state_version: int = 0
+    output: list[InstructionOutput] = field(default_factory=list)
 
-
-class Context(SimpleNamespace):
     @property
     def ip(self):
+        self.ip_reads += 1
         return self.full_ip & self.ip_mask
 
     @ip.setter
     def ip(self, value):
         self.full_ip = ((self.full_ip & ~self.ip_mask) | (self.ip_mask & value))
 
+    def advance(self, size: int):
+        """Moves `ip` forward by `size` bytes after emitting them, without counting as a read of it."""
+        self.ip = self.full_ip + size
+
+    def snapshot(self) -> dict[str, object]:
+        """Copies the pass state. Containers are copied one level deep, the values in them are shared."""
+        return {name: copy.copy(value) for name, value in vars(self).items() if name not in _SHARED_CONTEXT_FIELDS}
+
+    def restore(self, snapshot: dict[str, object]):
+        for name, value in snapshot.items():
+            setattr(self, name, copy.copy(value))
+
+    def symbol_id(self, name: tuple[int, str]) -> int:
+        dots, short_name = name
+        scopes = self.symbol_scopes
+        # With more dots than there are enclosing labels, the name is local to the innermost one
+        return self.symbols.intern(scopes[min(dots, len(scopes) - 1)], short_name)
+
+    def symbol_full_name(self, name: tuple[int, str]) -> str:
+        return self.symbols.full_name(self.symbol_id(name))
+
+    def symbol_short_name(self, name: tuple[int, str]) -> str:
+        return '.' * name[0] + name[1]
+
+    def is_external(self, name: tuple[int, str]) -> bool:
+        return bool(self.external_symbols) and self.symbol_id(name) in self.external_symbols
+
+    def resolve_symbol(self, name: tuple[int, str]) -> int | None:
+        symbol = self.symbol_id(name)
+        value = self.symbols.values[symbol]
+        if self.symbol_reads is not None:
+            self.symbol_reads[symbol] = value
+        if value is None:
+            if self.external_symbols and symbol in self.external_symbols:
+                return None
+            reject(symbol in self.illegal_symbols, lambda: f"Symbol {self.symbols.full_name(symbol)} is not defined")
+            self.missing_symbols.add(symbol)
+        return value
+
 
 @dataclass
 class SyntaxElement:
@@ -39,6 +144,10 @@ class SyntaxElement:
     func: Callable
     strid: str
     required_markers: frozendict[str, bool]
+    # A lower bound on the size of the output, used to stop exploring alternatives early
+    min_size: int = 0
+    # Whether `func` doesn't use the context, so that it can be evaluated ahead of time if its arguments are constant
+    pure: bool = False
 
 
 potential_extensions: dict[str, Extension] = {}
@@ -61,14 +170,16 @@ class Extension:
         assert self.name not in potential_extensions
         potential_extensions[self.strid] = self
 
-    def register_syntax(self, category: str, grammar, func=None, /, **kwargs: bool):
+    def register_syntax(self, category: str, grammar, func=None, /, *, min_size: int = 0, pure: bool = False,
+                        **kwargs: bool):
         def dec(f):
             markers = frozendict(kwargs)
             i = 0
             f_name = f.__name__ if f.__name__.isidentifier() else "unknown"
             while (sid := f'{f_name}_{i}') in self.syntax_elements_by_id:
                 i += 1
-            self.syntax_elements[markers].append(se := SyntaxElement(self, category, grammar, f, sid, markers))
+            self.syntax_elements[markers].append(se := SyntaxElement(self, category, grammar, f, sid, markers,
+                                                                     min_size, pure))
             self.syntax_elements_by_id[sid] = se
             return f
 
@@ -77,8 +188,8 @@ class Extension:
         else:
             return dec(func)
 
-    def inst(self, grammar, /, **kwargs: bool):
-        return self.register_syntax("instruction", grammar, **kwargs)
+    def inst(self, grammar, /, *, min_size: int = 0, **kwargs: bool):
+        return self.register_syntax("instruction", grammar, min_size=min_size, **kwargs)
 
     def reg(self, grammar, /, **kwargs: bool):
         return self.register_syntax("register", grammar, **kwargs)
@@ -97,41 +208,30 @@ class Extension:
 core = Extension(None, "core", "Core Assembly", True)
 
 
-def _symbol_full_name(context, name: tuple[int, str]) -> str:
-    return '.'.join((*context.symbol_path[:name[0]], name[1]))
-
-
-def _symbol_short_name(context, name: tuple[int, str]) -> str:
-    return '.' * name[0] + name[1]
-
-def _resolve_symbol(context, name: tuple[int, str]) -> int | None:
-    full_name = context.symbol_full_name(name)
-    if full_name in context.symbols:
-        return context.symbols[full_name]
-    else:
-        reject(full_name in context.illegal_symbols, f"Symbol {full_name} is not defined")
-        context.missing_symbols.add(full_name)
-        return None
-
-
 @core.set_init
 def core_init(context):
-    context.enabled_extensions = [e for a in context.available_extensions
-                                  if (e := potential_extensions[a]).default_on]
+    # Iterate in registration order: the set of available extensions has no stable order between runs. Extensions
+    # that aren't built in (only created by some imported module) come last.
+    builtin = extensions.BUILTIN_EXTENSIONS
+    context.enabled_extensions = [extensions.load(strid) for strid, info in builtin.items()
+                                  if strid in context.available_extensions and info.default_on]
+    context.enabled_extensions += [e for e in potential_extensions.values() if e.strid not in builtin
+                                   and e.strid in context.available_extensions and e.default_on]
     for e in context.enabled_extensions:
         if e.init is not None and e is not core:
             e.init(context)
     context.modes = set()
     context.ip_mask = 0xFFFF
     context.full_ip = 0xFFFF_FFFF_FFFF_8000
-    context.symbols = {}
-    context.symbol_path = ['']
+    context.symbols = SymbolTable()
+    context.symbol_scopes = [ROOT, context.symbols.intern(ROOT, '')]
     context.missing_symbols = set()
     context.changed_symbols = set()
     context.illegal_symbols = set()
-    context.symbol_short_name = partial(_symbol_short_name, context)
-    context.symbol_full_name = partial(_symbol_full_name, context)
-    context.resolve_symbol = partial(_resolve_symbol, context)
+    context.defined_symbols = set()
+    context.exported_symbols = set()
+    context.symbol_reads = None
+    context.state_version = 0
     context.reload_extensions()
 
 
@@ -150,7 +250,11 @@ _WORD_SIZES = {
 
 @core.inst(fr'/{oneof(*_WORD_SIZES)}/ immediate*')
 def put_word(context, size, *values):
-    return b"".join(value.to_bytes(_WORD_SIZES[size], "little", signed=value < 0) for value in values)
+    width = _WORD_SIZES[size]
+    data = b"".join(value.to_bytes(width, "little", signed=value < 0) for value in values)
+    relocations = [objects.Relocation(i * width, size[1:], value.symbol)
+                   for i, value in enumerate(values) if isinstance(value, objects.External)]
+    return objects.Relocated(data, relocations) if relocations else data
 
 
 encodings = {
@@ -176,6 +280,8 @@ def put_stringz(context, encoding, string):
 def balign(context, _, size, width, fill_value=None, max_jump=None):
     delta = (width - context.ip % width) % width
     assert (context.ip + delta) % width == 0, (context.ip, delta, width)
+    if context.branches is not None:
+        context.branches.anchor(context.ip + delta)
     word_width = (2 ** context.register_sizes[size]) if size is not None else 1
     if max_jump is not None and max_jump < width:
         return None
@@ -196,25 +302,36 @@ def p2align(context, _, size, width, fill_value=None, max_jump=None):
 
 @core.inst(fr'".org" immediate ["," immediate]')
 def org(context, target, fill_value=None):
+    if context.branches is not None:
+        context.branches.anchor(target)
     if fill_value is None:
         context.ip = target
         return None
+    elif target < context.ip:
+        # Going backwards, there is nothing to fill
+        context.ip = target
+        return b''
     else:
         fv = fill_value.to_bytes(1, "little", signed=fill_value < 0)
-        delta = target - context.ip
-        return fv * delta
+        return Fill(fv, target - context.ip)
 
 
 @core.inst(r'".set" symbol immediate')
 def set_symbol(context, symbol, value):
     dot_count, name = symbol
-    while len(context.symbol_path) < dot_count:
-        context.symbol_path.append('')
-    context.symbol_path[dot_count:] = [name]
-    full_name = '.'.join((*context.symbol_path[:dot_count], name))
-    if context.symbols.get(full_name, None) != value:
-        context.changed_symbols.add(full_name)
-    context.symbols[full_name] = value
+    symbols, scopes = context.symbols, context.symbol_scopes
+    # A label with more dots than there are enclosing labels gets empty ones in between
+    while len(scopes) <= dot_count:
+        scopes.append(symbols.intern(scopes[-1], ''))
+    del scopes[dot_count + 1:]
+    symbol = symbols.intern(scopes[-1], name)
+    scopes.append(symbol)
+    context.defined_symbols.add(symbol)
+    if context.symbol_log is not None:
+        context.symbol_log.append((dot_count, name, value, symbol))
+    if symbols.set(symbol, value):
+        context.changed_symbols.add(symbol)
+    context.state_version += 1
     return b''
 
 
@@ -230,12 +347,20 @@ def local_label(context, dots: str, name: str):
     return b''
 
 
-@core.register_syntax('symbol', 'NAME')
+@core.inst(r'".global" symbol ("," symbol)*')
+def export_symbols(context, *names):
+    context.exported_symbols.update(map(context.symbol_id, names))
+    # Not a line that can be replayed from the line cache, the exports are pass state
+    context.state_version += 1
+    return b''
+
+
+@core.register_syntax('symbol', 'NAME', pure=True)
 def global_symbol_reference(context, name: str):
     return 0, str(name)
 
 
-@core.register_syntax('symbol', r'/\.+/ NAME')
+@core.register_syntax('symbol', r'/\.+/ NAME', pure=True)
 def local_symbol_reference(context, dots, name: str):
     return len(dots), str(name)
 
@@ -246,7 +371,7 @@ def enable_extension(context, *names: str):
     for name in names:
         if name not in context.available_extensions:
             raise ValueError(f"Unknown extension {name!r}, expected one of {list(context.available_extensions)}")
-        ext = potential_extensions[name]
+        ext = extensions.load(name)
         if ext not in context.enabled_extensions:
             context.enabled_extensions.append(ext)
             if ext.init is not None:
@@ -255,29 +380,34 @@ def enable_extension(context, *names: str):
     context.reload_extensions()
 
 
-core.register_syntax('atom', r'/[+-]?[0-9]+(_[0-9]+)*/', lambda _, x: int(str(x), 10))
-core.register_syntax('atom', r'/[+-]?0[bB]_?[01]+(_[01]+)*/', lambda _, x: int(x[2:].removeprefix('_'), 2))
-core.register_syntax('atom', r'/[+-]?0[oO]_?[0-7]+(_[0-7]+)*/', lambda _, x: int(x[2:].removeprefix('_'), 8))
-core.register_syntax('atom', r'/[+-]?0x_?[0-9a-f]+(_[0-9a-f]+)*/i', lambda _, x: int(x[2:].removeprefix('_'), 16))
+core.register_syntax('atom', r'/[+-]?[0-9]+(_[0-9]+)*/', lambda _, x: int(str(x), 10), pure=True)
+core.register_syntax('atom', r'/[+-]?0[bB]_?[01]+(_[01]+)*/', lambda _, x: int(x[2:].removeprefix('_'), 2),
+                     pure=True)
+core.register_syntax('atom', r'/[+-]?0[oO]_?[0-7]+(_[0-7]+)*/', lambda _, x: int(x[2:].removeprefix('_'), 8),
+                     pure=True)
+core.register_syntax('atom', r'/[+-]?0x_?[0-9a-f]+(_[0-9a-f]+)*/i', lambda _, x: int(x[2:].removeprefix('_'), 16),
+                     pure=True)
 
-core.register_syntax('atom', r"/'([^'\\\n]|\\[^\n])'/", lambda _, x: ord(literal_eval(x)))
+core.register_syntax('atom', r"/'([^'\\\n]|\\[^\n])'/", lambda _, x: ord(literal_eval(x)), pure=True)
 
 core.register_syntax('atom', r'/\$/', lambda c, _: c.ip)
 
-core.register_syntax('immediate', 'expression_or', lambda _, x: x)
+core.register_syntax('immediate', 'expression_or', lambda _, x: x, pure=True)
 
 
 @core.register_syntax('atom', 'symbol')
 def immediate_symbol(context, symbol):
     value = context.resolve_symbol(symbol)
     if value is None:
+        if context.is_external(symbol):
+            return objects.External(context.symbol_full_name(symbol))
         # This symbol is not defined right now. To simplify instruction creators, make it 0 in this pass
         return 0
     else:
         return value
 
 
-@core.register_syntax('expression_paren', '"(" expression_or ")" | atom')
+@core.register_syntax('expression_paren', '"(" expression_or ")" | atom', pure=True)
 def expr_paren(context, immediate: int):
     return immediate
 
@@ -285,7 +415,7 @@ def expr_paren(context, immediate: int):
 UNARY_OPERATIONS = {'~': lambda x: ~x, '!': lambda x: int(not x), '-': lambda x: -x, '+': lambda x: +x}
 
 
-@core.register_syntax('expression_unary', '/~|!|-|\+/ expression_paren')
+@core.register_syntax('expression_unary', '/~|!|-|\+/ expression_paren', pure=True)
 def expr_unary(context, operator, expression):
     return UNARY_OPERATIONS[operator](expression)
 
@@ -294,7 +424,8 @@ MUL_OPERATIONS = {'*': lambda a, b: a * b, '/': lambda a, b: a // b, '%': lambda
 
 
 @core.register_syntax('expression_mul',
-                      '(expression_paren | expression_unary) (/\/|\*|%/ (expression_paren | expression_unary))*')
+                      '(expression_paren | expression_unary) (/\/|\*|%/ (expression_paren | expression_unary))*',
+                      pure=True)
 def expr_mul(context, acc, *ops_and_exprs):
     for op, expr in zip(ops_and_exprs[::2], ops_and_exprs[1::2]):
         acc = MUL_OPERATIONS[op](acc, expr)
@@ -304,7 +435,7 @@ def expr_mul(context, acc, *ops_and_exprs):
 ADD_OPERATIONS = {'+': lambda a, b: a + b, '-': lambda a, b: a - b}
 
 
-@core.register_syntax('expression_add', 'expression_mul (/\+|-/ expression_mul)*')
+@core.register_syntax('expression_add', 'expression_mul (/\+|-/ expression_mul)*', pure=True)
 def expr_add(context, acc, *ops_and_exprs):
     for op, expr in zip(ops_and_exprs[::2], ops_and_exprs[1::2]):
         acc = ADD_OPERATIONS[op](acc, expr)
@@ -314,51 +445,212 @@ def expr_add(context, acc, *ops_and_exprs):
 SHIFT_OPERATIONS = {'<<': lambda a, b: a << b, '>>': lambda a, b: a >> b}
 
 
-@core.register_syntax('expression_shift', 'expression_add (/<<|>>/ expression_add)*')
+@core.register_syntax('expression_shift', 'expression_add (/<<|>>/ expression_add)*', pure=True)
 def expr_shift(context, acc, *ops_and_exprs):
     for op, expr in zip(ops_and_exprs[::2], ops_and_exprs[1::2]):
         acc = SHIFT_OPERATIONS[op](acc, expr)
     return acc
 
 
-@core.register_syntax('expression_and', 'expression_shift ("&"  expression_shift)*')
+@core.register_syntax('expression_and', 'expression_shift ("&"  expression_shift)*', pure=True)
 def expr_and(context, expr, *exprs):
     return reduce(lambda a, b: a & b, exprs, expr)
 
 
-@core.register_syntax('expression_xor', 'expression_and ("^" expression_and)*')
+@core.register_syntax('expression_xor', 'expression_and ("^" expression_and)*', pure=True)
 def expr_xor(context, expr, *exprs):
     return reduce(lambda a, b: a ^ b, exprs, expr)
 
 
-@core.register_syntax('expression_or', 'expression_xor ("|" expression_xor)*')
+@core.register_syntax('expression_or', 'expression_xor ("|" expression_xor)*', pure=True)
 def expr_or(context, expr, *exprs):
     return reduce(lambda a, b: a | b, exprs, expr)
 
 
-class _CompileInstruction(Transformer):
-    def __init__(self, context, line):
-        super().__init__()
+class _Node:
+    """
+    A node of a compiled parse forest. `data` is the alias of the syntax element, with its function looked up once.
+    Nodes that evaluate to the same values every time have them in `values`: tokens, the text of `_raw` nodes, and
+    pure syntax elements of constant nodes, which covers most immediates. The parameters of a macro template are
+    `_argument` nodes, or `_argument_text` if their text is used.
+    """
+    __slots__ = ('data', 'children', 'func', 'text', 'index', 'values')
+
+    def __init__(self, data: str | None, children: list[_Node] = (), func: Callable = None, text: str = None,
+                 index: int = None, values: list = None):
+        self.data = data
+        self.children = children
+        self.func = func
+        self.text = text
+        self.index = index
+        self.values = values
+
+
+def _fold(func: Callable, children: list[_Node]) -> list | None:
+    """The values of a pure syntax element applied to constant nodes, None if that has to wait until it is used."""
+    values = []
+    try:
+        for args in product(*(child.values for child in children)):
+            value = func(None, *args)
+            if value not in values:
+                values.append(value)
+    except (Exception, RejectionError):
+        # Rejections and errors are reported when (and if) this alternative is evaluated
+        return None
+    return values
+
+
+class _Program:
+    """
+    The parse tree of a line compiled for evaluation, see _Node. `replace` maps the ids of the nodes of a macro
+    template that stand for a parameter to its index and whether its text is used.
+    """
+
+    def __init__(self, tree: Tree, text: str, replace: dict[int, tuple[int, bool]] = None):
+        self.tree = tree
+        self.text = text
+        self.replace = replace or {}
+        self.compiled: dict[int, _Node] = {}
+        self.alternatives = [self.compile(alternative) for alternative in _alternatives(tree)]
+        self.min_sizes = [_min_size(alternative) for alternative in _alternatives(tree)]
+        del self.compiled, self.replace
+
+    def compile(self, node) -> _Node:
+        if not isinstance(node, Tree):
+            # Tokens, and None for optional parts that are missing
+            return _Node(None, values=[node])
+        try:
+            return self.compiled[id(node)]
+        except KeyError:
+            pass
+        if id(node) in self.replace:
+            index, raw = self.replace[id(node)]
+            result = _Node('_argument_text' if raw else '_argument', index=index)
+        else:
+            children = [self.compile(child) for child in node.children]
+            constant = all(child.values is not None for child in children)
+            data = node.data
+            if data == '_ambig':
+                result = _Node(data, children)
+                if constant:
+                    result.values = []
+                    for value in (value for child in children for value in child.values):
+                        if value not in result.values:
+                            result.values.append(value)
+            elif data.endswith('_raw'):
+                # The children only have to be valid, the text is what gets used
+                result = _Node(data, children, text=self.text[node.meta.start_pos:node.meta.end_pos])
+                if constant:
+                    result.values = [result.text] if all(child.values for child in children) else []
+            elif data == 'macro_invocation':
+                result = _Node(data, children)
+            else:
+                element = _syntax_element(data)
+                result = _Node(data, children, func=element.func)
+                if constant and element.pure:
+                    result.values = _fold(element.func, children)
+        self.compiled[id(node)] = result
+        return result
+
+
+class _CompileInstruction:
+    """
+    Evaluates the compiled parse forest of a single line.
+
+    Every subtree evaluates to the list of distinct values its alternatives produce (in the order they are first
+    produced), so independent ambiguities in the operands don't multiply with each other. Only combinations of
+    distinct operand values are passed on to the syntax functions, and at most `limit` calls are made in total.
+    Constant subtrees were already evaluated by _Program, and don't count towards the limit. `arguments` fills in
+    the parameters if the line is a macro template.
+    """
+
+    def __init__(self, context, line, limit, arguments: MacroInvocation = None):
         self.context = context
         self.line = line
-
-    def macro_invocation(self, children):
+        self.arguments = arguments
+        self.remaining = limit
+        self.limit = limit
+        self.rejections: list[RejectionError] = []
+        self.values_of: dict[int, list] = {}
+
+    def values(self, node: _Node) -> list:
+        if node.values is not None:
+            return node.values
+        try:
+            return self.values_of[id(node)]
+        except KeyError:
+            pass
+        values = []
+        if node.data == '_ambig':
+            for child in node.children:
+                for value in self.values(child):
+                    if value not in values:
+                        values.append(value)
+        elif node.data == '_argument':
+            values = self.values(self.arguments.nodes[node.index])
+        elif node.data == '_argument_text':
+            values = [self.arguments.arguments[node.index]]
+        else:
+            for args in product(*map(self.values, node.children)):
+                try:
+                    value = self.call(node, args)
+                except RejectionError as e:
+                    self.rejections.append(e)
+                    continue
+                if value not in values:
+                    values.append(value)
+                if node.text is not None:
+                    break
+        self.values_of[id(node)] = values
+        return values
+
+    def call(self, node: _Node, args: tuple):
+        if node.text is not None:
+            return node.text
+        self.remaining -= 1
+        if self.remaining < 0:
+            raise TooManyAlternatives(self.line, self.limit)
+        if node.data == 'macro_invocation':
+            return self.macro_invocation(node, args)
+        with profiling.active.phase("transform"):
+            return node.func(self.context, *args)
+
+    def macro_invocation(self, node: _Node, children):
         name, *args = children
         if name in self.context.known_macros:
-            argc, body = self.context.known_macros[name]
-            if argc == len(args):
-                return self.context.macro(body.format(*args))
-            raise RejectionError(f"Unexpected number of arguments for macro {name}. (got {len(args)}, expected {argc}")
+            macro = self.context.known_macros[name]
+            if macro.argc == len(args):
+                invocation = MacroInvocation(macro, tuple(args), _argument_nodes(node), self.line)
+                return self.context.macro(invocation.expand(), invocation)
+            raise RejectionError(
+                f"Unexpected number of arguments for macro {name}. (got {len(args)}, expected {macro.argc}")
         raise RejectionError(None)
 
-    def __default__(self, data, children, meta):
-        if data.endswith('_raw'):
-            return self.line[meta.start_pos:meta.end_pos]
-        assert '__' in data, (data, children)
-        ext, _, sid = data.partition('__')
-        ext = potential_extensions[ext]
-        se = ext.syntax_elements_by_id[sid]
-        return se.func(self.context, *children)
+
+def _argument_nodes(node: _Node) -> tuple[_Node, ...] | None:
+    """The atoms passed to a macro invocation, or None if they can't be taken from the tree as they are."""
+    arguments = node.children[1:]
+    if all(a.data == 'atom_raw' and len(a.children) == 1 for a in arguments):
+        return tuple(a.children[0] for a in arguments)
+    return None
+
+
+def _syntax_element(alias: str) -> SyntaxElement:
+    assert '__' in alias, alias
+    ext, _, sid = alias.partition('__')
+    return potential_extensions[ext].syntax_elements_by_id[sid]
+
+
+def _alternatives(tree: Tree) -> list[Tree]:
+    if tree.data != '_ambig':
+        return [tree]
+    return [alternative for child in tree.children for alternative in _alternatives(child)]
+
+
+def _min_size(alternative: Tree) -> int:
+    if alternative.data == 'macro_invocation':
+        return 0
+    return _syntax_element(alternative.data).min_size
 
 
 class RejectionError(BaseException):
@@ -380,67 +672,494 @@ class UnknownInstruction(Exception):
         super().__init__(message)
 
 
-def reject(cond=True, message: str = None):
+class TooManyAlternatives(Exception):
+    def __init__(self, line: str, limit: int) -> None:
+        self.line = line
+        self.limit = limit
+        super().__init__(f"Instruction is too ambiguous: {line.strip()}\n"
+                         f"Gave up after trying {limit} interpretations")
+
+
+class MacroError(Exception):
+    """An instruction of a macro body that couldn't be assembled, with where the macro was invoked."""
+
+    def __init__(self, name: str, number: int, line: str, invocation: str, cause: Exception) -> None:
+        self.name = name
+        self.number = number
+        self.line = line
+        self.invocation = invocation
+        super().__init__(f"{cause}\n  in line {number + 1} of macro {name}: {line.strip()}\n"
+                         f"  invoked by: {invocation.strip()}")
+
+
+# Stands in for a macro parameter while parsing a body line, must be a valid NAME
+_PLACEHOLDER = "__macro_parameter_{}__"
+
+
+@dataclass(frozen=True)
+class MacroLine:
+    """
+    A line of a macro body. In `template` each parameter is replaced by a placeholder symbol, whose positions and
+    parameter indices are in `slots`. Lines using anything but plain `{0}` or `{}` fields have no template.
+    """
+    text: str
+    template: str | None
+    slots: tuple[tuple[int, int, int], ...]
+
+    @classmethod
+    def parse(cls, text: str, auto: int = 0) -> MacroLine:
+        """`auto` is the index of the first `{}` field, which continues from the previous lines."""
+        template, slots = [], []
+        fields = _fields(text)
+        if fields is None:
+            return cls(text, None, ())
+        for literal, name, spec, conversion in fields:
+            template.append(literal)
+            if name is None:
+                continue
+            if spec or conversion or not (name == '' or name.isdigit()):
+                return cls(text, None, ())
+            if name == '':
+                index, auto = auto, auto + 1
+            else:
+                index = int(name)
+            start = sum(map(len, template))
+            template.append(_PLACEHOLDER.format(index))
+            slots.append((start, start + len(template[-1]), index))
+        return cls(text, ''.join(template), tuple(slots))
+
+
+@dataclass(frozen=True)
+class MacroDefinition:
+    name: str
+    argc: int
+    body: str
+    lines: tuple[MacroLine, ...]
+
+    @classmethod
+    def parse(cls, name: str, argc: int, lines: list[str]) -> MacroDefinition:
+        parsed, auto = [], 0
+        for text in lines:
+            parsed.append(MacroLine.parse(text, auto))
+            auto += sum(index == '' for _, index, _, _ in _fields(text) or ())
+        return cls(name, argc, '\n'.join(lines), tuple(parsed))
+
+
+def _fields(text: str) -> list[tuple] | None:
+    try:
+        return list(Formatter().parse(text))
+    except ValueError:
+        # Reported once the macro is invoked, like before
+        return None
+
+
+class MacroInvocation(NamedTuple):
+    macro: MacroDefinition
+    # The text of each argument, and the compiled tree of each, unless they couldn't be taken from the invocation
+    arguments: tuple[str, ...]
+    nodes: tuple[_Node, ...] | None
+    line: str
+
+    def expand(self) -> str:
+        return self.macro.body.format(*self.arguments)
+
+
+class _MacroTemplate:
+    """
+    The compiled parse tree of a macro body line with placeholders, and where the arguments go into it.
+
+    A placeholder that was parsed as an atom stands for the tree of the argument, and one that is the text of an
+    `atom_raw` for the text of the argument. Anywhere else, for example as part of a register name, the argument
+    could change how the line is parsed, so there is no template and the line gets parsed with the arguments in it.
+    """
+
+    def __init__(self, tree: Tree, text: str, slots: tuple[tuple[int, int, int], ...]):
+        self.slots = {(start, end): index for start, end, index in slots}
+        # id(node) -> (parameter index, whether the text is used) for nodes that stand for an argument
+        self.replace: dict[int, tuple[int, bool]] = {}
+        self.seen: set[int] = set()
+        self._find(tree)
+        del self.seen
+        if {index for index, _ in self.replace.values()} != set(self.slots.values()):
+            raise ValueError("not every parameter is an atom")
+        self.program = _Program(tree, text, self.replace)
+
+    def _inside(self, position: int) -> bool:
+        return any(start <= position < end for start, end in self.slots)
+
+    def _find(self, node):
+        """Records the nodes to replace below `node`."""
+        if isinstance(node, Token):
+            if node.start_pos is not None and self._inside(node.start_pos):
+                raise ValueError(f"parameter used as {node.type}")
+            return
+        if not isinstance(node, Tree) or id(node) in self.seen:
+            return
+        self.seen.add(id(node))
+        meta = node.meta
+        span = (meta.start_pos, meta.end_pos) if not meta.empty else None
+        if node.data.endswith('_raw'):
+            if node.data == 'atom_raw' and span in self.slots:
+                self.replace[id(node)] = self.slots[span], True
+            elif span is not None and any(span[0] < end and start < span[1] for start, end in self.slots):
+                raise ValueError(f"parameter used in {node.data}")
+            return
+        if span in self.slots and '__' in node.data and _syntax_element(node.data).category == 'atom':
+            self.replace[id(node)] = self.slots[span], False
+            return
+        for child in node.children:
+            self._find(child)
+
+
+def reject(cond=True, message: str | Callable[[], str] = None):
+    """
+    Rejects the current alternative if `cond` holds.
+
+    `message` can also be a function producing the message, so that it only has to be formatted if it is needed.
+    """
     if cond:
-        raise RejectionError(message)
+        raise RejectionError(message() if callable(message) else message)
+
+
+@dataclass(frozen=True)
+class Fill:
+    """
+    `size` bytes repeating `pattern`, used as the binary of directives that pad the output. It is only turned into
+    actual bytes when an output format needs them.
+    """
+    pattern: bytes
+    size: int
+
+    def __len__(self):
+        return self.size
+
+    def __bytes__(self):
+        return b"".join(self.chunks())
+
+    def chunks(self, limit: int = None) -> Iterable[bytes]:
+        """The bytes in chunks of at most `limit` (FILL_CHUNK_SIZE by default) bytes."""
+        size = self.size
+        chunk = self.pattern * -(-min(size, limit or FILL_CHUNK_SIZE) // len(self.pattern))
+        while size >= len(chunk) > 0:
+            yield chunk
+            size -= len(chunk)
+        if size > 0:
+            yield chunk[:size]
+
+
+def binary_chunks(data: bytes | Fill) -> Iterable[bytes]:
+    """The bytes of an instruction's binary, in chunks of bounded size if it is a Fill."""
+    return data.chunks() if isinstance(data, Fill) else (data,)
 
 
 class InstructionOutput(NamedTuple):
     start_ip: int
-    binary: bytes
+    binary: bytes | Fill
     raw_line: str
 
 
+# Fills are materialized in chunks of at most this many bytes, and at most this many binaries are joined at once,
+# so that writing an image doesn't need memory proportional to its size
+FILL_CHUNK_SIZE = 1 << 16
+RUN_LENGTH = 1 << 12
+
+
+@dataclass
+class Segment:
+    """A contiguous range of addresses and the output placed there, in address order."""
+    start: int
+    end: int
+    output: list[InstructionOutput]
+
+
 @dataclass()
 class AssemblyResult:
+    """
+    The output of an assembly. The output is kept in the order it was produced in. `segments` arranges it by address,
+    so the image is sparse: gaps between segments take no memory and only get filled when writing a flat image.
+    """
     output: list[InstructionOutput]
     max_address_width: int = 16
     fill_value: bytes = b"\x00"
+    # How many passes over the source it took
+    passes: int = 1
 
-    def output_with_aligns(self, starting_at=None) -> Iterable[InstructionOutput]:
+    @cached_property
+    def segments(self) -> list[Segment]:
+        """The output split into non-overlapping segments, sorted by address."""
+        pieces = []
+        for i in self.output:
+            if pieces and pieces[-1].end == i.start_ip:
+                pieces[-1].output.append(i)
+                pieces[-1].end += len(i.binary)
+            else:
+                pieces.append(Segment(i.start_ip, i.start_ip + len(i.binary), [i]))
+        pieces.sort(key=lambda segment: segment.start)
+        segments = []
+        for piece in pieces:
+            if segments and piece.start <= segments[-1].end:
+                last = segments[-1]
+                if piece.start < last.end and piece.end > piece.start:
+                    raise ValueError(f"Output at 0x{piece.start:x}-0x{piece.end:x} overlaps output at "
+                                     f"0x{last.start:x}-0x{last.end:x}", piece.output[0], last.output[0])
+                last.output.extend(piece.output)
+                last.end = max(last.end, piece.end)
+            else:
+                segments.append(piece)
+        return segments
+
+    def segment_at(self, address: int) -> Segment | None:
+        """The segment containing `address`, if there is one."""
+        segments = self.segments
+        i = bisect_right(segments, address, key=lambda segment: segment.start)
+        if i and address < segments[i - 1].end:
+            return segments[i - 1]
+        return None
+
+    def _start(self, starting_at=None) -> int | None:
+        if not self.segments:
+            return None
+        first = self.segments[0].start
         if starting_at is None:
-            if self.output:
-                ip = self.output[0].start_ip
+            return first
+        if first < starting_at:
+            raise ValueError("Instruction placed before the start of the image", self.segments[0].output[0],
+                             starting_at)
+        return starting_at
+
+    def output_with_aligns(self, starting_at=None) -> Iterable[InstructionOutput]:
+        """All output in address order, with the gaps between segments filled."""
+        ip = self._start(starting_at)
+        for segment in self.segments:
+            if segment.start > ip:
+                yield InstructionOutput(ip, Fill(self.fill_value, segment.start - ip), "")
+            yield from segment.output
+            ip = segment.end
+
+    def size(self, starting_at=None) -> int:
+        start = self._start(starting_at)
+        return 0 if start is None else self.segments[-1].end - start
+
+    def chunks(self, starting_at=None) -> Iterable[tuple[int, bytes | Fill]]:
+        """
+        The contents of the image without the gaps between segments, as offsets into the image together with either
+        joined runs of (at most RUN_LENGTH) binaries or a Fill.
+        """
+        start = self._start(starting_at)
+        for segment in self.segments:
+            offset = segment.start - start
+            run = []
+            for i in segment.output:
+                if isinstance(i.binary, Fill) or len(run) >= RUN_LENGTH:
+                    if run:
+                        data = b"".join(run)
+                        yield offset, data
+                        offset += len(data)
+                        run = []
+                    if isinstance(i.binary, Fill):
+                        yield offset, i.binary
+                        offset += len(i.binary)
+                        continue
+                run.append(i.binary)
+            if run:
+                yield offset, b"".join(run)
+
+    def write_into(self, buffer, starting_at=None) -> int:
+        """
+        Writes the image into `buffer`, which can be anything writable supporting the buffer protocol (e.g. a
+        bytearray, memoryview or mmap) and has to be at least `size()` bytes large. Returns the size of the image.
+        """
+        view = memoryview(buffer).cast('B')
+        end = 0
+
+        def put(data: bytes | Fill):
+            nonlocal end
+            for chunk in binary_chunks(data):
+                view[end:end + len(chunk)] = chunk
+                end += len(chunk)
+
+        for offset, data in self.chunks(starting_at):
+            put(Fill(self.fill_value, offset - end))
+            put(data)
+        # Output without any bytes (like labels) can lie beyond the last bytes
+        size = self.size(starting_at)
+        put(Fill(self.fill_value, size - end))
+        return size
+
+    def write_to(self, file, starting_at=None) -> int:
+        """
+        Writes the image to the binary `file`. If the file is seekable and the fill value is zero, gaps between
+        segments are skipped with a seek, leaving holes in the file on file systems that support them. Otherwise,
+        they are filled. Returns the size of the image.
+        """
+        sparse = not self.fill_value.strip(b"\x00") and file.seekable()
+        end = 0
+        for offset, data in self.chunks(starting_at):
+            if sparse and offset > end:
+                file.seek(offset - end, io.SEEK_CUR)
             else:
-                return
-        else:
-            ip = starting_at
-        for i in self.output:
-            if i.start_ip > ip:
-                yield InstructionOutput(ip, self.fill_value * (i.start_ip - ip), "")
-                ip += (i.start_ip - ip)
-            elif i.start_ip < ip:
-                raise ValueError("Instruction placed before earlier instruction", i, ip)
-            yield i
-            ip += len(i.binary)
+                file.writelines(binary_chunks(Fill(self.fill_value, offset - end)))
+            file.writelines(binary_chunks(data))
+            end = offset + len(data)
+        size = self.size(starting_at)
+        file.writelines(binary_chunks(Fill(self.fill_value, size - end)))
+        return size
 
     def to_bytes(self, starting_at=None) -> bytes:
-        return b"".join(i.binary for i in self.output_with_aligns(starting_at))
+        buffer = bytearray(self.size(starting_at))
+        self.write_into(buffer, starting_at)
+        return bytes(buffer)
+
+
+# Marks macro expansions that depend on their placement in Assembler.macro_cache
+_PLACED = object()
+
+_INCLUDE = re.compile(r'\s*\.include\s+("(?:[^"\\]|\\.)*")\s*(;.*)?')
+
+
+class _Unit(NamedTuple):
+    """
+    What assembling an included file did, see Assembler.include. Symbols are referred to by their full names, so that
+    units can be kept on disk.
+    """
+    # The values of the symbols defined elsewhere that the file read
+    reads: dict[str, int]
+    # Every `set_symbol` as (dots, name, value)
+    definitions: tuple[tuple[int, str, int], ...]
+    macros: dict[str, MacroDefinition]
+    output: list[InstructionOutput]
+    end_ip: int
+    # How many lines the file has, including the files it includes itself
+    lines: int
+
+    def to_json(self) -> dict | None:
+        """The unit as it is kept on disk, or None if it refers to external symbols, which JSON can't keep."""
+        values = [*self.reads.values(), *(value for _, _, value in self.definitions)]
+        if (any(type(value) is not int for value in values)
+                or any(objects.relocations(entry.binary) for entry in self.output)):
+            return None
+        return {
+            "reads": self.reads,
+            "definitions": self.definitions,
+            "macros": [[m.name, m.argc, m.body.split('\n') if m.lines else []] for m in self.macros.values()],
+            "output": [[entry.start_ip, binary_to_json(entry.binary), entry.raw_line] for entry in self.output],
+            "end_ip": self.end_ip,
+            "lines": self.lines,
+        }
+
+    @classmethod
+    def from_json(cls, data: dict) -> _Unit:
+        """Raises ValueError, TypeError, KeyError, IndexError or AttributeError if `data` isn't a unit."""
+        macros = {str(name): MacroDefinition.parse(str(name), int(argc), [str(line) for line in lines])
+                  for name, argc, lines in data["macros"]}
+        output = [InstructionOutput(int(ip), binary_from_json(binary), str(line))
+                  for ip, binary, line in data["output"]]
+        return cls({str(name): int(value) for name, value in data["reads"].items()},
+                   tuple((int(dots), str(name), int(value)) for dots, name, value in data["definitions"]),
+                   macros, output, int(data["end_ip"]), int(data["lines"]))
+
+
+# Parsers only depend on the enabled extensions (in order) and the active modes, so they can be shared between
+# passes and Assembler instances. Switching back to a configuration seen before is then only a dictionary lookup.
+PARSER_CACHE_SIZE = 32
+# How many entries each of the caches an Assembler keeps across resets may hold. A long-lived Assembler (a worker of the
+# server, or one file in --watch) empties those that grew past it when it is reset.
+ASSEMBLER_CACHE_SIZE = 100_000
+_parser_cache: OrderedDict[tuple[tuple[str, ...], frozenset[str]], InstructionParser] = OrderedDict()
 
 
 class Assembler:
-    current_parser: Lark
+    current_parser: InstructionParser
+    # How many syntax function calls a single line may take before it is considered too ambiguous
+    max_alternatives: int = 1000
 
     def __init__(self, verbosity=0, default_modes=None, available_extensions=None, logger: logging.Logger = None):
         self.context = Context()
+        # Parse results only depend on the parser and the line, so they are kept across passes
+        self.parse_cache: dict[tuple[InstructionParser, str, bool], _Program | None] = {}
+        # The index of the alternative that was chosen for a line the last time it was encoded
+        self.winners: dict[tuple[InstructionParser, str], int] = {}
+        # Encoded lines together with the symbol values they read, see handle_line
+        self.line_cache: dict[tuple, tuple[dict[str, int], list[InstructionOutput], int, tuple]] = {}
+        # The same on disk and across runs, if enabled
+        self.line_store: LineCache | None = None
+        # See line_config
+        self.line_configs: dict[tuple, str] = {}
+        # Expanded macros together with the symbol values they read, see macro
+        self.macro_cache: dict[tuple, tuple[dict[str, int], bytes, bool] | object] = {}
+        self.macro_tables: dict[tuple, int] = {}
+        # Parsed macro body lines, keyed like parse_cache, see template
+        self.templates: dict[tuple[InstructionParser, str, bool], _MacroTemplate | None] = {}
+        # Directories searched by `.include` after the one of the including file
+        self.include_paths: list[str] = []
+        # Included files by path, as their text and its hash, read once per assembly
+        self.sources: dict[str, tuple[str, str]] = {}
+        # Assembled included files by fingerprint, see include
+        self.units: dict[str, _Unit] = {}
+        # Counts the lines of the current pass, which identifies them even across included files
+        self.line_index = 0
+        self.including: list[str] = []
+        self.unit_reads: list[dict[int, int | None]] | None = None
         # Maybe these should be different loggers ?
         self.logger = logger or logging.getLogger(__name__)
+        self.reset(verbosity, default_modes, available_extensions)
+
+    def reset(self, verbosity=None, default_modes=None, available_extensions=None, warm: bool = False):
+        """
+        Starts over with a fresh context, e.g. to assemble another file. Parse results are kept, since they don't
+        depend on anything that is reset. By default, the verbosity and available extensions stay the same.
+
+        With `warm`, the next assembly is expected to be of (a new version of) the same file. Everything cached stays
+        valid then, and the symbols start out with their final values of the last assembly, so that lines that
+        didn't change can be reused right from the first pass.
+        """
+        if verbosity is None:
+            verbosity = self.context.verbosity
+        if available_extensions is None:
+            available_extensions = self.context.available_extensions or None
+        symbols = self.context.symbols
+        self.context = Context()
+        if not warm:
+            self.line_cache.clear()
+            self.macro_cache.clear()
+            self.units.clear()
+            self.line_configs.clear()
+        self.trim_caches()
         self.setup_context(True,
                            verbosity=verbosity,
                            default_modes=default_modes,
                            available_extensions=available_extensions)
         core.init(self.context)
+        if warm:
+            # Symbol ids stay the same, which the caches depend on
+            self.context.symbols = symbols
+            self.context.symbol_scopes = [ROOT, symbols.intern(ROOT, '')]
         self.context.modes = default_modes or set()
 
+    def trim_caches(self):
+        """Empties the caches that are kept across resets and hold more than ASSEMBLER_CACHE_SIZE entries."""
+        for entries in (self.parse_cache, self.winners, self.templates, self.line_cache, self.macro_cache, self.units,
+                        self.line_configs):
+            if len(entries) > ASSEMBLER_CACHE_SIZE:
+                entries.clear()
+        if len(self.macro_tables) > ASSEMBLER_CACHE_SIZE:
+            # Their ids are part of the keys of the other caches, which would mix up tables that get the same id
+            self.macro_tables.clear()
+            self.line_cache.clear()
+            self.macro_cache.clear()
+            self.line_configs.clear()
+
     def setup_context(self, full_reset=False, **extras):
         self.context.logger = self.logger
         self.context.reload_extensions = self.reload_extensions
         self.context.macro = self.macro
         if full_reset:
             self.context.output = []
-            self.context.available_extensions = extras.pop('available_extensions', None) or set(potential_extensions)
+            available = extras.pop('available_extensions', None) or extensions.known
+            self.context.available_extensions = available if available is extensions.known else frozenset(available)
             self.context.modes = extras.pop('default_modes', None) or set()
             self.context.known_macros = {}
+            self.context.macro_table = self.macro_table_id()
         for k, v in extras.items():
             setattr(self.context, k, v)
 
@@ -453,13 +1172,29 @@ class Assembler:
             size = 'd'
         self.context.default_size = size
 
+    def macro_table_id(self) -> int:
+        return self.macro_tables.setdefault(tuple(self.context.known_macros.items()), len(self.macro_tables))
+
     def reload_extensions(self):
         self.set_default_size()
+        self.context.state_version += 1
 
-        grammar_builder = GrammarBuilder()
-        grammar_builder.load_grammar(open(Path(__file__).with_name("instruction.lark")).read(), "instruction.lark")
+        key = (tuple(e.strid for e in self.context.enabled_extensions), frozenset(self.context.modes))
+        with profiling.active.phase("reload_extensions"):
+            try:
+                self.current_parser = _parser_cache[key]
+            except KeyError:
+                with profiling.active.phase("build_parser"):
+                    self.current_parser = _parser_cache[key] = self.build_parser()
+                if len(_parser_cache) > PARSER_CACHE_SIZE:
+                    _parser_cache.popitem(last=False)
+            else:
+                _parser_cache.move_to_end(key)
+
+    def build_parser(self) -> InstructionParser:
+        base_grammar = Path(__file__).with_name("instruction.lark").read_text()
         existing_syntax_elements = {"instruction"}
-        full_grammar = ""
+        pieces = []
         for extension in self.context.enabled_extensions:
             extension: Extension
             for required_modes, syntax in extension.syntax_elements.items():
@@ -473,101 +1208,472 @@ class Assembler:
                         grammar = f"{s.category}: ({s.grammar}) -> {alias}"
                         grammar += f"\n{s.category}_raw: {s.category}"
                         existing_syntax_elements.add(s.category)
-                    full_grammar += grammar + "\n"
-                    grammar_builder.load_grammar(grammar, alias)
+                    pieces.append((s.category, alias, grammar))
 
         if self.context.verbosity >= 5:
-            self.logger.debug(full_grammar)
-        try:
-            grammar = grammar_builder.build()
-        except GrammarError as e:
-            raise e
-        # Maybe lexer=dynamic_complete is worth it, although it might mean a massive reduction in performance
-        self.current_parser = Lark(grammar, parser='earley', lexer='dynamic', ambiguity="explicit",
-                                   start="instruction", propagate_positions=True)
-
-    def handle_instruction(self, line: str):
+            self.logger.debug("".join(grammar + "\n" for _, _, grammar in pieces))
+        return InstructionParser(base_grammar, pieces)
+
+    def handle_instruction(self, line: str, program: _Program | None = None, arguments: MacroInvocation = None):
+        """
+        Assembles a single instruction. `program` is a compiled tree for `line` that was built elsewhere, such as a
+        macro template with `arguments` filled in.
+        """
         if self.context.verbosity >= 3:
             self.logger.debug(f"Enabled extensions: {self.context.enabled_extensions}")
             self.logger.debug(f"Active modes: {self.context.modes}")
         if self.context.verbosity >= 4:
             self.logger.debug(pformat(self.context))
-        tree = self.current_parser.parse(line)
+        if program is None:
+            program = self.parse(line)
+            if program is None:
+                return
+        alternatives = program.alternatives
+        key = (self.current_parser, line)
+        # The alternative that won last time is tried first, since it usually wins again. That often makes it
+        # possible to skip the others: an alternative can only win if it can produce something shorter (or
+        # equally long but earlier in the grammar).
+        order = list(range(len(alternatives)))
+        winner = self.winners.get(key)
+        if winner is not None and winner < len(order):
+            order.remove(winner)
+            order.insert(0, winner)
+        compiler = _CompileInstruction(self.context, line, self.max_alternatives, arguments)
+        best = None
+        with profiling.active.phase("collapse"):
+            for position, i in enumerate(order):
+                for result in compiler.values(alternatives[i]):
+                    size = 0 if result is None else len(result)
+                    if best is None or (size, i) < best[:2]:
+                        best = size, i, result
+                if best is not None and all((program.min_sizes[j], j) > best[:2] for j in order[position + 1:]):
+                    break
+        if best is None:
+            raise UnknownInstruction(line, compiler.rejections)
+        _, self.winners[key], result = best
+        if result is not None:
+            self.context.output.append(InstructionOutput(self.context.full_ip, result, line))
+            self.context.advance(len(result))
+
+    def parse(self, line: str) -> _Program | None:
+        """
+        The (possibly ambiguous) parse tree of `line` compiled for evaluation, or None if it doesn't contain an
+        instruction.
+        """
+        parser = self.current_parser
+        key = (parser, line, parser.invokes_macro(line, self.context.known_macros))
+        try:
+            return self.parse_cache[key]
+        except KeyError:
+            pass
+        with profiling.active.phase("parse"):
+            tree = parser.parse(line, self.context.known_macros)
         if self.context.verbosity >= 4:
             self.logger.debug(f"Tree: \n{tree.pretty()}")
         if tree.data == "no_instruction":
-            return
-        options = CollapseAmbiguities().transform(tree)
-        results = []
-        rejections = []
-        for option in options:
-            try:
-                result = _CompileInstruction(self.context, line).transform(option)
-            except RejectionError as e:
-                rejections.append(e)
-                continue
-            except VisitError as e:
-                raise e.orig_exc from None
-            else:
-                results.append(result)
-        if not results:
-            raise UnknownInstruction(line, rejections)
-        if len(results) > 1:
-            #  TODO: Maybe raise errors on later passes if this isn't resolved?
-            #        OTOH if these ambiguities are actually correct, it shouldn't hurt
-            #        Maybe each option should be required to return some kind of cost factor?
-            result = min(results, key=len)
-            # raise NotImplementedError("Prioritization is not implemented", results)
+            program = None
         else:
-            result, = results
-        if result is not None:
-            self.context.output.append(InstructionOutput(self.context.full_ip, result, line))
-            self.context.ip += len(result)
-
-    def macro(self, instructions: str):
-        old_output, old_ip = self.context.output, self.context.ip
-        self.context.output = new_output = []
+            with profiling.active.phase("compile"):
+                program = _Program(tree, line)
+        self.parse_cache[key] = program
+        return program
+
+    def macro(self, instructions: str, invocation: MacroInvocation | None = None) -> bytes:
+        """
+        Assembles `instructions` in place of the current instruction and returns the bytes. If they are the expansion
+        of a user macro, `invocation` allows using its pre-parsed body.
+
+        Expansions are reused like lines are in handle_line, as long as the symbols they read still have the same
+        values. Most of them don't depend on where they are placed, and are shared between all their occurrences.
+        """
+        context = self.context
+        key = (instructions, self.current_parser, context.macro_table, context.symbol_scopes[-1],
+               context.relax_register)
+        cached = self.macro_cache.get(key)
+        if cached is _PLACED:
+            cached = self.macro_cache.get((*key, context.full_ip))
+        if cached is not None:
+            reads, result, placed = cached
+            values = context.symbols.values
+            if all(values[symbol] == value for symbol, value in reads.items()):
+                if context.symbol_reads is not None:
+                    context.symbol_reads.update(reads)
+                if placed:
+                    # Whatever this expansion is part of depends on the placement as well
+                    context.ip_reads += 1
+                return result
+
+        old_output, old_ip, old_reads = context.output, context.full_ip, context.symbol_reads
+        version, ip_reads = context.state_version, context.ip_reads
+        branches = context.branches
+        sites = branches and (len(branches.line_sites), len(branches.line_anchors))
+        context.output = new_output = []
+        context.symbol_reads = reads = {}
+        try:
+            with profiling.active.phase("macro"):
+                if invocation is None:
+                    for line in instructions.splitlines(False):
+                        self.handle_instruction(line)
+                else:
+                    self.expand(invocation, instructions)
+        finally:
+            context.output, context.full_ip, context.symbol_reads = old_output, old_ip, old_reads
+            if old_reads is not None:
+                old_reads.update(reads)
+        result = objects.join(o.binary for o in new_output)
+
+        if (context.state_version == version and None not in reads.values()
+                and sites == (branches and (len(branches.line_sites), len(branches.line_anchors)))):
+            placed = context.ip_reads != ip_reads
+            if placed:
+                self.macro_cache[key] = _PLACED
+                key = (*key, old_ip)
+            self.macro_cache[key] = reads, result, placed
+        return result
+
+    def expand(self, invocation: MacroInvocation, instructions: str):
+        """
+        Assembles the body of a user macro, whose expansion is `instructions`. Body lines are parsed and compiled once
+        per configuration with placeholders for the parameters, which then evaluate to the arguments.
+        """
+        # Arguments can't contain line breaks, so the lines of the expansion are the expanded lines of the body
+        for number, (line, text) in enumerate(zip(invocation.macro.lines, instructions.split('\n'))):
+            template = self.template(line) if invocation.nodes is not None else None
+            try:
+                if template is None:
+                    self.handle_instruction(text)
+                else:
+                    self.handle_instruction(text, template.program, invocation)
+            except (UnexpectedInput, UnknownInstruction, TooManyAlternatives, MacroError) as e:
+                raise MacroError(invocation.macro.name, number, text, invocation.line, e) from e
+
+    def template(self, line: MacroLine) -> _MacroTemplate | None:
+        """The template of a macro body line for the current configuration, None if it has to be parsed as text."""
+        if line.template is None:
+            return None
+        parser = self.current_parser
+        key = (parser, line.template, parser.invokes_macro(line.template, self.context.known_macros))
         try:
-            for line in instructions.splitlines(False):
+            return self.templates[key]
+        except KeyError:
+            pass
+        try:
+            program = self.parse(line.template)
+            template = None if program is None else _MacroTemplate(program.tree, line.template, line.slots)
+        except (UnexpectedInput, ValueError):
+            template = None
+        self.templates[key] = template
+        return template
+
+    def line_config(self) -> str:
+        """
+        Everything the encoding of a line depends on apart from its text, the symbols it reads and where it is placed,
+        as a fingerprint that stays the same between runs: the code of etc_as and of the enabled extensions, the
+        configuration of the parser, the known macros, the current symbol scope, the relax register and the address
+        size.
+        """
+        context = self.context
+        key = (self.current_parser, context.macro_table, context.symbol_scopes[-1], context.relax_register,
+               context.ip_mask)
+        try:
+            return self.line_configs[key]
+        except KeyError:
+            pass
+        symbols = context.symbols
+        # The code of the assembler and of the extensions from elsewhere, which the encoding depends on as well
+        code = [cache.source_fingerprint(__package__)]
+        for e in context.enabled_extensions:
+            info = extensions.find(e.strid)
+            if info is not None and e.strid not in extensions.BUILTIN_EXTENSIONS:
+                code.append(cache.source_fingerprint(info.module))
+        config = self.line_configs[key] = cache.fingerprint(
+            code, [e.strid for e in context.enabled_extensions], sorted(context.modes),
+            [(m.name, m.argc, m.body) for m in context.known_macros.values()],
+            [symbols.names[scope] for scope in context.symbol_scopes[1:]], context.relax_register, context.ip_mask)
+        return config
+
+    def handle_line(self, line: str, number: int = 0, index: int = None):
+        """
+        Handles a top level source line, reusing the output of an earlier evaluation where possible. `number` is the
+        number of the line in its file, and `index` counts all lines of the pass (by default, `number`).
+
+        Apart from the symbols it reads, a line only depends on where it is placed, the active configuration,
+        the current symbol scope, the known macros and whether its branches have been relaxed. Lines that change state
+        others depend on (defining symbols, switching modes or extensions) or that read undefined symbols are always
+        evaluated again.
+        """
+        context = self.context
+        key = (line, context.full_ip, self.current_parser, context.symbol_scopes[-1], context.macro_table,
+               context.relax_register)
+        if index is None:
+            index = number
+        cached = self.line_cache.get(key)
+        if cached is not None:
+            reads, outputs, end_ip, sites = cached
+            values = context.symbols.values
+            if (all(values[symbol] == value for symbol, value in reads.items())
+                    and context.branches.replay(sites, index, context.ip)):
+                context.output.extend(outputs)
+                context.full_ip = end_ip
+                if self.unit_reads is not None:
+                    self.unit_reads.append(reads)
+                return
+        start_ip = context.full_ip
+        disk_key = None
+        if self.line_store is not None:
+            disk_key = self.line_store.key(self.line_config(), line)
+            with profiling.active.phase("line_store"):
+                variant = self.line_store.lookup(disk_key, context.symbols, start_ip)
+            if variant is not None:
+                self.replay_variant(key, variant)
+                return
+        context.branches.start_line(index, context.ip)
+        version, ip_reads = context.state_version, context.ip_reads
+        start = len(context.output)
+        context.symbol_reads = reads = {}
+        try:
+            with profiling.active.line(number, line):
                 self.handle_instruction(line)
         finally:
-            self.context.output, self.context.ip = old_output, old_ip
-        return b''.join(o.binary for o in new_output)
-
-    def single_pass(self, full_text: str):
+            context.symbol_reads = None
+            if self.unit_reads is not None:
+                self.unit_reads.append(reads)
+        if context.external_symbols and not context.external_symbols.isdisjoint(reads):
+            self._check_relocated(reads, context.output[start:])
+        elif context.state_version == version and None not in reads.values():
+            sites = context.branches.line_state()
+            self.line_cache[key] = reads, context.output[start:], context.full_ip, sites
+            if disk_key is not None and sites == ((), ()):
+                full_name = context.symbols.full_name
+                self.line_store.add(disk_key, Variant(
+                    tuple((full_name(symbol), value) for symbol, value in reads.items()),
+                    start_ip if context.ip_reads != ip_reads else None,
+                    tuple((o.start_ip - start_ip, o.binary, o.raw_line) for o in context.output[start:]),
+                    context.full_ip - start_ip))
+
+    def replay_variant(self, key: tuple, variant: Variant):
+        """Repeats a line found in the line store, and keeps it in the line cache under `key` for later passes."""
+        context = self.context
+        start_ip = context.full_ip
+        reads = {context.symbols.lookup(name): value for name, value in variant.reads}
+        outputs = [InstructionOutput(start_ip + offset, binary, text) for offset, binary, text in variant.output]
+        context.output.extend(outputs)
+        context.ip = start_ip + variant.size
+        if self.unit_reads is not None:
+            self.unit_reads.append(reads)
+        self.line_cache[key] = reads, outputs, context.full_ip, ((), ())
+
+    def _check_relocated(self, reads: dict[int, int | None], output: list[InstructionOutput]):
+        """Makes sure that every external symbol read by a line has a relocation in its output."""
+        relocated = {r.symbol for o in output for r in objects.relocations(o.binary)}
+        for symbol in self.context.external_symbols.intersection(reads):
+            name = self.context.symbols.full_name(symbol)
+            if name not in relocated:
+                raise ValueError(f"Can't refer to the external symbol {name} here: only near jumps and calls and "
+                                 f"data words that are just a symbol can be relocated")
+
+    def single_pass(self, full_text: str, path: str = None):
+        self.line_index = 0
+        self.including = []
+        self.assemble_text(full_text, path)
+
+    def assemble_text(self, full_text: str, path: str = None):
+        """Assembles the lines of `full_text`, which is the contents of the file `path` if it is known."""
         in_macro = False
         macro = None
-        for line in full_text.splitlines(False):
+        for number, line in enumerate(full_text.splitlines(False)):
             if self.context.verbosity >= 2:
                 self.logger.debug(f"Starting with line: {line!r}")
+            if not in_macro and line.lstrip().startswith('.include'):
+                match = _INCLUDE.fullmatch(line)
+                if match is None:
+                    raise ValueError(f"Invalid include, expected .include \"PATH\": {line.strip()}")
+                self.include(literal_eval(match[1]), path)
+                continue
             if not in_macro and line.lstrip().startswith('.macro'):
                 in_macro = True
                 _, name, param_count = line.split()
                 macro = (name, int(param_count), [])
             elif in_macro and line.lstrip().startswith(".endmacro"):
                 in_macro = False
-                self.context.known_macros[macro[0]] = (macro[1], '\n'.join(macro[2]))
+                self.context.known_macros[macro[0]] = MacroDefinition.parse(*macro)
+                self.context.macro_table = self.macro_table_id()
             elif in_macro:
                 macro[2].append(line)
             else:
-                self.handle_instruction(line)
+                self.handle_line(line, number, self.line_index)
+            self.line_index += 1
             if self.context.verbosity >= 2:
                 self.logger.debug(f"Done with line    : {line!r}")
 
-    def n_pass(self, full_text) -> AssemblyResult:
-        start_context = copy.deepcopy(self.context)
-        self.single_pass(full_text)
-        while self.context.missing_symbols or self.context.changed_symbols:
-            old = self.context.missing_symbols, self.context.changed_symbols
-            old_symbols = self.context.symbols.copy()
-            self.context = copy.deepcopy(start_context)
-            self.setup_context(False, symbols=old_symbols, illegal_symbols=old[0].difference(old_symbols))
+    def find_include(self, name: str, including: str | None) -> str:
+        """The path of the file `.include "name"` refers to in the file `including`."""
+        directory = os.path.dirname(including) if including is not None else ''
+        for candidate in (os.path.join(directory, name), *(os.path.join(d, name) for d in self.include_paths)):
+            if os.path.isfile(candidate):
+                return os.path.normpath(candidate)
+        raise FileNotFoundError(f"Included file {name} not found in {[directory or '.', *self.include_paths]}")
+
+    def include(self, name: str, including: str | None):
+        """
+        Assembles the file included as `name` by the file `including`.
+
+        What it did is kept as a `_Unit` in memory and on disk, keyed by a hash of its contents, where it is placed and
+        everything else it depends on apart from symbol values, see `line_config`. The values of the symbols it reads
+        are checked when it is reused. Files that do anything but define symbols and macros and produce output (or that
+        have branches that could be relaxed, or read undefined symbols) are always assembled again. Units are written
+        to disk as JSON, like the entries of the line cache, so that reading one can't run any code.
+        """
+        path = self.find_include(name, including)
+        if path in self.including:
+            raise ValueError(f"{path} includes itself")
+        if path not in self.sources:
+            with open(path, encoding="utf-8") as f:
+                text = f.read()
+            self.sources[path] = text, hashlib.sha256(text.encode("utf-8")).hexdigest()
+        text, digest = self.sources[path]
+        context = self.context
+        symbols = context.symbols
+        key = cache.fingerprint(digest, self.line_config(), context.full_ip)
+        unit = self.units.get(key)
+        if unit is None:
+            with profiling.active.phase("load_include"):
+                data = cache.load_json("includes", key)
+            if data is not None:
+                try:
+                    unit = self.units[key] = _Unit.from_json(data)
+                except (ValueError, TypeError, KeyError, IndexError, AttributeError):
+                    unit = None
+        if unit is not None and self.replay(unit):
+            return
+
+        before = {name: copy.copy(value) for name, value in vars(context).items()
+                  if name not in _SHARED_CONTEXT_FIELDS and name not in _UNIT_RESULT_FIELDS}
+        macros = dict(context.known_macros)
+        outer_reads, outer_log = self.unit_reads, context.symbol_log
+        self.unit_reads = reads = []
+        context.symbol_log = log = []
+        start, start_ip, first_line = len(context.output), context.full_ip, self.line_index
+        sites = len(context.branches.sites), len(context.branches.anchors)
+        previous_file = profiling.active.file if profiling.active is not profiling.DISABLED else None
+        self.including.append(path)
+        try:
+            if profiling.active is not profiling.DISABLED:
+                profiling.active.file = path
+            self.assemble_text(text, path)
+        finally:
+            self.including.pop()
+            if profiling.active is not profiling.DISABLED:
+                profiling.active.file = previous_file
+            self.unit_reads, context.symbol_log = outer_reads, outer_log
+            if outer_reads is not None:
+                outer_reads.extend(reads)
+            if outer_log is not None:
+                outer_log.extend(log)
+
+        if sites != (len(context.branches.sites), len(context.branches.anchors)):
+            return
+        if any(vars(context).get(name) != value for name, value in before.items()):
+            return
+        defined = {symbol for _, _, _, symbol in log}
+        read = {}
+        for line_reads in reads:
+            for symbol, value in line_reads.items():
+                if value is None or (symbol in defined and value != symbols.values[symbol]):
+                    return
+                if symbol not in defined:
+                    read[symbols.full_name(symbol)] = value
+        unit = _Unit(read, tuple(entry[:3] for entry in log),
+                     {name: m for name, m in context.known_macros.items() if macros.get(name) is not m},
+                     context.output[start:], context.full_ip, self.line_index - first_line)
+        if self.units.get(key) != unit:
+            self.units[key] = unit
+            data = unit.to_json()
+            if data is not None:
+                cache.store_json("includes", key, data)
+
+    def replay(self, unit: _Unit) -> bool:
+        """Repeats what an included file did, if the symbols it read still have the same values."""
+        context = self.context
+        symbols = context.symbols
+        reads = {symbols.lookup(name): value for name, value in unit.reads.items()}
+        if any(symbols.values[symbol] != value for symbol, value in reads.items()):
+            return False
+        if self.unit_reads is not None:
+            self.unit_reads.append(reads)
+        context.output.extend(unit.output)
+        for dots, name, value in unit.definitions:
+            set_symbol(context, (dots, name), value)
+        if unit.macros:
+            context.known_macros.update(unit.macros)
+            context.macro_table = self.macro_table_id()
+        context.full_ip = unit.end_ip
+        self.line_index += unit.lines
+        return True
+
+    def _settle(self, branches: BranchSites) -> bool:
+        with profiling.active.phase("settle"):
+            return branches.settle(self.context.symbols)
+
+    def _forget_stale(self) -> bool:
+        """
+        Forgets the values of symbols the last pass didn't define, which only a warm start (see `reset`) can have.
+        Lines that read them have to see them as undefined in the next pass. Returns whether there were any.
+        """
+        values, defined = self.context.symbols.values, self.context.defined_symbols
+        stale = [symbol for symbol, value in enumerate(values) if value is not None and symbol not in defined]
+        for symbol in stale:
+            values[symbol] = None
+        return bool(stale)
+
+    def n_pass(self, full_text, relocatable: bool = False, path: str = None) -> AssemblyResult:
+        """
+        Assembles `full_text`, repeating passes until all symbols are resolved and nothing changes anymore. With
+        `relocatable`, symbols that are still undefined after a pass become external, see etc_as.objects. `path` is
+        the file `full_text` comes from, which `.include` looks for files relative to.
+        """
+        start = self.context.snapshot()
+        self.context.external_symbols = set() if relocatable else None
+        self.sources = {}
+        if self.line_store is not None:
+            self.line_store.start()
+        branches = self.context.branches = BranchSites()
+        with profiling.active.phase("pass", number=1):
+            self.single_pass(full_text, path)
+        passes = 1
+        while (self._settle(branches) or self.context.missing_symbols or self.context.changed_symbols
+               or self._forget_stale()):
+            old = self.context.missing_symbols, self.context.changed_symbols, len(branches.long)
+            values = self.context.symbols.values
+            undefined = {symbol for symbol in old[0] if values[symbol] is None}
+            if relocatable:
+                self.context.external_symbols |= undefined
+                undefined = set()
+            self.context.restore(start)
+            self.setup_context(False, illegal_symbols=undefined)
             self.reload_extensions()
-            self.single_pass(full_text)
-            if old == (self.context.missing_symbols, self.context.changed_symbols):
-                raise ValueError(
-                    f"Stuck without further progress, still missing symbols {self.context.missing_symbols}")
-        return AssemblyResult(self.context.output, self.context.ip_mask.bit_count())
+            branches.start_pass()
+            passes += 1
+            with profiling.active.phase("pass", number=passes):
+                self.single_pass(full_text, path)
+            if old == (self.context.missing_symbols, self.context.changed_symbols, len(branches.long)):
+                missing = {self.context.symbols.full_name(symbol) for symbol in self.context.missing_symbols}
+                raise ValueError(f"Stuck without further progress, still missing symbols {missing}")
+        if self.line_store is not None:
+            with profiling.active.phase("line_store"):
+                self.line_store.flush(self.context.symbols)
+        return AssemblyResult(self.context.output, self.context.ip_mask.bit_count(), passes=passes)
+
+    def exported_symbols(self) -> dict[str, int]:
+        """The symbols exported with `.global` by the last assembly, and their values."""
+        symbols = self.context.symbols
+        exported = {}
+        for symbol in sorted(self.context.exported_symbols):
+            name = symbols.full_name(symbol)
+            if symbols.values[symbol] is None:
+                raise ValueError(f"Exported symbol {name} is not defined")
+            exported[name] = symbols.values[symbol]
+        return exported
 
 
 def resolve_register_size(context, *sizes: str | None):
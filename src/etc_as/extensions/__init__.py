@@ -1,7 +1,114 @@
+"""
+The extensions etc-as knows about, and the modules defining them.
+
+Their metadata is known without importing them, so that an extension's module is only imported once it is enabled.
+Other packages can provide extensions through the `etc_as.extensions` entry point group. Each entry point has to refer
+to an `ExtensionInfo` (which should be defined somewhere that is cheap to import), whose `module` creates the
+`etc_as.core.Extension` with the same strid when imported. Entry points are only looked at once a name isn't built in,
+so extensions provided by them can't be on by default.
+"""
+from __future__ import annotations
+
+import importlib
 import pkgutil
+from collections.abc import Set
+from typing import NamedTuple
+
+ENTRY_POINT_GROUP = "etc_as.extensions"
+
+
+class ExtensionInfo(NamedTuple):
+    cpuid: int | None
+    strid: str
+    name: str
+    default_on: bool
+    module: str
+
+
+# In the order they used to be imported in, which is the order default extensions are enabled in
+BUILTIN_EXTENSIONS = {info.strid: info for info in [
+    ExtensionInfo(None, "core", "Core Assembly", True, "etc_as.core"),
+    ExtensionInfo(None, "base", "Base Instruction Set", True, "etc_as.base_isa"),
+    ExtensionInfo(None, "common_macros", "Common Macros", True, "etc_as.common_macros"),
+    ExtensionInfo(3, "byte_operations", "Byte Operations", False, f"{__name__}.byte_operations"),
+    ExtensionInfo(14, "dword_operations", "Double Word Operations", False, f"{__name__}.dword_operations"),
+    ExtensionInfo(16, "real32", "32 Bit Address Space", False, f"{__name__}.dword_pointers"),
+    ExtensionInfo(15, "qword_operations", "Quad Word Operations", False, f"{__name__}.qword_operations"),
+    ExtensionInfo(1, "functions", "Stack and Functions", False, f"{__name__}.stack_and_functions"),
+]}
+
+_registry: dict[str, ExtensionInfo] | None = None
+
+
+def registry() -> dict[str, ExtensionInfo]:
+    """The metadata of every known extension by strid, the built-in ones first."""
+    global _registry
+    if _registry is None:
+        # importlib.metadata alone takes longer to import than all built-in extensions
+        from importlib.metadata import entry_points
+        _registry = dict(BUILTIN_EXTENSIONS)
+        for entry_point in entry_points(group=ENTRY_POINT_GROUP):
+            info = entry_point.load()
+            if not isinstance(info, ExtensionInfo):
+                raise TypeError(f"entry point {entry_point.name!r} of {ENTRY_POINT_GROUP} doesn't refer to an "
+                                f"ExtensionInfo: {info!r}")
+            if info.default_on:
+                raise ValueError(f"extension {info.strid!r} of entry point {entry_point.name!r} can't be on by default")
+            _registry.setdefault(info.strid, info)
+    return _registry
+
+
+def find(strid: str) -> ExtensionInfo | None:
+    return BUILTIN_EXTENSIONS.get(strid) or registry().get(strid)
+
+
+def load(strid: str):
+    """Imports the module of the extension `strid` if needed and returns the `etc_as.core.Extension`."""
+    from etc_as.core import potential_extensions
+    try:
+        return potential_extensions[strid]
+    except KeyError:
+        pass
+    info = find(strid)
+    if info is None:
+        raise KeyError(strid)
+    importlib.import_module(info.module)
+    extension = potential_extensions[strid]
+    assert (extension.cpuid, extension.strid, extension.name, extension.default_on) == info[:4], \
+        f"the metadata of {strid!r} doesn't match its extension: {info}"
+    return extension
+
+
+class _Known(Set):
+    """
+    Every known extension, including the ones that were created without being registered. Entry points are only
+    looked at when something that isn't built in is looked up, or when listing all of them.
+    """
+
+    def __contains__(self, strid) -> bool:
+        from etc_as.core import potential_extensions
+        return strid in BUILTIN_EXTENSIONS or strid in potential_extensions or find(strid) is not None
+
+    def __iter__(self):
+        from etc_as.core import potential_extensions
+        return iter({**registry(), **potential_extensions})
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __bool__(self):
+        return True
+
+    def __repr__(self):
+        return "<all known extensions>"
+
+
+known = _Known()
 
 
 def import_all_extensions():
-    import etc_as.base_isa
+    for strid in registry():
+        load(strid)
+    # Modules that aren't listed above still get imported, but aren't known before that
     for args in pkgutil.iter_modules(__path__):
-        __import__(f'{__name__}.{args.name}')
+        importlib.import_module(f'{__name__}.{args.name}')
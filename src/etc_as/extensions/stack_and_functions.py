@@ -1,9 +1,14 @@
 from etc_as.core import Extension, reject, oneof
-from etc_as.base_isa import CONDITION_NAMES, validate_registers, build
+from etc_as.base_isa import CONDITION_NAMES, validate_registers, Layout, REG_REG, REG_IMM
+from etc_as import objects
+from etc_as.relax import external_branch, relaxed_branch
 
 functions = Extension(1, "functions", "Stack and Functions")
 Register = tuple[int | None, int]
 
+REG_JUMP = Layout(8, 3, 1, 4, table=True)
+NEAR_CALL = Layout(4, 12)
+
 REGISTERS = {
     "a0": 0,
     "a1": 1,
@@ -25,59 +30,64 @@ def fn_ptr_registers(cxt, name, size):
 @functions.reg(fr'/(a|v|s)/ size_infix /(?!<\s)[0-2]/', prefix=False)
 def fn_gp_registers(cxt, pref, size, suff):
     name = pref + suff
-    reject(not name in REGISTERS.keys(), f"Unknown register name `{name}'")
+    reject(not name in REGISTERS.keys(), lambda: f"Unknown register name `{name}'")
     return size, REGISTERS[name]
 
-@functions.inst(f'"pop" size_postfix register')
+@functions.inst(f'"pop" size_postfix register', min_size=2)
 def pop_inst(cxt, inst_size, reg: Register):
     size, (dst,) = validate_registers(cxt, reg, inst_size=inst_size)
-    return build((0b00,2), (cxt.register_sizes[size],2), (0xC,4), (dst,3), (6,3), (0b00,2))
+    return REG_REG.encode(0b00, cxt.register_sizes[size], 0xC, dst, 6, 0b00)
 
-@functions.inst(f'"push" size_postfix register')
+@functions.inst(f'"push" size_postfix register', min_size=2)
 def push_register_inst(cxt, inst_size, reg: Register):
     size, (src,) = validate_registers(cxt, reg, inst_size=inst_size)
-    return build((0b00,2), (cxt.register_sizes[size],2), (0xD,4), (6,3), (src,3), (0b00,2))
+    return REG_REG.encode(0b00, cxt.register_sizes[size], 0xD, 6, src, 0b00)
 
-@functions.inst(f'"push" size_postfix immediate')
+@functions.inst(f'"push" size_postfix immediate', min_size=2)
 def push_register_imm(cxt, inst_size, imm: int):
     size, () = validate_registers(cxt, inst_size=inst_size)
     reject(
         not isinstance(imm, int) or not (0 <= imm < 32),
-        f"Invalidate immediate {imm} for op `push'"
+        lambda: f"Invalidate immediate {imm} for op `push'"
     )
-    return build((0b01,2), (cxt.register_sizes[size],2), (0xD,4), (6,3), (imm,5))
+    return REG_IMM.encode(0b01, cxt.register_sizes[size], 0xD, 6, imm)
 
-@functions.inst(f'/j{oneof(*CONDITION_NAMES, exclude=("",))}/ register')
+@functions.inst(f'/j{oneof(*CONDITION_NAMES, exclude=("",))}/ register', min_size=2)
 def cond_abs_reg_jump(cxt, inst: str, reg: Register):
     _,(src,) = validate_registers(cxt, reg)
     cc = inst.removeprefix('j')
     op = CONDITION_NAMES[cc]
-    return build((0xAF,8), (src,3), (0b0,1), (op,4))
+    return REG_JUMP.encode(0xAF, src, 0b0, op)
 
-@functions.inst(f'/ret{oneof(*CONDITION_NAMES, exclude=("mp",))}/')
+@functions.inst(f'/ret{oneof(*CONDITION_NAMES, exclude=("mp",))}/', min_size=2)
 def cond_return(cxt, inst: str):
     cc = inst.removeprefix('ret')
     op = CONDITION_NAMES[cc]
-    return build((0xAF,8), (0b111,3), (0b0,1), (op,4))
+    return REG_JUMP.encode(0xAF, 0b111, 0b0, op)
 
-@functions.inst(f'/call{oneof(*CONDITION_NAMES, exclude=("mp",))}/ register')
+@functions.inst(f'/call{oneof(*CONDITION_NAMES, exclude=("mp",))}/ register', min_size=2)
 def cond_abs_reg_call(cxt, inst: str, reg: Register):
     _,(src,) = validate_registers(cxt, reg)
     cc = inst.removeprefix('call')
     op = CONDITION_NAMES[cc]
-    return build((0xAF,8), (src,3), (0b1,1), (op,4))
+    return REG_JUMP.encode(0xAF, src, 0b1, op)
 
-@functions.inst('"call" symbol')
+@functions.inst('"call" symbol', min_size=2)
 def rel_near_imm_call(cxt, lbl: tuple[int, str]):
-    target = cxt.resolve_symbol(lbl)
+    resolved = target = cxt.resolve_symbol(lbl)
     if target is None:
         target = cxt.ip
+    if cxt.is_external(lbl):
+        return external_branch(cxt, lbl, objects.NEAR_CALL, NEAR_CALL.encode(0xB, 0), "call {}")
     offset = target - cxt.ip
     bottom_mask = 0xfff
+    if cxt.relax_register is not None:
+        return relaxed_branch(cxt, "call", cxt.symbol_id(lbl), resolved, range(-2048, 2048),
+                              lambda: NEAR_CALL.encode(0xB, bottom_mask & offset), "call {}")
     reject(
         offset < -2048 or offset > 2047,
-        f"""Cannot encode near call:
+        lambda: f"""Cannot encode near call:
     from `call {cxt.symbol_short_name(lbl)}'     at 0x{cxt.ip:04x}
     to   `{cxt.symbol_full_name(lbl)}' resolved to 0x{target:04x}"""
     )
-    return build((0xB,4), (bottom_mask & offset, 12))
+    return NEAR_CALL.encode(0xB, bottom_mask & offset)
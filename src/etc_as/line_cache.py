@@ -0,0 +1,151 @@
+"""
+Persistent line cache.
+
+With `etc-as --line-cache`, encoded lines are kept on disk and reused by later runs, in the spirit of ccache. Entries
+live in the `lines` namespace of etc_as.cache. The key of a line is a hash of its text and everything it depends on
+besides symbol values: the code of etc_as and its extensions, the enabled extensions, modes, known macros, current
+symbol scope, relax register and address size. Since the symbols a line reads are only known once it has been encoded,
+an entry holds up to MAX_VARIANTS `Variant`s, each with the values of the symbols it read (and the ip, for lines that
+depend on where they are placed). A variant is only used if they all still match.
+
+Entries are written once an assembly succeeded, and only for lines whose symbols ended up with the values they read.
+They are JSON, so that reading an entry written by someone else can't run code, and an entry that can't be decoded is a
+miss. Every write is atomic, so concurrent builds sharing the cache at worst lose each other's variants. After writing,
+one of the 16 subdirectories is cleaned up, oldest entries first, until it fits into its share of the size limit.
+Entries are touched when they are used, so those still in use stay.
+"""
+from __future__ import annotations
+
+import random
+import sys
+from typing import NamedTuple, TYPE_CHECKING
+
+from etc_as import cache, objects
+
+if TYPE_CHECKING:
+    from etc_as.core import Fill
+    from etc_as.symbols import SymbolTable
+
+NAMESPACE = "lines"
+DEFAULT_MAX_SIZE = 100 * 2**20
+MAX_VARIANTS = 8
+# How many entries read from disk are kept in memory, by a long-lived process like --watch
+MAX_LOADED = 100_000
+_SUBDIRECTORIES = "0123456789abcdef"
+
+
+class Variant(NamedTuple):
+    # The symbols the line read by their full names, and their values
+    reads: tuple[tuple[str, int], ...]
+    # Where the line was placed, None if it doesn't depend on it
+    ip: int | None
+    # The output as (offset from the start of the line, binary, line)
+    output: tuple[tuple[int, bytes | Fill, str], ...]
+    # How far the line moves the ip
+    size: int
+
+    def to_json(self) -> dict:
+        return {
+            "reads": self.reads,
+            "ip": self.ip,
+            "output": [[offset, binary_to_json(binary), line] for offset, binary, line in self.output],
+            "size": self.size,
+        }
+
+    @classmethod
+    def from_json(cls, data: dict) -> Variant:
+        """Raises ValueError, TypeError or KeyError if `data` isn't a variant."""
+        output = tuple((int(offset), binary_from_json(binary), str(line)) for offset, binary, line in data["output"])
+        ip = data["ip"]
+        return cls(tuple((str(name), int(value)) for name, value in data["reads"]), None if ip is None else int(ip),
+                   output, int(data["size"]))
+
+
+def binary_to_json(binary: bytes | Fill) -> str | list:
+    """A binary in hex, or a pad as [pattern in hex, size]. Relocations are lost."""
+    from etc_as.core import Fill
+    return [binary.pattern.hex(), binary.size] if isinstance(binary, Fill) else binary.hex()
+
+
+def binary_from_json(data: str | list) -> bytes | Fill:
+    """The binary written by `binary_to_json`. Raises ValueError, TypeError or IndexError if `data` isn't one."""
+    from etc_as.core import Fill
+    if isinstance(data, list):
+        return Fill(bytes.fromhex(data[0]), int(data[1]))
+    return bytes.fromhex(data)
+
+
+class LineCache:
+    def __init__(self, max_size: int = DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        # Entries read from disk by this process, and the variants to write once the assembly is done
+        self.entries: dict[str, list[Variant]] = {}
+        self.pending: dict[str, list[Variant]] = {}
+        self.hits = self.misses = self.stored = self.evicted = 0
+
+    def start(self):
+        """Starts counting (and collecting variants) for another assembly."""
+        if len(self.entries) > MAX_LOADED:
+            self.entries.clear()
+        self.pending = {}
+        self.hits = self.misses = self.stored = self.evicted = 0
+
+    @staticmethod
+    def key(config: str, line: str) -> str:
+        digest = cache.fingerprint(config, line)
+        return f"{digest[0]}/{digest[1:]}"
+
+    def _variants(self, key: str) -> list[Variant]:
+        try:
+            return self.entries[key]
+        except KeyError:
+            pass
+        data = cache.load_json(NAMESPACE, key)
+        try:
+            variants = [Variant.from_json(variant) for variant in data] if data else []
+        except (ValueError, TypeError, KeyError, IndexError):
+            variants = []
+        self.entries[key] = variants
+        return variants
+
+    def lookup(self, key: str, symbols: SymbolTable, ip: int) -> Variant | None:
+        """The variant stored under `key` that matches the current symbol values and `ip`, if there is one."""
+        values = symbols.values
+        for variant in self._variants(key):
+            if ((variant.ip is None or variant.ip == ip)
+                    and all(values[symbols.lookup(name)] == value for name, value in variant.reads)):
+                self.hits += 1
+                cache.touch(NAMESPACE, key)
+                return variant
+        self.misses += 1
+        return None
+
+    def add(self, key: str, variant: Variant):
+        if any(objects.relocations(binary) for _, binary, _ in variant.output):
+            # Relocations aren't stored, the line is assembled again instead
+            return
+        variants = self.pending.setdefault(key, [])
+        if variant not in variants:
+            variants.append(variant)
+
+    def flush(self, symbols: SymbolTable):
+        """Writes the variants of the last assembly that read the final values of their symbols."""
+        values = symbols.values
+        for key, variants in self.pending.items():
+            final = [v for v in variants if all(values[symbols.lookup(name)] == value for name, value in v.reads)]
+            old = self._variants(key)
+            new = [v for v in final if v not in old]
+            if not new:
+                continue
+            self.entries[key] = merged = (new + old)[:MAX_VARIANTS]
+            cache.store_json(NAMESPACE, key, [variant.to_json() for variant in merged])
+            self.stored += len(new)
+        self.pending = {}
+        if self.stored:
+            self.evicted += cache.evict(NAMESPACE, random.choice(_SUBDIRECTORIES), self.max_size // 16)
+
+    def report(self, name: str, file=sys.stdout):
+        lookups = self.hits + self.misses
+        rate = f" ({self.hits / lookups:.0%} hit rate)" if lookups else ""
+        print(f"{name}: line cache: {self.hits} hits, {self.misses} misses{rate}, {self.stored} stored, "
+              f"{self.evicted} evicted", file=file)
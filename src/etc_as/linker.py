@@ -0,0 +1,85 @@
+"""
+Linker.
+
+`etc-ld` combines objects assembled with `etc-as -c` (see etc_as.objects) into the same outputs `etc-as` produces. The
+references to external symbols are filled in with the values the other objects export, everything else is taken as
+it is, so only the objects of files that changed have to be assembled again.
+
+    etc-as -c main.s -o main.o
+    etc-as -c lib.s -o lib.o
+    etc-ld main.o lib.o -o program.bin -mformat=binary
+"""
+from __future__ import annotations
+
+import argparse
+import sys
+
+from etc_as import __version__
+from etc_as.objects import LinkError, ObjectFile, patch, relocations
+
+
+def link(objects: list[ObjectFile], names: list[str] = None):
+    """Links `objects` into an AssemblyResult. `names` are used in messages."""
+    from etc_as.core import AssemblyResult
+    names = names or [f"object {n + 1}" for n in range(len(objects))]
+    symbols: dict[str, int] = {}
+    defined_in: dict[str, str] = {}
+    for obj, name in zip(objects, names):
+        for symbol, value in obj.symbols.items():
+            if symbol in symbols:
+                raise LinkError(f"{symbol} is exported by both {defined_in[symbol]} and {name}")
+            symbols[symbol] = value
+            defined_in[symbol] = name
+
+    output = []
+    for obj, name in zip(objects, names):
+        address_mask = (1 << obj.max_address_width) - 1
+        for instruction in obj.output:
+            pending = relocations(instruction.binary)
+            if pending:
+                binary = bytes(instruction.binary)
+                for relocation in pending:
+                    if relocation.symbol not in symbols:
+                        raise LinkError(f"{name}: undefined symbol {relocation.symbol} "
+                                        f"in `{instruction.raw_line.strip()}'")
+                    binary = patch(binary, instruction.start_ip & address_mask, relocation,
+                                   symbols[relocation.symbol], address_mask)
+                instruction = instruction._replace(binary=binary)
+            output.append(instruction)
+    return AssemblyResult(output, max((obj.max_address_width for obj in objects), default=16))
+
+
+def main():
+    from etc_as import main as etc_as
+    parser = argparse.ArgumentParser(prog="etc-ld", description=__doc__.strip().splitlines()[0])
+    parser.add_argument("objects", nargs="+", metavar="OBJECT", help="objects assembled with etc-as -c")
+    parser.add_argument("-o", dest="output", default="a.out", help="the output file (default: a.out)")
+    parser.add_argument("-m", dest="machine", action="append", default=[], metavar="format=FORMAT",
+                        help="the output format, binary, tc, tc-64 or annotated (default: annotated)")
+    parser.add_argument("-v", dest="verbosity", action="count", default=0, help="print the symbols of every object")
+    parser.add_argument("-V", "--version", action="version", version=__version__)
+    args = parser.parse_args()
+
+    mformat = 'annotated'
+    for option in args.machine:
+        if not option.startswith('format='):
+            parser.error(f"unknown option -m{option}")
+        mformat = etc_as.machine_option(option, set())
+
+    objects = []
+    for name in args.objects:
+        with open(name, encoding="utf-8") as f:
+            objects.append(ObjectFile.read(f))
+        if args.verbosity:
+            print(f"{name}: exports {', '.join(objects[-1].symbols) or 'nothing'}, "
+                  f"needs {', '.join(sorted(objects[-1].externals())) or 'nothing'}")
+    try:
+        res = link(objects, args.objects)
+        # Overlapping objects are reported before anything is written
+        res.segments
+        with open(args.output, 'wb' if mformat == 'binary' else 'w') as f:
+            etc_as.write_output(res, f, mformat)
+    except (LinkError, ValueError) as e:
+        print(f"etc-ld: {e}", file=sys.stderr)
+        return 1
+    return 0
@@ -1,79 +1,275 @@
 from __future__ import annotations
 
 from etc_as import __version__
-import etc_as.core as core
-import etc_as.base_isa as base
-import etc_as.common_macros
-import etc_as.extensions as extensions
-import logging
+import etc_as.profiling as profiling
+import etc_as.server as server
+import os
+import struct
 import sys
-
-
-def assemble(in_file: str, out_file: str):
-    global mformat, modes, verbosity
-    extensions.import_all_extensions()
+import time
+import traceback
+from typing import TYPE_CHECKING
+
+# The assembler itself (and lark with it) is only imported once something gets assembled locally, so that --help,
+# --version and forwarding to a server don't have to wait for it. Extensions are imported when they get enabled.
+if TYPE_CHECKING:
+    import etc_as.core as core
+
+
+# Kept between files, so that assembling many files in one process reuses the parsers and parse results
+_worker: core.Assembler | None = None
+# The socket of the server files are forwarded to, if one is running
+server_socket: str | None = None
+# The directories given with -I
+include_paths: list[str] = []
+# How often --watch looks for changed files, in seconds
+WATCH_INTERVAL = 0.1
+# The size limit of the on-disk line cache in bytes, None if it isn't used
+line_cache_size: int | None = None
+
+
+def assembler(warm: bool = False) -> core.Assembler:
+    """
+    The Assembler of this process, reset for the current modes and ready to assemble another file. With `warm`, it
+    is going to assemble the same file as last time again, see Assembler.reset.
+    """
+    global _worker
+    import etc_as.core as core
     if verbosity >= 5:
+        import logging
         logging.basicConfig(level='DEBUG')
 
-    worker = core.Assembler(verbosity)
-    worker.context.modes = modes
-    worker.context.reload_extensions()
-
+    if _worker is None:
+        _worker = core.Assembler(verbosity)
+    else:
+        _worker.reset(verbosity, warm=warm)
+    if line_cache_size is None:
+        _worker.line_store = None
+    elif _worker.line_store is None or _worker.line_store.max_size != line_cache_size:
+        import etc_as.line_cache as line_cache
+        _worker.line_store = line_cache.LineCache(line_cache_size)
+    _worker.context.modes = set(modes)
+    _worker.context.reload_extensions()
+    _worker.include_paths = list(include_paths)
+    return _worker
+
+
+def assemble(in_file: str, out_file: str, warm: bool = False):
     with open(in_file, 'r', encoding="utf-8") as f:
-        res = worker.n_pass(f.read())
-
-    if mformat == 'binary':
-        output_as_binary(res, out_file)
-    elif mformat == 'annotated':
-        output_as_annotated(res, out_file, (res.max_address_width + 7) // 8)
-    elif mformat == 'tc':
-        output_as_tc_8(res, out_file)
-    elif mformat == 'tc-64':
-        output_as_tc_64(res, out_file)
+        source = f.read()
+
+    if server_socket is not None:
+        output = server.request_assembly(server_socket, source, modes, mformat, in_file, include_paths)
+        with open(out_file, 'wb' if mformat == 'binary' else 'w') as f:
+            f.write(output)
+        return
+
+    if profiling.active is not profiling.DISABLED:
+        profiling.active.file = in_file
+    if mformat == 'object':
+        import etc_as.objects as objects
+        worker = assembler(warm)
+        res = objects.ObjectFile.from_result(worker.n_pass(source, relocatable=True, path=in_file),
+                                             worker.exported_symbols())
+        with open(out_file, 'w', encoding="utf-8") as f, profiling.active.phase("output"):
+            res.write(f)
     else:
-        raise ValueError(f'impossible mformat `{mformat}\'')
+        worker = assembler(warm)
+        res = worker.n_pass(source, path=in_file)
+        with open(out_file, 'wb' if mformat == 'binary' else 'w') as f, profiling.active.phase("output"):
+            write_output(res, f)
+    if verbosity and worker.line_store is not None:
+        worker.line_store.report(in_file)
+
+
+def write_output(res, f, fmt: str = None):
+    fmt = fmt or mformat
+    if fmt == 'binary':
+        output_as_binary(res, f)
+    elif fmt == 'annotated':
+        output_as_annotated(res, f, (res.max_address_width + 7) // 8)
+    elif fmt == 'tc':
+        output_as_tc_8(res, f)
+    elif fmt == 'tc-64':
+        output_as_tc_64(res, f)
+    else:
+        raise ValueError(f'impossible mformat `{fmt}\'')
+
 
+# The writers take open files. Output is written line by line (or chunk by chunk), so memory use doesn't depend on
+# the size of the image.
 
-def output_as_binary(res, out_file):
-    with open(out_file, 'bw') as f:
-        f.write(res.to_bytes())
+def output_as_binary(res, f):
+    res.write_to(f)
 
 
-def output_as_tc_8(res, out_file):
-    with open(out_file, 'w') as f:
-        for instr in res.output_with_aligns():
-            encoding = ' '.join(f'0x{b:02x}' for b in instr.binary)
-            f.write(f"{encoding:10} # {instr.raw_line}\n")
+_TC_BYTES = [f'0x{b:02x}' for b in range(256)]
 
 
-def output_as_tc_64(res, out_file):
-    with open(out_file, 'w') as f:
-        bs = b''
-        waiting = []
+def output_as_tc_8(res, f):
+    for instr in res.output_with_aligns():
+        encoding = ' '.join(map(_TC_BYTES.__getitem__, bytes(instr.binary)))
+        f.write(f"{encoding:10} # {instr.raw_line}\n")
 
-        def do_print():
-            nonlocal bs, waiting
-            for i in waiting:
-                f.write(f"# {i.raw_line}\n")
-            f.write(f"0x{int.from_bytes(bs[:8], 'little'):0{16}x}\n")
-            bs = bs[8:]
-            waiting = []
 
-        for instr in res.output_with_aligns():
-            waiting.append(instr)
-            bs += instr.binary
-            while len(bs) >= 8:
-                do_print()
-        while len(bs) > 0:
-            do_print()
+def output_as_tc_64(res, f):
+    import etc_as.core as core
+    pending = bytearray()
+    waiting = []
+    for instr in res.output_with_aligns():
+        waiting.append(instr.raw_line)
+        for chunk in core.binary_chunks(instr.binary):
+            pending += chunk
+            if len(pending) >= 8:
+                end = len(pending) - len(pending) % 8
+                f.writelines(f"# {line}\n" for line in waiting)
+                waiting = []
+                with memoryview(pending) as view:
+                    f.writelines(f"0x{word:016x}\n" for word, in struct.iter_unpack('<Q', view[:end]))
+                del pending[:end]
+    if pending:
+        f.writelines(f"# {line}\n" for line in waiting)
+        f.write(f"0x{int.from_bytes(pending, 'little'):016x}\n")
 
 
-def output_as_annotated(res, out_file, address_width):
+def output_as_annotated(res, f, address_width):
     address_mask = (1 << (address_width*8)) - 1
-    with open(out_file, 'w') as f:
-        for instr in res.output_with_aligns():
-            encoding = ' '.join('{:02x}'.format(b) for b in instr.binary)
-            f.write(f"0x{instr.start_ip & address_mask:0{address_width*2}x}: {encoding:30}# {instr.raw_line}\n")
+    for instr in res.output_with_aligns():
+        encoding = bytes(instr.binary).hex(' ')
+        f.write(f"0x{instr.start_ip & address_mask:0{address_width*2}x}: {encoding:30}# {instr.raw_line}\n")
+
+
+FORMAT_SUFFIXES = {
+    'binary': '.bin',
+    'annotated': '.ann',
+    'tc': '.tc',
+    'tc-64': '.tc64',
+    'object': '.o',
+}
+
+
+def output_names(asm_files: list[str], obj_file: str | None) -> list[str]:
+    """
+    The output file for each input file. `obj_file` can be a pattern using `{stem}`, `{name}`, `{dir}` and `{ext}`
+    (the format's usual suffix). Otherwise, it names the output file for a single input or the output directory for
+    many. Without it, a single input goes to a.out and many go next to their inputs, as do objects.
+    """
+    if obj_file is None and len(asm_files) == 1 and mformat != 'object':
+        return ['a.out']
+    if obj_file is None:
+        obj_file = os.path.join('{dir}', '{stem}{ext}')
+    elif '{' not in obj_file:
+        if len(asm_files) == 1 and not os.path.isdir(obj_file):
+            return [obj_file]
+        os.makedirs(obj_file, exist_ok=True)
+        obj_file = os.path.join(obj_file, '{stem}{ext}')
+    names = []
+    for asm_file in asm_files:
+        name = os.path.basename(asm_file)
+        names.append(obj_file.format(stem=os.path.splitext(name)[0], name=name, dir=os.path.dirname(asm_file) or '.',
+                                     ext=FORMAT_SUFFIXES[mformat]))
+    duplicates = {name for name in names if names.count(name) > 1}
+    if duplicates:
+        raise ValueError(f"several inputs would be written to {', '.join(sorted(duplicates))}")
+    # A pattern can name directories that don't exist yet
+    for directory in {os.path.dirname(name) for name in names} - {''}:
+        os.makedirs(directory, exist_ok=True)
+    return names
+
+
+def _stamps(paths) -> dict[str, int | None]:
+    stamps = {}
+    for path in paths:
+        try:
+            stamps[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            stamps[path] = None
+    return stamps
+
+
+def watch(jobs: list[tuple[str, str]]) -> int:
+    """
+    Assembles all `jobs`, and then each one again whenever its file or a file it includes changes, until interrupted.
+
+    Every file keeps its own Assembler, which is reset warm (see Assembler.reset) for the next build, so that only the
+    lines that changed (or are affected by the changes) get encoded again.
+    """
+    global _worker
+    workers: dict[str, core.Assembler] = {}
+    stamps: dict[str, dict[str, int | None]] = {}
+    try:
+        while True:
+            for in_file, out_file in jobs:
+                known = stamps.get(in_file, {in_file: None})
+                current = _stamps(known)
+                if current == stamps.get(in_file):
+                    continue
+                _worker = workers.get(in_file)
+                start = time.perf_counter()
+                try:
+                    assemble(in_file, out_file, warm=True)
+                    status = f"-> {out_file}"
+                except Exception as e:
+                    status = f"{type(e).__name__}: {e}"
+                    if verbosity:
+                        status += "\n" + traceback.format_exc()
+                workers[in_file] = _worker
+                # Files included for the first time are taken as they are now, before the build is reported, so that
+                # changes made once it is are seen
+                stamps[in_file] = {**_stamps(_worker.sources if _worker else ()), **current}
+                print(f"{in_file}: {status} ({(time.perf_counter() - start) * 1000:.1f} ms)", file=sys.stderr,
+                      flush=True)
+            time.sleep(WATCH_INTERVAL)
+    except KeyboardInterrupt:
+        return 0
+
+
+def _init_batch_worker(options):
+    global modes, mformat, verbosity, server_socket, include_paths, line_cache_size
+    import etc_as.cache as cache
+    modes, mformat, verbosity, server_socket, include_paths, line_cache_size, cache.enabled = options
+
+
+def _assemble_reporting(job: tuple[str, str]) -> str | None:
+    """Assembles one file of a batch, returning the error message instead of raising."""
+    in_file, out_file = job
+    try:
+        assemble(in_file, out_file)
+    except Exception as e:
+        message = f"{in_file}: {type(e).__name__}: {e}"
+        if verbosity:
+            message += "\n" + traceback.format_exc()
+        return message
+    return None
+
+
+def assemble_batch(jobs: list[tuple[str, str]], processes: int) -> int:
+    """Assembles all `jobs`, reporting errors per file. Returns the number of files that failed."""
+    if processes > 1 and len(jobs) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        import etc_as.cache as cache
+        # Everything the workers need is passed explicitly, they don't inherit it unless the pool forks
+        pool = ProcessPoolExecutor(min(processes, len(jobs)), initializer=_init_batch_worker,
+                                   initargs=((modes, mformat, verbosity, server_socket, include_paths,
+                                             line_cache_size, cache.enabled),))
+        with pool:
+            results = pool.map(_assemble_reporting, jobs)
+            return _report(jobs, results)
+    return _report(jobs, map(_assemble_reporting, jobs))
+
+
+def _report(jobs, results) -> int:
+    failed = 0
+    for (in_file, out_file), error in zip(jobs, results):
+        if error is None:
+            if verbosity:
+                print(f"{in_file} -> {out_file}")
+        else:
+            failed += 1
+            print(error, file=sys.stderr)
+    if failed and len(jobs) > 1:
+        print(f"{failed} of {len(jobs)} files failed", file=sys.stderr)
+    return failed
 
 
 args = sys.argv
@@ -85,7 +281,7 @@ def shift(n=1):
 
 
 usage_msg: str = f'''\
-Usage: {args[0]} [option...] FILE\
+Usage: {args[0]} [option...] FILE...\
 '''
 
 help_msg: str = usage_msg + f'''
@@ -93,7 +289,44 @@ Options:
   -V     --version        Print version number and exit
   -v                      Print progress information.
   -help  --help           Display this help message and exit.
-  -o OBJFILE              Name the object file (default: a.out)
+  -o OBJFILE              Name the object file (default: a.out). With several
+                          input files, OBJFILE is the output directory
+                          (default: next to each input file). It can also be a
+                          pattern like `build/{{stem}}.bin' using {{stem}},
+                          {{name}}, {{dir}} and {{ext}} (the suffix of the output
+                          format).
+  -c                      Assemble into a relocatable object (FILE.o by
+                          default) that etc-ld links with others. Undefined
+                          symbols are left to the linker, `.global NAME'
+                          exports NAME to other objects.
+  -I DIR                  Look for files included with `.include "FILE"' in
+                          DIR, after the directory of the including file.
+                          Can be given several times.
+  -jN                     Assemble up to N files in parallel (default: 1, -j
+                          alone uses all CPUs).
+  --watch                 Keep running, and assemble every file again
+                          whenever it or a file it includes changes.
+                          Unchanged lines are reused from the last build.
+  --no-cache              Don't read or write the on-disk caches.
+  --clear-cache           Empty the on-disk caches before assembling.
+  --line-cache[=MB]       Keep encoded lines on disk and reuse them in later
+                          runs, using up to MB megabytes (default: 100).
+                          With -v, hits and misses are reported.
+  --server                Keep running and assemble the files sent by other
+                          invocations of etc-as, which forward their files to
+                          it while it is listening. -jN sets how many files it
+                          assembles at the same time.
+  --socket PATH           The socket of the server (default: $ETC_AS_SOCKET,
+                          etc_as-UID.sock in $XDG_RUNTIME_DIR or
+                          etc_as-UID/server.sock in /tmp).
+  --idle-timeout SECONDS  Stop the server after SECONDS without a request
+                          (default: {server.DEFAULT_IDLE_TIMEOUT}, 0 to never stop).
+  --no-server             Assemble locally even if a server is running.
+  --profile[=FILE]        Print how long the phases of the assembly and the
+                          slowest source lines took. With FILE, also write
+                          that to FILE as JSON, which can be loaded as a
+                          Chrome trace. Implies --no-server and -j1.
+  --profile-top N         Report the N slowest lines (default: 20).
   -mformat=[binary|tc|tc-64|annotated] (default: annotated)
                           Control the assembled output format.
                           The tc and tc-64 formats are aimed at the game
@@ -109,6 +342,25 @@ Options:
 '''
 
 
+def machine_option(option: str, modes: set[str]) -> str | None:
+    """
+    Applies the `-m` option `option` (without the `-m`) to `modes`. Returns the output format if it selects one, and
+    raises a KeyError if it is unknown.
+    """
+    if option == 'strict' or option == 'pedantic':
+        modes.add('strict')
+    elif option == 'naked-reg':
+        modes.discard('prefix')
+    elif option.startswith('format='):
+        fmt = option[7:]
+        if fmt not in ['binary', 'tc', 'tc-64', 'annotated']:
+            raise ValueError(f"unknown format: {fmt}")
+        return fmt
+    else:
+        raise KeyError(option)
+    return None
+
+
 def print_version():
     print(__version__)
     exit()
@@ -120,13 +372,27 @@ def print_help():
 
 
 def main():
-    global modes, mformat, verbosity
+    global modes, mformat, verbosity, server_socket, include_paths, line_cache_size
 
     modes = set(['prefix'])
+    include_paths = []
+    line_cache_size = None
     mformat = 'annotated'
-    asm_file: str = None
-    obj_file: str = 'a.out'
+    asm_files: list[str] = []
+    obj_file: str | None = None
+    processes = 1
     verbosity = 0
+    use_cache = True
+    clear_cache = False
+    serve = False
+    forward = True
+    socket_path = None
+    idle_timeout = server.DEFAULT_IDLE_TIMEOUT
+    profile = False
+    profile_file = None
+    profile_top = 20
+    relocatable = False
+    watching = False
     unhandled = []
     while len(args) > 1:
         a = args[1]
@@ -136,35 +402,108 @@ def main():
             verbosity += 1; shift()
         elif a == '-help' or a == '--help':
             print_help()
+        elif a == '-c':
+            relocatable = True; shift()
         elif a == '-o':
             obj_file = args[2]; shift(2)
-        elif a.startswith('-m'):
-            a = a[2:]
-            if a == 'strict' or a == 'pedantic':
-                modes.add('strict'); shift()
-            elif a == 'naked-reg':
-                modes.remove('prefix'); shift()
-            elif a.startswith('format='):
-                a = a[7:]
-                if a not in ['binary', 'tc', 'tc-64', 'annotated']: raise ValueError(f"unknown format: {a}")
-                mformat = a;
-                shift()
+        elif a == '-I':
+            include_paths.append(args[2]); shift(2)
+        elif a.startswith('-I'):
+            include_paths.append(a[2:]); shift()
+        elif a.startswith('-j'):
+            if a != '-j':
+                processes = int(a[2:]); shift()
+            elif len(args) > 2 and args[2].isdigit():
+                processes = int(args[2]); shift(2)
             else:
-                unhandled += [a]; shift()
+                processes = os.cpu_count() or 1; shift()
+        elif a == '--watch':
+            watching = True; shift()
+        elif a == '--no-cache':
+            use_cache = False; shift()
+        elif a == '--line-cache' or a.startswith('--line-cache='):
+            line_cache_size = int(float(a.partition('=')[2] or 100) * 2**20); shift()
+        elif a == '--clear-cache':
+            clear_cache = True; shift()
+        elif a == '--server':
+            serve = True; shift()
+        elif a == '--socket':
+            socket_path = args[2]; shift(2)
+        elif a == '--idle-timeout':
+            idle_timeout = float(args[2]); shift(2)
+        elif a == '--no-server':
+            forward = False; shift()
+        elif a == '--profile' or a.startswith('--profile='):
+            profile = True
+            profile_file = a.partition('=')[2] or None; shift()
+        elif a == '--profile-top':
+            profile_top = int(args[2]); shift(2)
+        elif a.startswith('-m'):
+            try:
+                mformat = machine_option(a[2:], modes) or mformat
+            except KeyError:
+                unhandled += [a[2:]]
+            shift()
         elif a[0] != '-':
-            asm_file = a; shift()
+            asm_files.append(a); shift()
         else:
             unhandled += [a]; shift()
 
+    if relocatable:
+        mformat = 'object'
+
     if verbosity:
         print("Parsed command line arguments:")
         print(f"  modes:     {modes}")
         print(f"  format:    {mformat}")
-        print(f"  in file:   {asm_file}")
+        print(f"  in files:  {asm_files}")
+        print(f"  includes:  {include_paths}")
         print(f"  objfile:   {obj_file}")
+        print(f"  processes: {processes}")
         print(f"  verbosity: {verbosity}")
 
     if len(unhandled) != 0:
         raise ValueError(f"unknown arguments: {unhandled}")
 
-    assemble(asm_file, obj_file)
+    if not use_cache or clear_cache:
+        import etc_as.cache as cache
+        cache.enabled = use_cache
+    if clear_cache:
+        cache.clear()
+        if not asm_files and not serve:
+            return
+
+    if serve:
+        return server.serve(socket_path, processes, idle_timeout, verbosity)
+
+    if not asm_files:
+        print(usage_msg, file=sys.stderr)
+        return 1
+
+    # The server has its own cache, so it is only used with the default cache settings
+    if (forward and use_cache and not clear_cache and not profile and not relocatable and not watching
+            and line_cache_size is None):
+        socket_path = socket_path or server.default_socket_path()
+        if server.is_running(socket_path):
+            server_socket = socket_path
+            if verbosity:
+                print(f"Forwarding to the server on {socket_path}")
+
+    obj_files = output_names(asm_files, obj_file)
+    if watching:
+        return watch(list(zip(asm_files, obj_files)))
+    if profile:
+        with profiling.Profiler() as profiler:
+            try:
+                if len(asm_files) == 1:
+                    assemble(asm_files[0], obj_files[0])
+                    return 0
+                return 1 if assemble_batch(list(zip(asm_files, obj_files)), 1) else 0
+            finally:
+                profiler.report(profile_top)
+                if profile_file is not None:
+                    profiler.write(profile_file, profile_top)
+    if len(asm_files) == 1:
+        assemble(asm_files[0], obj_files[0])
+        return 0
+    return 1 if assemble_batch(list(zip(asm_files, obj_files)), processes) else 0
@@ -0,0 +1,196 @@
+"""
+Relocatable objects.
+
+`etc-as -c` assembles a file without requiring every symbol it references to be defined. The symbols that are still
+undefined after the first pass become external, references to them are encoded as if they were 0 and get a
+`Relocation` telling the linker (`etc-ld`, see etc_as.linker) what to fill in. Only the references whose encoding the
+linker knows how to patch can be relocated: near jumps and calls, their relaxed long forms, and data words holding a
+symbol on its own (like `.word name`). Anything else referring to an external symbol is an error.
+
+Objects aren't position independent: everything stays at the address it was assembled at, so modules that are linked
+together have to be placed apart with `.org`. Symbols other objects may refer to have to be exported with `.global`.
+
+An object is a JSON file. The bytes of all instructions are stored once, base64 encoded, and every instruction is a
+list `[address, size, line]` (pads have the fill pattern in hex as a fourth element). A relocation is
+`[offset, kind, symbol, shift]`, where `offset` is the position of the patched bytes in the code.
+"""
+from __future__ import annotations
+
+import base64
+import json
+from typing import IO, NamedTuple, Iterable, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from etc_as.core import AssemblyResult, InstructionOutput, Fill
+
+FORMAT = "etc-as object"
+VERSION = 1
+
+# The relocation kinds, and the sizes of the data words they patch
+NEAR_JUMP = "near_jump"
+NEAR_CALL = "near_call"
+IMM5 = "imm5"
+DATA_SIZES = {'half': 1, 'word': 2, 'dword': 4, 'qword': 8}
+
+
+class LinkError(Exception):
+    pass
+
+
+class Relocation(NamedTuple):
+    # Position of the patched bytes, relative to the binary the relocation is attached to
+    offset: int
+    kind: str
+    # The full name of the symbol
+    symbol: str
+    # For IMM5, how far the address is shifted right before taking the low 5 bits
+    shift: int = 0
+
+
+class Relocated(bytes):
+    """The binary of an instruction that refers to external symbols, with the relocations for those references."""
+    relocations: tuple[Relocation, ...]
+
+    def __new__(cls, data: bytes, relocations: Iterable[Relocation]):
+        self = super().__new__(cls, data)
+        self.relocations = tuple(relocations)
+        return self
+
+
+class External(int):
+    """The value of a reference to an external symbol in an expression, 0 until the linker fills it in."""
+    symbol: str
+
+    def __new__(cls, symbol: str):
+        self = super().__new__(cls, 0)
+        self.symbol = symbol
+        return self
+
+
+def relocations(binary) -> tuple[Relocation, ...]:
+    return getattr(binary, "relocations", ())
+
+
+def join(binaries: Iterable) -> bytes:
+    """Joins the binaries of several instructions, keeping their relocations."""
+    parts = []
+    moved = []
+    offset = 0
+    for binary in binaries:
+        data = bytes(binary)
+        moved += [r._replace(offset=r.offset + offset) for r in relocations(binary)]
+        parts.append(data)
+        offset += len(data)
+    result = b"".join(parts)
+    return Relocated(result, moved) if moved else result
+
+
+def patch(binary: bytes, site: int, relocation: Relocation, target: int, address_mask: int) -> bytes:
+    """Fills `target` into `binary`, which starts at the address `site`, as described by `relocation`."""
+    data = bytearray(binary)
+    i = relocation.offset
+    kind = relocation.kind
+    if kind == NEAR_JUMP:
+        offset = target - site - i
+        if not -256 <= offset < 256:
+            raise LinkError(f"Cannot encode near jump from 0x{site + i:04x} to `{relocation.symbol}' at 0x{target:04x}")
+        data[i] = data[i] & ~0x10 | (offset < 0) << 4
+        data[i + 1] = offset & 0xFF
+    elif kind == NEAR_CALL:
+        offset = target - site - i
+        if not -2048 <= offset < 2048:
+            raise LinkError(f"Cannot encode near call from 0x{site + i:04x} to `{relocation.symbol}' at 0x{target:04x}")
+        data[i] = data[i] & 0xF0 | offset >> 8 & 0x0F
+        data[i + 1] = offset & 0xFF
+    elif kind == IMM5:
+        data[i] = data[i] & 0xE0 | (target & address_mask) >> relocation.shift & 0x1F
+    elif kind in DATA_SIZES:
+        size = DATA_SIZES[kind]
+        if target >> 8 * size:
+            raise LinkError(f"`{relocation.symbol}' at 0x{target:x} does not fit into a .{kind} at 0x{site + i:04x}")
+        data[i:i + size] = target.to_bytes(size, "little")
+    else:
+        raise LinkError(f"Unknown relocation kind {kind!r}")
+    return bytes(data)
+
+
+class ObjectFile(NamedTuple):
+    output: list[InstructionOutput]
+    max_address_width: int
+    # The exported symbols and their values
+    symbols: dict[str, int]
+
+    @classmethod
+    def from_result(cls, result: AssemblyResult, symbols: dict[str, int]) -> ObjectFile:
+        # Stored in address order, so that the instructions of a section are next to each other
+        return cls([i for segment in result.segments for i in segment.output], result.max_address_width, symbols)
+
+    def externals(self) -> set[str]:
+        return {r.symbol for i in self.output for r in relocations(i.binary)}
+
+    def to_json(self) -> dict:
+        from etc_as.core import Fill
+        code = []
+        offset = 0
+        instructions = []
+        sections = []
+        relocs = []
+        for i in self.output:
+            size = len(i.binary)
+            if sections and sections[-1][1] == i.start_ip:
+                sections[-1][1] += size
+            else:
+                sections.append([i.start_ip, i.start_ip + size, offset])
+            if isinstance(i.binary, Fill):
+                instructions.append([i.start_ip, size, i.raw_line, i.binary.pattern.hex()])
+                continue
+            instructions.append([i.start_ip, size, i.raw_line])
+            relocs += [[offset + r.offset, r.kind, r.symbol, r.shift] for r in relocations(i.binary)]
+            code.append(bytes(i.binary))
+            offset += size
+        return {
+            "format": FORMAT,
+            "version": VERSION,
+            "address_width": self.max_address_width,
+            "symbols": self.symbols,
+            # [start address, end address, offset in the code]
+            "sections": sections,
+            "relocations": relocs,
+            "instructions": instructions,
+            "code": base64.b64encode(b"".join(code)).decode("ascii"),
+        }
+
+    @classmethod
+    def from_json(cls, data: dict) -> ObjectFile:
+        from etc_as.core import Fill, InstructionOutput
+        if data.get("format") != FORMAT or data.get("version") != VERSION:
+            raise LinkError(f"Not an object of version {VERSION}")
+        code = base64.b64decode(data["code"])
+        pending = sorted(Relocation(*r) for r in data["relocations"])
+        output = []
+        offset = 0
+        n = 0
+        for start, size, line, *fill in data["instructions"]:
+            if fill:
+                output.append(InstructionOutput(start, Fill(bytes.fromhex(fill[0]), size), line))
+                continue
+            binary = code[offset:offset + size]
+            own = []
+            while n < len(pending) and pending[n].offset < offset + size:
+                own.append(pending[n]._replace(offset=pending[n].offset - offset))
+                n += 1
+            output.append(InstructionOutput(start, Relocated(binary, own) if own else binary, line))
+            offset += size
+        return cls(output, data["address_width"], data["symbols"])
+
+    def write(self, f: IO[str]):
+        json.dump(self.to_json(), f, separators=(",", ":"))
+        f.write("\n")
+
+    @classmethod
+    def read(cls, f: IO[str]) -> ObjectFile:
+        try:
+            data = json.load(f)
+        except ValueError as e:
+            raise LinkError(f"Not an object: {e}") from e
+        return cls.from_json(data)
@@ -0,0 +1,166 @@
+"""
+Keyword-indexed instruction parsing.
+
+Instead of feeding every line to one Earley parser containing every instruction of every enabled extension, the
+first token of a line selects the instructions that can start with it. The line is then parsed by a grammar that
+only contains those instructions (and everything they refer to). The generic macro invocation rule is only added
+when the first token names a known macro, since it would otherwise be rejected anyway.
+"""
+from __future__ import annotations
+
+import re
+from collections import defaultdict
+
+from lark import Lark, GrammarError, Tree, UnexpectedInput
+from lark.load_grammar import GrammarBuilder
+
+from etc_as import cache, profiling
+
+# (category, alias, grammar) as produced by Assembler.build_parser
+GrammarPiece = tuple[str, str, str]
+
+# Comes before the instructions of all extensions, like it used to in instruction.lark
+MACRO_INVOCATION: GrammarPiece = ("instruction", "macro_invocation",
+                                  '%extend instruction: NAME (atom_raw ("," atom_raw)*)? -> macro_invocation')
+
+_LEADING_WHITESPACE = re.compile(r"[ \t]*")
+_NAME = re.compile(r"\b[^\W0-9]\w*")
+
+
+def _load_grammar(base_grammar: str, pieces: list[GrammarPiece]):
+    grammar_builder = GrammarBuilder()
+    grammar_builder.load_grammar(base_grammar, "instruction.lark")
+    for _, alias, grammar in pieces:
+        grammar_builder.load_grammar(grammar, alias)
+    try:
+        return grammar_builder.build()
+    except GrammarError as e:
+        raise e
+
+
+def _first_terminals(rules) -> dict[str, set[str] | None]:
+    """
+    Maps the alias of each `instruction` rule to the names of the terminals it can start with.
+    An alias that can match the empty string maps to None.
+    """
+    nullable = set()
+    first = defaultdict(set)
+    changed = True
+    while changed:
+        changed = False
+        for rule in rules:
+            origin_first = first[rule.origin]
+            size = len(origin_first)
+            for symbol in rule.expansion:
+                if symbol.is_term:
+                    origin_first.add(symbol.name)
+                    break
+                origin_first |= first[symbol]
+                if symbol not in nullable:
+                    break
+            else:
+                if rule.origin not in nullable:
+                    nullable.add(rule.origin)
+                    changed = True
+            changed |= size != len(origin_first)
+
+    result = {}
+    for rule in rules:
+        if rule.origin.name != "instruction" or rule.alias is None:
+            continue
+        terminals = set()
+        for symbol in rule.expansion:
+            if symbol.is_term:
+                terminals.add(symbol.name)
+                break
+            terminals |= first[symbol]
+            if symbol not in nullable:
+                break
+        else:
+            terminals = None
+        previous = result.get(rule.alias, set())
+        result[rule.alias] = None if terminals is None or previous is None else previous | terminals
+    return result
+
+
+class InstructionParser:
+    """
+    Parses single lines for one configuration of enabled extensions and active modes.
+
+    Sub-parsers are built lazily for each distinct set of candidate instructions and shared through the on-disk cache.
+    """
+
+    def __init__(self, base_grammar: str, pieces: list[GrammarPiece]):
+        self.base_grammar = base_grammar
+        self.pieces = [MACRO_INVOCATION, *pieces]
+        key = cache.fingerprint(base_grammar, pieces)
+        index = cache.load("dispatch", key)
+        if index is None:
+            index = self._build_index()
+            cache.store("dispatch", key, index)
+        always, keyed = index
+        self.always = frozenset(always)
+        self.index = [(re.compile(pattern).match, frozenset(aliases)) for pattern, aliases in keyed]
+        self.parsers: dict[frozenset[str], Lark] = {}
+
+    def _build_index(self):
+        terminals, rules, _ = _load_grammar(self.base_grammar, self.pieces).compile(["instruction"], set())
+        patterns = {t.name: t.pattern.to_regexp() for t in terminals}
+        always = set()
+        by_terminal = defaultdict(set)
+        for alias, first in _first_terminals(rules).items():
+            if alias == MACRO_INVOCATION[1]:
+                continue
+            elif first is None:
+                always.add(alias)
+            else:
+                for name in first:
+                    by_terminal[patterns[name]].add(alias)
+        return sorted(always), sorted((pattern, sorted(aliases)) for pattern, aliases in by_terminal.items())
+
+    def candidates(self, line: str, macros=()) -> frozenset[str]:
+        """The aliases of the instructions that could match `line`, judging by its first token."""
+        pos = _LEADING_WHITESPACE.match(line).end()
+        selected = set(self.always)
+        for match, aliases in self.index:
+            if match(line, pos):
+                selected |= aliases
+        if self.invokes_macro(line, macros):
+            selected.add(MACRO_INVOCATION[1])
+        return frozenset(selected)
+
+    @staticmethod
+    def invokes_macro(line: str, macros) -> bool:
+        """Whether the first token of `line` is the name of one of `macros`."""
+        if not macros:
+            return False
+        name = _NAME.match(line, _LEADING_WHITESPACE.match(line).end())
+        return name is not None and name.group() in macros
+
+    def parser_for(self, candidates: frozenset[str]) -> Lark:
+        try:
+            return self.parsers[candidates]
+        except KeyError:
+            pass
+        pieces = [p for p in self.pieces if p[0] != "instruction" or p[1] in candidates]
+        key = cache.fingerprint(self.base_grammar, pieces)
+        with profiling.active.phase("load_subparser"):
+            parser = cache.load("parsers", key)
+        if parser is None:
+            with profiling.active.phase("build_subparser"):
+                # Maybe lexer=dynamic_complete is worth it, although it might mean a massive reduction in performance
+                parser = Lark(_load_grammar(self.base_grammar, pieces), parser='earley', lexer='dynamic',
+                              ambiguity="explicit", start="instruction", propagate_positions=True)
+                cache.store("parsers", key, parser)
+        self.parsers[candidates] = parser
+        return parser
+
+    def parse(self, line: str, macros=()) -> Tree:
+        candidates = self.candidates(line, macros)
+        try:
+            return self.parser_for(candidates).parse(line)
+        except UnexpectedInput:
+            if MACRO_INVOCATION[1] in candidates:
+                raise
+            # Unknown mnemonics used to be parsed as macro invocations, which are then rejected with a nicer error
+            return self.parser_for(candidates | {MACRO_INVOCATION[1]}).parse(line)
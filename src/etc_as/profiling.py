@@ -0,0 +1,156 @@
+"""
+Time and call counts of the phases of an assembly, and of every source line.
+
+The assembler marks its phases with `profiling.active.phase(name)` and source lines with `profiling.active.line(...)`.
+Unless a `Profiler` is active, those return a shared no-op context manager, so profiling costs next to nothing when
+it's off. Phases nest. Each one is reported with its total time and its self time, which excludes nested phases.
+
+A profile can be written to a JSON file that doubles as a Chrome trace (chrome://tracing, https://ui.perfetto.dev):
+besides the summary it has `traceEvents` for everything but the innermost phases.
+"""
+from __future__ import annotations
+
+import json
+import os
+import sys
+from contextlib import nullcontext
+from time import perf_counter
+
+# Phases that happen too often to be worth putting into the trace one by one
+UNTRACED = frozenset({"transform"})
+# The trace is cut off after this many events
+MAX_TRACE_EVENTS = 500_000
+
+
+class _Disabled:
+    _NULL = nullcontext()
+
+    def phase(self, name: str, **args):
+        return self._NULL
+
+    def line(self, number: int, text: str):
+        return self._NULL
+
+
+DISABLED = _Disabled()
+active: Profiler | _Disabled = DISABLED
+
+
+class _Phase:
+    __slots__ = ("profiler", "name", "args", "start", "duration", "children")
+
+    def __init__(self, profiler: Profiler, name: str, args: dict):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+        self.children = 0.0
+
+    def __enter__(self):
+        self.profiler.stack.append(self)
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = perf_counter()
+        profiler = self.profiler
+        profiler.stack.pop()
+        self.duration = duration = end - self.start
+        if profiler.stack:
+            profiler.stack[-1].children += duration
+        stats = profiler.phases.setdefault(self.name, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += duration
+        stats[2] += duration - self.children
+        if self.name not in UNTRACED:
+            profiler.trace(self.name, self.start, duration, self.args)
+        return False
+
+
+class _Line(_Phase):
+    __slots__ = ()
+
+    def __exit__(self, *exc):
+        super().__exit__(*exc)
+        key = (self.profiler.file, self.args["line"])
+        stats = self.profiler.lines.setdefault(key, [self.args["text"], 0, 0.0])
+        stats[1] += 1
+        stats[2] += self.duration
+        return False
+
+
+class Profiler:
+    def __init__(self):
+        # name -> [calls, total seconds, self seconds]
+        self.phases: dict[str, list] = {}
+        # (file, line number) -> [text, evaluations, total seconds]
+        self.lines: dict[tuple[str | None, int], list] = {}
+        self.events: list[dict] = []
+        self.truncated = False
+        self.stack: list[_Phase] = []
+        self.file: str | None = None
+        self.origin = perf_counter()
+        self._previous = None
+
+    def __enter__(self):
+        global active
+        self._previous, active = active, self
+        return self
+
+    def __exit__(self, *exc):
+        global active
+        active, self._previous = self._previous, None
+        return False
+
+    def phase(self, name: str, **args) -> _Phase:
+        return _Phase(self, name, args)
+
+    def line(self, number: int, text: str) -> _Line:
+        """The evaluation of line `number` (counting from 0) of the current file."""
+        return _Line(self, "line", {"line": number, "text": text})
+
+    def trace(self, name: str, start: float, duration: float, args: dict):
+        if len(self.events) >= MAX_TRACE_EVENTS:
+            self.truncated = True
+            return
+        event = {"name": name, "ph": "X", "ts": (start - self.origin) * 1e6, "dur": duration * 1e6,
+                 "pid": os.getpid(), "tid": 0}
+        if self.file is not None or args:
+            event["args"] = {"file": self.file, **args} if self.file is not None else args
+        self.events.append(event)
+
+    def top_lines(self, n: int) -> list[tuple[str | None, int, str, int, float]]:
+        """The `n` lines that took longest over all their evaluations: (file, number, text, evaluations, seconds)."""
+        rows = [(file, number, text, count, seconds) for (file, number), (text, count, seconds) in self.lines.items()]
+        rows.sort(key=lambda row: -row[4])
+        return rows[:n]
+
+    def report(self, top: int = 20, file=sys.stderr):
+        print(f"{'phase':<20} {'calls':>9} {'total ms':>11} {'self ms':>11}", file=file)
+        for name, (calls, total, own) in sorted(self.phases.items(), key=lambda item: -item[1][2]):
+            print(f"{name:<20} {calls:>9} {total * 1000:>11.1f} {own * 1000:>11.1f}", file=file)
+        if not self.lines:
+            return
+        several_files = len({file for file, _ in self.lines}) > 1
+        rows = [(f"{name}:{number + 1}" if several_files else f"{number + 1}", text, count, seconds)
+                for name, number, text, count, seconds in self.top_lines(top)]
+        width = max(8, *(len(location) for location, *_ in rows))
+        print(f"\nslowest {len(rows)} lines:", file=file)
+        print(f"{'line':>{width}} {'evals':>6} {'total ms':>10} {'ms/eval':>9}  text", file=file)
+        for location, text, count, seconds in rows:
+            print(f"{location:>{width}} {count:>6} {seconds * 1000:>10.2f} {seconds * 1000 / count:>9.2f}  "
+                  f"{text.strip()}", file=file)
+
+    def to_json(self, top: int = 20) -> dict:
+        return {
+            "phases": {name: {"calls": calls, "total": total, "self": own}
+                       for name, (calls, total, own) in self.phases.items()},
+            "lines": [{"file": name, "line": number + 1, "text": text, "evaluations": count, "total": seconds}
+                      for name, number, text, count, seconds in self.top_lines(top)],
+            "traceEvents": self.events,
+            "displayTimeUnit": "ms",
+            "truncated": self.truncated,
+        }
+
+    def write(self, path: str, top: int = 20):
+        with open(path, "w") as f:
+            json.dump(self.to_json(top), f)
@@ -0,0 +1,177 @@
+"""
+Branch relaxation.
+
+Once a scratch register is selected with `.relax`, jumps and calls that can't reach their target with their near form
+don't get rejected anymore. Instead, they switch to a long form that loads the absolute target into the scratch
+register and jumps or calls through it. The long form has the same size no matter where the target is.
+
+Every branch site starts out near and only ever grows, which guarantees that the layout converges: a site can only
+change once, and there are only finitely many of them. After each pass `BranchSites.settle` relaxes the near sites
+that are out of range, including the ones that only end up out of range because other sites grow. It only works on
+the recorded sites, so a chain of branches that push each other out of range doesn't take a whole pass per link.
+"""
+from __future__ import annotations
+
+from bisect import bisect_left, bisect_right
+from itertools import accumulate
+from typing import Callable, NamedTuple
+
+from etc_as.objects import IMM5, Relocated, Relocation
+from etc_as.symbols import SymbolTable
+
+# (line number, offset of the branch from the start of the line, mnemonic, id of the target symbol)
+SiteKey = tuple[int, int, str, int]
+
+
+class Site(NamedTuple):
+    ip: int
+    # The offsets the near form can reach
+    reach: range
+    # How many bytes the long form adds
+    growth: int
+    long: bool
+
+
+class BranchSites:
+    def __init__(self):
+        self.long: set[SiteKey] = set()
+        # The sites and anchors encountered during the current pass
+        self.sites: dict[SiteKey, Site] = {}
+        self.anchors: list[int] = []
+        # The same for the current line, with anchors relative to the start of the line
+        self.line_sites: dict[SiteKey, Site] = {}
+        self.line_anchors: list[int] = []
+        self.line = 0
+        self.line_ip = 0
+
+    def start_pass(self):
+        self.sites = {}
+        self.anchors = []
+
+    def start_line(self, number: int, ip: int):
+        self.line = number
+        self.line_ip = ip
+        self.line_sites = {}
+        self.line_anchors = []
+
+    def key(self, ip: int, mnemonic: str, symbol: int) -> SiteKey:
+        return self.line, ip - self.line_ip, mnemonic, symbol
+
+    def record(self, key: SiteKey, site: Site):
+        self.sites[key] = site
+        self.line_sites[key] = site
+
+    def anchor(self, ip: int):
+        """
+        Marks `ip` as placed by `.org` or `.align`. Growth before an anchor might not move what comes after it, so
+        `settle` doesn't assume it does and leaves that to the next pass.
+        """
+        self.anchors.append(ip)
+        self.line_anchors.append(ip - self.line_ip)
+
+    def line_state(self) -> tuple:
+        return tuple(self.line_sites.items()), tuple(self.line_anchors)
+
+    def replay(self, state: tuple, number: int, ip: int) -> bool:
+        """
+        Records the sites and anchors of a line that was encoded earlier at the same position, as line `number`
+        starting at `ip`. Returns False (and records nothing) if any of its sites was relaxed in the meantime.
+        """
+        sites, anchors = state
+        moved = [((number, *key[1:]), site._replace(ip=ip + key[1])) for key, site in sites]
+        if any((key in self.long) != site.long for key, site in moved):
+            return False
+        self.sites.update(moved)
+        self.anchors.extend(ip + offset for offset in anchors)
+        return True
+
+    def settle(self, symbols: SymbolTable) -> bool:
+        """
+        Relaxes the near sites of the last pass that are out of range of their target in `symbols`, or end up out of
+        range once the sites relaxed after they were encoded have grown. Returns whether anything was relaxed.
+        """
+        anchors = sorted(set(self.anchors))
+        grown = [(site.ip, site.growth) for key, site in self.sites.items() if not site.long and key in self.long]
+        values = symbols.values
+        near = [(key, site, values[key[3]]) for key, site in self.sites.items()
+                if key not in self.long and values[key[3]] is not None]
+        relaxed = False
+        while True:
+            grown.sort()
+            positions = [ip for ip, _ in grown]
+            total = [0, *accumulate(growth for _, growth in grown)]
+
+            def moved(address):
+                i = bisect_right(anchors, address)
+                first = bisect_left(positions, anchors[i - 1]) if i else 0
+                return address + total[bisect_left(positions, address)] - total[first]
+
+            out_of_range = [(key, site) for key, site, target in near
+                            if moved(target) - moved(site.ip) not in site.reach]
+            if not out_of_range:
+                return relaxed
+            relaxed = True
+            for key, site in out_of_range:
+                self.long.add(key)
+                grown.append((site.ip, site.growth))
+            near = [entry for entry in near if entry[0] not in self.long]
+
+
+# The extensions providing the operand sizes `load_address` needs for addresses wider than 16 bits
+_SIZE_EXTENSIONS = {'d': "dword_operations", 'q': "qword_operations"}
+
+
+def _groups(context) -> int:
+    return -(-context.ip_mask.bit_count() // 5)
+
+
+def load_address(context, register: str, target: int) -> list[str]:
+    """Instructions loading `target` into `register`, always the same number of them for the current address size."""
+    from etc_as.core import reject
+    bits = context.ip_mask.bit_count()
+    size = 'x' if bits <= 16 else 'd' if bits <= 32 else 'q'
+    reject(size not in context.register_sizes,
+           lambda: f"Long branches with {bits} bit addresses need the {_SIZE_EXTENSIONS[size]} extension")
+    groups = _groups(context)
+    target &= context.ip_mask
+    return [f"movz{size} {register}, {target >> 5 * (groups - 1) & 0x1F}",
+            *(f"slo{size} {register}, {target >> 5 * i & 0x1F}" for i in reversed(range(groups - 1)))]
+
+
+def relaxed_branch(context, mnemonic: str, symbol: int, target: int | None, reach: range,
+                   near: Callable[[], bytes], far: str, near_size: int = 2) -> bytes:
+    """
+    Encodes the branch `mnemonic` to the symbol with the id `symbol` with `near` as long as its site can use the near
+    form. Otherwise, the `target` is loaded into the scratch register, followed by `far` with the register formatted
+    into it. `far` has to be a single 2 byte instruction that jumps or calls through the register.
+
+    Sites are never relaxed here: forward references still have their value from the previous pass, which can be
+    arbitrarily far off. A near site that is out of range is relaxed by `BranchSites.settle` after the pass instead,
+    so the output of a pass can only be final if all of its near sites are in range.
+    """
+    sites: BranchSites = context.branches
+    key = sites.key(context.ip, mnemonic, symbol)
+    long = key in sites.long
+    sites.record(key, Site(context.ip, reach, 2 * (_groups(context) + 1) - near_size, long))
+    if not long:
+        return near()
+    register = context.relax_register
+    return context.macro("\n".join((*load_address(context, register, target or 0), far.format(register))))
+
+
+def external_branch(context, name: tuple[int, str], kind: str, near: bytes, far: str) -> bytes:
+    """
+    Encodes a branch to the external symbol `name`, leaving the target to the linker. Without a scratch register, that
+    is the `near` form, which has to reach the target once it is linked. With one, it is always the long form, since
+    where the target ends up isn't known yet. `kind` is the relocation of the near form.
+    """
+    symbol = context.symbol_full_name(name)
+    register = context.relax_register
+    if register is None:
+        return Relocated(near, [Relocation(0, kind, symbol)])
+    loads = load_address(context, register, 0)
+    binary = context.macro("\n".join((*loads, far.format(register))))
+    # The loads all have the same size, and their 5 bit immediate is at the end
+    size = (len(binary) - 2) // len(loads)
+    return Relocated(binary, [Relocation(size * (i + 1) - 1, IMM5, symbol, 5 * (len(loads) - 1 - i))
+                              for i in range(len(loads))])
@@ -0,0 +1,293 @@
+"""
+Assembler server.
+
+`etc-as --server` keeps the extensions imported and the parsers built in a few worker processes, and assembles
+sources sent to it over a Unix domain socket. While a server is listening on the socket, `etc-as` forwards its files
+to it instead of assembling them itself.
+
+The protocol is newline-delimited JSON: every line sent by a client is a request, and the server answers each one with
+a single line. A connection can be used for any number of requests. An assembly request looks like
+
+    {"source": "mov r0, 1\\n", "modes": ["prefix"], "format": "annotated", "file": "example.s"}
+
+where only `source` is required. `modes` defaults to `["prefix"]`, `format` (one of binary, annotated, tc and tc-64)
+to annotated, and `file` is only used in messages. Files included by the source are looked for relative to `path`, the
+absolute path of the source, and in the absolute directories in `include_paths`. The answer is either
+
+    {"ok": true, "output": "0x0000: ..."}
+
+with binary output encoded as base64 (and `"encoding": "base64"`), or
+
+    {"ok": false, "type": "UnknownInstruction", "error": "Can't process instruction: ..."}
+
+Besides that, `{"command": "ping"}` is answered with `{"ok": true, "version": ...}` and `{"command": "shutdown"}` stops
+the server after answering.
+
+Only the user running the server can connect to its socket, and clients only connect to sockets owned by themselves
+that nobody else can access, so that another user can't pose as a server to collect or forge assemblies. Without
+`$XDG_RUNTIME_DIR`, the socket is put into a directory only the user can access in the temporary directory.
+"""
+from __future__ import annotations
+
+import base64
+import io
+import json
+import os
+import socket
+import socketserver
+import stat
+import sys
+import tempfile
+import threading
+import time
+
+from etc_as import __version__
+
+DEFAULT_MODES = ("prefix",)
+FORMATS = ("binary", "annotated", "tc", "tc-64")
+# Seconds without any connection after which the server exits, 0 to keep it running
+DEFAULT_IDLE_TIMEOUT = 15 * 60
+# How long the client waits for a server to accept the connection before assembling by itself
+CONNECT_TIMEOUT = 0.5
+
+
+class ServerError(Exception):
+    """An error reported by the server, raised in the client."""
+
+    def __init__(self, type_name: str, message: str):
+        super().__init__(f"{type_name}: {message}")
+        self.type_name = type_name
+
+
+def default_socket_path() -> str:
+    if "ETC_AS_SOCKET" in os.environ:
+        return os.environ["ETC_AS_SOCKET"]
+    if os.environ.get("XDG_RUNTIME_DIR"):
+        return os.path.join(os.environ["XDG_RUNTIME_DIR"], f"etc_as-{os.getuid()}.sock")
+    # Everyone can create files in the temporary directory, so the socket can't be at a predictable path in there
+    return os.path.join(tempfile.gettempdir(), f"etc_as-{os.getuid()}", "server.sock")
+
+
+# Client side
+
+def is_trusted(path: str) -> bool:
+    """Whether `path` is a socket owned by the current user that no other user can access."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(st.st_mode) and st.st_uid == os.getuid() and not st.st_mode & 0o077
+
+
+def connect(path: str) -> socket.socket | None:
+    """Connects to the server listening on `path`, or returns None if there is none (or it isn't trusted)."""
+    if not is_trusted(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(CONNECT_TIMEOUT)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    sock.settimeout(None)
+    return sock
+
+
+def request(path: str, message: dict) -> dict | None:
+    """Sends `message` to the server on `path` and returns its answer, or None if no server is listening."""
+    sock = connect(path)
+    if sock is None:
+        return None
+    with sock, sock.makefile("rwb") as f:
+        f.write(json.dumps(message).encode("utf-8") + b"\n")
+        f.flush()
+        answer = f.readline()
+    if not answer:
+        raise ConnectionError(f"the server on {path} closed the connection without answering")
+    return json.loads(answer)
+
+
+def is_running(path: str) -> bool:
+    try:
+        answer = request(path, {"command": "ping"})
+    except (OSError, ValueError):
+        return False
+    return answer is not None and answer.get("version") == __version__
+
+
+def request_assembly(path: str, source: str, modes, mformat: str, file: str = None,
+                     include_paths: list[str] = ()) -> bytes | str:
+    """Assembles `source` on the server, returning the output in `mformat` or raising a ServerError."""
+    answer = request(path, {"source": source, "modes": sorted(modes), "format": mformat, "file": file,
+                            "path": file and os.path.abspath(file),
+                            "include_paths": [os.path.abspath(d) for d in include_paths]})
+    if answer is None:
+        raise ConnectionError(f"no server is listening on {path}")
+    if not answer["ok"]:
+        raise ServerError(answer["type"], answer["error"])
+    if answer.get("encoding") == "base64":
+        return base64.b64decode(answer["output"])
+    return answer["output"]
+
+
+# Server side, the worker processes
+
+def _init_worker(cache_enabled: bool):
+    from etc_as import cache, extensions, main
+    cache.enabled = cache_enabled
+    extensions.import_all_extensions()
+    main.modes, main.mformat, main.verbosity = set(DEFAULT_MODES), "annotated", 0
+    main.assembler()
+
+
+def _assemble(message: dict) -> dict:
+    from etc_as import main
+    try:
+        source = message["source"]
+        mformat = message.get("format", "annotated")
+        if mformat not in FORMATS:
+            raise ValueError(f"unknown format: {mformat}")
+        main.modes = set(message.get("modes", DEFAULT_MODES))
+        main.mformat = mformat
+        main.include_paths = message.get("include_paths", [])
+        res = main.assembler().n_pass(source, path=message.get("path"))
+        if mformat == "binary":
+            buffer = io.BytesIO()
+            main.write_output(res, buffer)
+            return {"ok": True, "encoding": "base64", "output": base64.b64encode(buffer.getvalue()).decode("ascii")}
+        buffer = io.StringIO()
+        main.write_output(res, buffer)
+        return {"ok": True, "output": buffer.getvalue()}
+    except Exception as e:
+        return {"ok": False, "type": type(e).__name__, "error": str(e)}
+
+
+# Server side, the main process
+
+class _Handler(socketserver.StreamRequestHandler):
+    server: AssemblyServer
+
+    def handle(self):
+        self.server.enter()
+        try:
+            for line in self.rfile:
+                try:
+                    message = json.loads(line)
+                except ValueError as e:
+                    message = {}
+                    answer = {"ok": False, "type": type(e).__name__, "error": str(e)}
+                else:
+                    if not isinstance(message, dict):
+                        message = {"command": None}
+                    answer = self.server.answer(message)
+                self.wfile.write(json.dumps(answer).encode("utf-8") + b"\n")
+                self.wfile.flush()
+                if message.get("command") == "shutdown":
+                    self.server.stopping = True
+                    break
+        finally:
+            self.server.leave()
+
+
+class AssemblyServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    Accepts any number of connections, but assembles at most `jobs` sources at the same time, one per worker process.
+    Exits after `idle_timeout` seconds without a connection.
+    """
+    daemon_threads = True
+
+    def __init__(self, path: str, jobs: int = 1, idle_timeout: float = DEFAULT_IDLE_TIMEOUT, verbosity: int = 0):
+        self.path = path
+        self.jobs = jobs
+        self.idle_timeout = idle_timeout
+        self.verbosity = verbosity
+        self.stopping = False
+        self.connections = 0
+        self.last_activity = time.monotonic()
+        self.lock = threading.Lock()
+        self.pool = None
+        # The socket is only accessible to the user running the server
+        umask = os.umask(0o177)
+        try:
+            super().__init__(path, _Handler)
+        finally:
+            os.umask(umask)
+
+    def start_workers(self):
+        # The workers are started (and warmed up) before accepting connections, so that the pool never forks while
+        # other threads are running
+        from concurrent.futures import ProcessPoolExecutor
+        from etc_as import cache
+        self.pool = ProcessPoolExecutor(self.jobs, initializer=_init_worker, initargs=(cache.enabled,))
+        for future in [self.pool.submit(int) for _ in range(self.jobs)]:
+            future.result()
+
+    def enter(self):
+        with self.lock:
+            self.connections += 1
+
+    def leave(self):
+        with self.lock:
+            self.connections -= 1
+            self.last_activity = time.monotonic()
+
+    def idle(self) -> bool:
+        with self.lock:
+            return (self.idle_timeout > 0 and self.connections == 0
+                    and time.monotonic() - self.last_activity >= self.idle_timeout)
+
+    def answer(self, message: dict) -> dict:
+        command = message.get("command", "assemble")
+        if command == "ping":
+            return {"ok": True, "version": __version__, "jobs": self.jobs}
+        if command == "shutdown":
+            return {"ok": True}
+        if command != "assemble" or "source" not in message:
+            return {"ok": False, "type": "ValueError", "error": f"invalid request: {message!r}"}
+        started = time.perf_counter()
+        answer = self.pool.submit(_assemble, message).result()
+        if self.verbosity:
+            status = "ok" if answer["ok"] else f"{answer['type']}: {answer['error']}"
+            print(f"{message.get('file') or '<source>'}: {status} ({time.perf_counter() - started:.3f}s)",
+                  file=sys.stderr)
+        return answer
+
+    def serve(self):
+        self.timeout = min(1.0, self.idle_timeout) if self.idle_timeout > 0 else None
+        while not self.stopping and not self.idle():
+            self.handle_request()
+
+    def server_close(self):
+        super().server_close()
+        if self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def serve(path: str = None, jobs: int = 1, idle_timeout: float = DEFAULT_IDLE_TIMEOUT, verbosity: int = 0) -> int:
+    path = path or default_socket_path()
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory, mode=0o700)
+    if directory and os.stat(directory).st_uid not in (os.getuid(), 0):
+        print(f"{directory} belongs to another user, not listening in it", file=sys.stderr)
+        return 1
+    if is_running(path):
+        print(f"a server is already listening on {path}", file=sys.stderr)
+        return 1
+    if os.path.exists(path):
+        # Left behind by a server that didn't exit cleanly
+        os.unlink(path)
+    with AssemblyServer(path, jobs, idle_timeout, verbosity) as server:
+        server.start_workers()
+        if verbosity:
+            print(f"listening on {path} with {jobs} worker(s)", file=sys.stderr)
+        try:
+            server.serve()
+        except KeyboardInterrupt:
+            pass
+    return 0
@@ -0,0 +1,62 @@
+"""
+Symbol table.
+
+Symbols are interned: every name gets a small integer id the first time it is defined or referenced, and everything
+else (values, the symbols read by a line, missing and changed symbols, branch sites) is keyed by that id.
+
+Local labels form a tree. The id of `outer.inner` is the child `inner` of the id of `outer`, so the full name of a
+reference is never built as a string. Looking it up only takes the id of its scope and the short name. The root is
+the empty path, and every id stands for a whole path of names, which makes it usable as the key of a scope as well.
+"""
+from __future__ import annotations
+
+ROOT = 0
+
+
+class SymbolTable:
+    """
+    The values of the symbols of an assembly, by id. Values are kept across passes: a symbol that isn't defined yet
+    in the current pass still has its value from the previous one.
+    """
+
+    def __init__(self):
+        self.ids: dict[tuple[int, str], int] = {}
+        self.parents: list[int] = [-1]
+        self.names: list[str] = ['']
+        self.values: list[int | None] = [None]
+
+    def intern(self, scope: int, name: str) -> int:
+        """The id of `name` inside of `scope`."""
+        key = (scope, name)
+        try:
+            return self.ids[key]
+        except KeyError:
+            pass
+        symbol = self.ids[key] = len(self.names)
+        self.parents.append(scope)
+        self.names.append(name)
+        self.values.append(None)
+        return symbol
+
+    def lookup(self, full_name: str) -> int:
+        """The id of the symbol with the full name `full_name`, see `full_name`."""
+        symbol = ROOT
+        for name in full_name.split('.'):
+            symbol = self.intern(symbol, name)
+        return symbol
+
+    def get(self, symbol: int) -> int | None:
+        return self.values[symbol]
+
+    def set(self, symbol: int, value: int) -> bool:
+        """Defines `symbol` and returns whether its value changed."""
+        changed = self.values[symbol] != value
+        self.values[symbol] = value
+        return changed
+
+    def full_name(self, symbol: int) -> str:
+        parts = []
+        while symbol != ROOT:
+            parts.append(self.names[symbol])
+            symbol = self.parents[symbol]
+        return '.'.join(reversed(parts))
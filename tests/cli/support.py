@@ -0,0 +1,65 @@
+"""
+Helpers for the command line tests, which run `python -m etc_as` from this checkout in a temporary directory, with a
+cache directory and server socket of their own. Run them with `python -m unittest discover -s tests/cli` from the root
+of the checkout, or as part of `make test`.
+"""
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from pathlib import Path
+
+SRC = Path(__file__).resolve().parents[2] / "src"
+sys.path.insert(0, str(SRC))
+
+# How long a test waits for something to happen in another process, in seconds
+TIMEOUT = 60
+
+
+class CliTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = Path(tempfile.mkdtemp(prefix="etc_as-test-"))
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        self.env = {**os.environ, "PYTHONPATH": str(SRC), "ETC_AS_CACHE_DIR": str(self.tmp / "cache"),
+                    "ETC_AS_SOCKET": str(self.tmp / "server.sock")}
+
+    def write(self, name: str, text: str) -> Path:
+        path = self.tmp / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(text)
+        return path
+
+    def command(self, *args) -> list[str]:
+        return [sys.executable, "-m", "etc_as", *map(str, args)]
+
+    def etc_as(self, *args) -> subprocess.CompletedProcess:
+        """Runs etc-as with `args` in the temporary directory and returns the finished process."""
+        return subprocess.run(self.command(*args), cwd=self.tmp, env=self.env, capture_output=True, text=True,
+                              timeout=TIMEOUT)
+
+    def start(self, *args) -> subprocess.Popen:
+        """
+        Starts etc-as with `args` in the background. It is killed at the end of the test if it is still running, along
+        with any worker processes it started.
+        """
+        process = subprocess.Popen(self.command(*args), cwd=self.tmp, env=self.env, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, text=True, start_new_session=True)
+        self.addCleanup(_stop, process)
+        return process
+
+    def wait_for(self, condition, message: str):
+        deadline = time.monotonic() + TIMEOUT
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail(f"timed out waiting for {message}")
+            time.sleep(0.05)
+
+
+def _stop(process: subprocess.Popen):
+    if process.poll() is None:
+        os.killpg(process.pid, signal.SIGKILL)
+    process.communicate(timeout=TIMEOUT)
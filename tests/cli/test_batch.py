@@ -0,0 +1,77 @@
+"""Assembling several files in one invocation, see `etc_as.main.assemble_batch` and `output_names`."""
+import unittest
+
+from support import CliTestCase
+
+FIRST = """\
+start:
+    mov %r0, 1
+    jmp start
+"""
+SECOND = """\
+    mov %r1, 2
+    hlt
+"""
+
+
+class BatchTest(CliTestCase):
+    def expected(self, name: str, *args) -> bytes:
+        """The output of assembling `name` on its own."""
+        out = self.tmp / "single.out"
+        result = self.etc_as("--no-server", *args, name, "-o", out)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        return out.read_bytes()
+
+    def test_output_directory(self):
+        self.write("first.s", FIRST)
+        self.write("src/second.s", SECOND)
+        for jobs in ("-j1", "-j2"):
+            with self.subTest(jobs=jobs):
+                result = self.etc_as("--no-server", jobs, "first.s", "src/second.s", "-o", f"build{jobs}")
+                self.assertEqual(result.returncode, 0, result.stderr)
+                self.assertEqual(sorted(p.name for p in (self.tmp / f"build{jobs}").iterdir()),
+                                 ["first.ann", "second.ann"])
+                self.assertEqual((self.tmp / f"build{jobs}/first.ann").read_bytes(), self.expected("first.s"))
+                self.assertEqual((self.tmp / f"build{jobs}/second.ann").read_bytes(), self.expected("src/second.s"))
+
+    def test_next_to_inputs(self):
+        self.write("first.s", FIRST)
+        self.write("src/second.s", SECOND)
+        result = self.etc_as("--no-server", "-mformat=binary", "first.s", "src/second.s")
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual((self.tmp / "first.bin").read_bytes(), self.expected("first.s", "-mformat=binary"))
+        self.assertEqual((self.tmp / "src/second.bin").read_bytes(),
+                         self.expected("src/second.s", "-mformat=binary"))
+
+    def test_pattern(self):
+        self.write("first.s", FIRST)
+        self.write("second.s", SECOND)
+        result = self.etc_as("--no-server", "-mformat=tc", "first.s", "second.s", "-o", "out/{stem}-{name}{ext}")
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertTrue((self.tmp / "out/first-first.s.tc").is_file())
+        self.assertTrue((self.tmp / "out/second-second.s.tc").is_file())
+
+    def test_duplicate_outputs(self):
+        self.write("a/prog.s", FIRST)
+        self.write("b/prog.s", SECOND)
+        result = self.etc_as("--no-server", "a/prog.s", "b/prog.s", "-o", "build")
+        self.assertNotEqual(result.returncode, 0)
+        self.assertIn("several inputs would be written to", result.stderr)
+
+    def test_failing_file(self):
+        self.write("first.s", FIRST)
+        self.write("broken.s", "    frobnicate %r0\n")
+        self.write("second.s", SECOND)
+        for jobs in ("-j1", "-j3"):
+            with self.subTest(jobs=jobs):
+                result = self.etc_as("--no-server", jobs, "first.s", "broken.s", "second.s", "-o", f"build{jobs}")
+                self.assertEqual(result.returncode, 1)
+                self.assertIn("broken.s: ", result.stderr)
+                self.assertIn("1 of 3 files failed", result.stderr)
+                # The other files are assembled all the same
+                self.assertEqual(sorted(p.name for p in (self.tmp / f"build{jobs}").iterdir()),
+                                 ["first.ann", "second.ann"])
+
+
+if __name__ == "__main__":
+    unittest.main()
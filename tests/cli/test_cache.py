@@ -0,0 +1,45 @@
+"""The on-disk cache shared between runs, see etc_as.cache."""
+import os
+import unittest
+from unittest import mock
+
+from support import CliTestCase
+
+from etc_as import cache
+
+
+class CacheTest(CliTestCase):
+    def use(self, name: str):
+        patcher = mock.patch.dict(os.environ, {"ETC_AS_CACHE_DIR": str(self.tmp / name)})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_private(self):
+        self.use("private")
+        cache.store("parsers", "key", {"parser": 1})
+        cache.store_json("lines", "0/key", [1])
+        self.assertEqual(os.stat(self.tmp / "private").st_mode & 0o777, 0o700)
+        self.assertEqual(cache.load("parsers", "key"), {"parser": 1})
+        self.assertEqual(cache.load_json("lines", "0/key"), [1])
+
+    def test_writable_entry(self):
+        self.use("private")
+        cache.store("parsers", "key", {"parser": 1})
+        os.chmod(cache._namespace_dir("parsers") / "key", 0o666)
+        self.assertIsNone(cache.load("parsers", "key"))
+
+    def test_shared_directory(self):
+        # As if someone else had put an entry into a directory everyone can write to
+        self.use("shared")
+        directory = cache._namespace_dir("parsers")
+        directory.mkdir(parents=True)
+        os.chmod(self.tmp / "shared", 0o777)
+        (directory / "key").write_text("[1]")
+        os.chmod(directory / "key", 0o600)
+        self.assertIsNone(cache.load_json("parsers", "key"))
+        cache.store_json("parsers", "other", [2])
+        self.assertFalse((directory / "other").exists())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+"""`etc-as --line-cache`, see etc_as.line_cache."""
+import os
+import re
+import unittest
+from unittest import mock
+
+from support import CliTestCase
+
+from etc_as import cache, line_cache
+from etc_as.line_cache import LineCache, Variant
+from etc_as.symbols import SymbolTable
+
+SOURCE = """\
+.set X 3
+start:
+    mov %r0, X
+    mov %r1, 1
+    jmp start
+"""
+
+
+class LineCacheTest(CliTestCase):
+    def run_cached(self, source: str = SOURCE) -> tuple[dict[str, int], str]:
+        """Assembles `source` with the line cache, and returns its counts and the output."""
+        self.write("prog.s", source)
+        result = self.etc_as("--line-cache", "-v", "prog.s", "-o", "prog.ann")
+        self.assertEqual(result.returncode, 0, result.stderr)
+        report = re.search(r"prog\.s: line cache: (.*)", result.stdout).group(1)
+        counts = {name: int(count) for count, name in re.findall(r"(\d+) (hits|misses|stored|evicted)", report)}
+        return counts, (self.tmp / "prog.ann").read_text()
+
+    def test_hit(self):
+        first, output = self.run_cached()
+        self.assertEqual(first["hits"], 0)
+        self.assertGreater(first["stored"], 0)
+        second, cached = self.run_cached()
+        self.assertEqual(second["hits"], first["stored"])
+        self.assertEqual(second["stored"], 0)
+        self.assertEqual(cached, output)
+
+    def test_miss(self):
+        first, output = self.run_cached()
+        # Only the line reading X is assembled again
+        second, changed = self.run_cached(SOURCE.replace("X 3", "X 4"))
+        self.assertEqual(second["hits"], first["stored"] - 1)
+        self.assertEqual(second["stored"], 1)
+        self.assertNotEqual(changed, output)
+        self.write("fresh.s", SOURCE.replace("X 3", "X 4"))
+        result = self.etc_as("fresh.s", "-o", "fresh.ann")
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertEqual(changed, (self.tmp / "fresh.ann").read_text())
+
+
+class VariantTest(CliTestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.dict(os.environ, {"ETC_AS_CACHE_DIR": str(self.tmp / "cache")})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.key = LineCache.key("config", "    jmp start")
+
+    @staticmethod
+    def path(key: str):
+        return cache.cache_dir() / line_cache.NAMESPACE / cache.version_tag() / key
+
+    def store(self, ip: int):
+        store = LineCache()
+        store.start()
+        store.add(self.key, Variant((), ip, ((0, bytes([0x80, ip & 0xff]), "    jmp start"),), 2))
+        store.flush(symbols=SymbolTable())
+
+    def test_eviction(self):
+        for ip in range(line_cache.MAX_VARIANTS + 1):
+            self.store(ip)
+        # A new process only sees what is on disk
+        variants = LineCache()._variants(self.key)
+        self.assertEqual(len(variants), line_cache.MAX_VARIANTS)
+        # The oldest variant made room for the newest
+        self.assertEqual([v.ip for v in variants], list(range(line_cache.MAX_VARIANTS, 0, -1)))
+        self.assertIsNone(LineCache().lookup(self.key, symbols=SymbolTable(), ip=0))
+        self.assertIsNotNone(LineCache().lookup(self.key, symbols=SymbolTable(), ip=1))
+
+    def test_size_limit(self):
+        keys = [f"0/{i}" for i in range(4)]
+        for i, key in enumerate(keys):
+            variant = Variant((), i, ((0, b"\x80\x00", "    jmp start"),), 2)
+            cache.store_json(line_cache.NAMESPACE, key, [variant.to_json()])
+            stamp = 1_000_000_000_000_000_000 + i * 1_000_000_000
+            os.utime(self.path(key), ns=(stamp, stamp))
+        cache.touch(line_cache.NAMESPACE, keys[0])
+        size = os.path.getsize(self.path(keys[0]))
+        # The entries used least recently go first
+        self.assertEqual(cache.evict(line_cache.NAMESPACE, "0", 2 * size), 2)
+        self.assertEqual([bool(LineCache()._variants(key)) for key in keys], [True, False, False, True])
+
+    def test_corrupt_entry(self):
+        self.store(0)
+        path = self.path(self.key)
+        path.write_text('[{"reads": [], "ip": 0, "output": [[0, "zz", ""]], "size": 2}]')
+        self.assertIsNone(LineCache().lookup(self.key, symbols=SymbolTable(), ip=0))
+
+
+if __name__ == "__main__":
+    unittest.main()
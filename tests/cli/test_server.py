@@ -0,0 +1,70 @@
+"""`etc-as --server` and forwarding to it, see etc_as.server."""
+import unittest
+from unittest import mock
+
+from support import TIMEOUT, CliTestCase
+
+from etc_as import server
+
+SOURCE = """\
+start:
+    mov %r0, 1
+    jmp start
+"""
+
+
+class ServerTest(CliTestCase):
+    def setUp(self):
+        super().setUp()
+        self.socket = str(self.tmp / "server.sock")
+        self.server = self.start("--server", "--socket", self.socket, "--idle-timeout", 60)
+        self.wait_for(lambda: server.is_running(self.socket) or self.server.poll() is not None, "the server")
+        self.assertIsNone(self.server.poll(), "the server exited")
+        self.addCleanup(self.shutdown)
+
+    def shutdown(self):
+        if self.server.poll() is None:
+            self.assertEqual(server.request(self.socket, {"command": "shutdown"}), {"ok": True})
+            self.assertEqual(self.server.wait(TIMEOUT), 0)
+
+    def local(self, *args) -> bytes:
+        self.write("local.s", SOURCE)
+        result = self.etc_as("--no-server", *args, "local.s", "-o", "local.out")
+        self.assertEqual(result.returncode, 0, result.stderr)
+        return (self.tmp / "local.out").read_bytes()
+
+    def test_round_trip(self):
+        output = server.request_assembly(self.socket, SOURCE, {"prefix"}, "annotated", "example.s")
+        self.assertEqual(output.encode(), self.local())
+
+    def test_binary(self):
+        answer = server.request(self.socket, {"source": SOURCE, "format": "binary"})
+        self.assertEqual(answer["encoding"], "base64")
+        output = server.request_assembly(self.socket, SOURCE, {"prefix"}, "binary")
+        self.assertEqual(output, self.local("-mformat=binary"))
+
+    def test_error(self):
+        answer = server.request(self.socket, {"source": "    mov %r0, undefined_symbol\n"})
+        self.assertFalse(answer["ok"])
+        self.assertIn("undefined_symbol", answer["error"])
+        with self.assertRaises(server.ServerError) as raised:
+            server.request_assembly(self.socket, "    mov %r0, undefined_symbol\n", {"prefix"}, "annotated")
+        self.assertEqual(raised.exception.type_name, answer["type"])
+        # Requests that aren't understood are answered as well
+        self.assertFalse(server.request(self.socket, {"command": "dance"})["ok"])
+
+    def test_forwarding(self):
+        self.write("forwarded.s", SOURCE)
+        result = self.etc_as("-v", "forwarded.s", "-o", "forwarded.ann")
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertIn("Forwarding to the server", result.stdout)
+        self.assertEqual((self.tmp / "forwarded.ann").read_bytes(), self.local())
+
+    def test_version_mismatch(self):
+        self.assertTrue(server.is_running(self.socket))
+        with mock.patch.object(server, "__version__", "0.0.0-other"):
+            self.assertFalse(server.is_running(self.socket))
+
+
+if __name__ == "__main__":
+    unittest.main()
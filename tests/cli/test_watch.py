@@ -0,0 +1,53 @@
+"""`etc-as --watch`, see etc_as.main.watch."""
+import os
+import queue
+import signal
+import threading
+import unittest
+
+from support import TIMEOUT, CliTestCase
+
+
+class WatchTest(CliTestCase):
+    def setUp(self):
+        super().setUp()
+        self.write("main.s", '.include "defs.inc"\n    mov %r0, WIDTH\n    mov %r1, 1\n')
+        self.write("defs.inc", ".set WIDTH 3\n")
+        self.process = self.start("--watch", "main.s", "-o", "out.ann")
+        self.lines = queue.Queue()
+        threading.Thread(target=self.read_stderr, daemon=True).start()
+
+    def read_stderr(self):
+        # Reading stops with the end of the process, which closes the pipe
+        for line in self.process.stderr:
+            self.lines.put(line)
+
+    def next_line(self) -> str:
+        try:
+            return self.lines.get(timeout=TIMEOUT)
+        except queue.Empty:
+            self.fail("etc-as --watch didn't report a build")
+
+    def test_changed_include(self):
+        self.assertTrue(self.next_line().startswith("main.s: -> out.ann"))
+        first = (self.tmp / "out.ann").read_text()
+        self.assertIn("59 03", first)
+
+        path = self.write("defs.inc", ".set WIDTH 7\n")
+        # Make sure the change is seen even where timestamps are coarse
+        stamp = os.stat(path).st_mtime_ns + 2_000_000_000
+        os.utime(path, ns=(stamp, stamp))
+        self.assertTrue(self.next_line().startswith("main.s: -> out.ann"))
+        second = (self.tmp / "out.ann").read_text()
+        self.assertNotEqual(first, second)
+        self.assertIn("59 07", second)
+
+        # Nothing changed since, so nothing is assembled again
+        with self.assertRaises(queue.Empty):
+            self.lines.get(timeout=1)
+        self.process.send_signal(signal.SIGINT)
+        self.assertEqual(self.process.wait(TIMEOUT), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
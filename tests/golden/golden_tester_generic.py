@@ -1,11 +1,17 @@
 #!/usr/bin/env python3.10
 import argparse
 import fnmatch
+import io
+import itertools
+import json
+import os
 import shlex
 import shutil
 import subprocess
 import tempfile
 import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from pprint import pprint
 from dataclasses import dataclass
@@ -15,8 +21,11 @@ import sys
 def parse_args(args):
     parser = argparse.ArgumentParser()
     exe = sys.executable.replace('\\','/')
-    parser.add_argument("-c", "--command", action="store", default=f"{exe} -m etc_as",
-                        help="The assembler to test")
+    parser.add_argument("-c", "--command", action="store",
+                        help="The assembler to test, run once per test case and format. By default, etc_as is "
+                             f"imported and runs in this process and its workers, like `{exe} -m etc_as` would")
+    parser.add_argument("-j", "--jobs", action="store", type=int, default=os.cpu_count() or 1,
+                        help="How many test cases to run at the same time without --command (default: all CPUs)")
     parser.add_argument("-i", "--include", action="append",
                         help="A glob-like pattern of which golden tests to include")
     parser.add_argument("-e", "--exclude", action="append",
@@ -41,10 +50,13 @@ output_modes = {
     'tc': "tc",
     'tc64': "tc-64",
 }
+# The expected error message of a test case that has to fail
+ERROR_SUFFIX = 'err'
+ERROR_MODE = "error"
 
 
 def collect_test_cases(ns):
-    for assembly_file in ns.folder.glob("*.s"):
+    for assembly_file in itertools.chain(ns.folder.glob("*.s"), ns.folder.glob("*.link")):
         name = assembly_file.stem
         if ns.include:
             if not any(fnmatch.fnmatch(name, p) for p in ns.include):
@@ -60,24 +72,178 @@ def collect_test_cases(ns):
             path = assembly_file.with_suffix('.' + suffix)
             if path.is_file():
                 compare_files[mode] = path
+        path = assembly_file.with_suffix('.' + ERROR_SUFFIX)
+        if path.is_file():
+            compare_files[ERROR_MODE] = path
         if not compare_files:
             print(f"Assembly file with no output files to check against, skipping: {assembly_file.name}")
             continue
         yield GoldenTestCase(name, assembly_file, compare_files)
 
 
+def extra_arguments(assembly_file: Path) -> list[str]:
+    first_line = assembly_file.read_text('utf8').partition("\n")[0].strip()
+    if first_line[0] != ";":
+        return []
+    return shlex.split(first_line.partition(";")[2].strip())
+
+
+def import_etc_as():
+    try:
+        import etc_as.main
+    except ImportError:
+        # Not installed, use the checkout this file is in
+        sys.path.insert(0, str(Path(__file__).resolve().parents[2] / "src"))
+        import etc_as.main
+    return etc_as.main
+
+
+def link_sources(link_file: Path) -> list[Path]:
+    """The sources listed in a `.link` file, one per line relative to it."""
+    lines = link_file.read_text('utf8').splitlines()
+    return [link_file.parent / line.strip() for line in lines if line.strip()]
+
+
+def assembler_for(etc_as_main, assembly_file: Path):
+    """An assembler set up with the arguments on the first line of `assembly_file`."""
+    modes = {'prefix'}
+    for argument in extra_arguments(assembly_file):
+        if not argument.startswith('-m') or etc_as_main.machine_option(argument[2:], modes) is not None:
+            raise ValueError(f"unsupported argument: {argument}")
+    etc_as_main.modes, etc_as_main.verbosity = modes, 0
+    return etc_as_main.assembler()
+
+
+def link_in_process(etc_as_main, link_file: Path):
+    """
+    Assembles the sources of `link_file` into objects and links them, like `etc-as -c` and `etc-ld` would. The objects
+    go through their file format on the way.
+    """
+    from etc_as import linker, objects
+    sources = link_sources(link_file)
+    linked = []
+    for source in sources:
+        worker = assembler_for(etc_as_main, source)
+        result = worker.n_pass(source.read_text('utf8'), relocatable=True, path=str(source))
+        obj = objects.ObjectFile.from_result(result, worker.exported_symbols())
+        linked.append(objects.ObjectFile.from_json(json.loads(json.dumps(obj.to_json()))))
+    result = linker.link(linked, [source.relative_to(link_file.parent).as_posix() for source in sources])
+    # Overlapping objects are an error, as in etc-ld
+    result.segments
+    return result
+
+
+def render(etc_as_main, result, mode: str) -> bytes:
+    """`result` in the format `mode`, exactly as `etc_as` would write it to a file."""
+    buffer = io.BytesIO()
+    if mode == 'binary':
+        etc_as_main.write_output(result, buffer, mode)
+    else:
+        # The same encoding and line endings as a file opened for writing text
+        text = io.TextIOWrapper(buffer)
+        etc_as_main.write_output(result, text, mode)
+        text.flush()
+        text.detach()
+    return buffer.getvalue()
+
+
+def assemble_in_process(assembly_file: Path, formats: list[str]) -> dict[str, bytes] | str:
+    """
+    Assembles `assembly_file` once and renders the result in each of `formats`. Returns the outputs by format, or the
+    error message. The error of a test case that is expected to fail is its output in the format ERROR_MODE.
+
+    A `.link` file is linked from the objects of the sources it lists, and has to give the same output as assembling
+    those sources as a single file.
+    """
+    etc_as_main = import_etc_as()
+    try:
+        if assembly_file.suffix == '.link':
+            result = link_in_process(etc_as_main, assembly_file)
+        else:
+            result = assembler_for(etc_as_main, assembly_file).n_pass(assembly_file.read_text('utf8'),
+                                                                      path=str(assembly_file))
+    except Exception as e:
+        if ERROR_MODE in formats:
+            # Some errors carry the offending instructions after the message
+            message = e.args[0] if e.args and isinstance(e.args[0], str) else str(e)
+            return {ERROR_MODE: f"{type(e).__name__}: {message}\n".encode('utf8')}
+        return traceback.format_exc()
+    try:
+        outputs = {mode: render(etc_as_main, result, mode) for mode in formats if mode != ERROR_MODE}
+        if ERROR_MODE in formats:
+            outputs[ERROR_MODE] = b""
+        if assembly_file.suffix == '.link':
+            sources = link_sources(assembly_file)
+            single = assembler_for(etc_as_main, sources[0]).n_pass(
+                "".join(source.read_text('utf8') for source in sources), path=str(sources[0]))
+            for mode, output in outputs.items():
+                if mode != ERROR_MODE and render(etc_as_main, single, mode) != output:
+                    return f"The linked {mode} output differs from assembling the sources as one file"
+        return outputs
+    except Exception:
+        return traceback.format_exc()
+
+
+def run_in_process(ns) -> int:
+    """Runs the test cases in a pool of processes that import etc_as once. Returns the number of failures."""
+    test_cases = list(collect_test_cases(ns))
+    jobs = [
+        (test_case.assembly_file,
+         [output_modes[suffix] for suffix in ns.gen] if ns.gen else list(test_case.compare_files))
+        for test_case in test_cases
+    ]
+    failed = 0
+    start = time.perf_counter()
+    if ns.jobs > 1 and len(jobs) > 1:
+        pool = ProcessPoolExecutor(min(ns.jobs, len(jobs)), initializer=import_etc_as)
+        results = pool.map(timed_assembly, jobs)
+    else:
+        pool = None
+        results = map(timed_assembly, jobs)
+    try:
+        for test_case, (outputs, seconds) in zip(test_cases, results):
+            if isinstance(outputs, str):
+                print(f"Assembling {test_case.name} failed")
+                print(outputs)
+                failed += 1
+                continue
+            if ns.gen:
+                for suffix in ns.gen:
+                    test_case.assembly_file.with_suffix('.' + suffix).write_bytes(outputs[output_modes[suffix]])
+            else:
+                for mode, path in test_case.compare_files.items():
+                    if path.read_bytes() != outputs[mode]:
+                        print(f"Output {mode} for {test_case.name} did not match expected, creating .fail file")
+                        path.with_suffix(path.suffix + ".fail").write_bytes(outputs[mode])
+                        failed += 1
+            print(f"Test Case {test_case.name} took {seconds} seconds")
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    print(f"{len(test_cases)} test cases took {time.perf_counter() - start} seconds")
+    return failed
+
+
+def timed_assembly(job: tuple[Path, list[str]]) -> tuple[dict[str, bytes] | str, float]:
+    start = time.perf_counter()
+    outputs = assemble_in_process(*job)
+    return outputs, time.perf_counter() - start
+
+
 def main(args):
     ns = parse_args(args)
+    if ns.command is None:
+        return run_in_process(ns)
+    failed = 0
     command_base = shlex.split(ns.command)
     with tempfile.TemporaryDirectory() as tmp_dir:
         p = Path(tmp_dir)
         for test_case in collect_test_cases(ns):
+            if test_case.assembly_file.suffix == '.link' or ERROR_MODE in test_case.compare_files:
+                print(f"Test Case {test_case.name} is only run without --command, skipping")
+                continue
             start = time.perf_counter()
-            first_line = test_case.assembly_file.read_text('utf8').partition("\n")[0].strip()
-            if first_line[0] != ";":
-                extra_arguments = []
-            else:
-                extra_arguments = shlex.split(first_line.partition(";")[2].strip())
+            arguments = extra_arguments(test_case.assembly_file)
             if ns.gen:
                 for suffix in ns.gen:
                     path = test_case.assembly_file.with_suffix('.' + suffix)
@@ -85,7 +251,7 @@ def main(args):
                         *command_base,
                         "-o", path,
                         f"-mformat={output_modes[suffix]}",
-                        *extra_arguments,
+                        *arguments,
                         test_case.assembly_file
                     ]
                     process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
@@ -100,21 +266,24 @@ def main(args):
                         *command_base,
                         "-o", tmp,
                         f"-mformat={mode}",
-                        *extra_arguments,
+                        *arguments,
                         test_case.assembly_file
                     ]
                     process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
                     if process.returncode != 0:
                         print(f"Assembler call for {test_case.name} failed with return code {process.returncode}")
                         print(process.stderr.decode())
+                        failed += 1
                         continue
                     expected = path.read_bytes()
                     got = tmp.read_bytes()
                     if expected != got:
                         print(f"Output {mode} for {test_case.name} did not match expected, creating .fail file")
                         shutil.move(tmp, path.with_suffix(path.suffix + ".fail"))
+                        failed += 1
             end = time.perf_counter()
             print(f"Test Case {test_case.name} took {end - start} seconds")
+    return failed
 
 
 if sys.version_info[0:2] < (3, 10):
@@ -125,4 +294,4 @@ if sys.version_info[0:2] < (3, 10):
 if __name__ == '__main__':
     import sys
 
-    main(sys.argv[1:])
+    exit(1 if main(sys.argv[1:]) else 0)
@@ -0,0 +1,12 @@
+;
+; Constants and macros shared through included files
+.include "include/defs.inc"
+start:
+    mov %r0, WIDTH
+    clear 1
+    set_to 2, HEIGHT
+    jmp after
+.include "include/table.inc"
+after:
+    mov %r3, table_end - table
+    hlt
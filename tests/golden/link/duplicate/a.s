@@ -0,0 +1,5 @@
+;
+.extension functions
+.global twice
+twice:
+    ret
@@ -0,0 +1,6 @@
+;
+.extension functions
+.org 0x8040
+.global twice
+twice:
+    ret
@@ -0,0 +1,11 @@
+;
+.extension functions
+.org 0x8040
+.global lib_add, lib_loop, lib_data
+lib_add:
+    add %r0, 2
+    ret
+lib_loop:
+    jmp start
+lib_data:
+    .word 0x1234
@@ -0,0 +1,11 @@
+;
+; Near references into another object, patched by the linker
+.extension functions
+.global start
+start:
+    mov %r0, 1
+    call lib_add
+    jz   lib_loop
+    jmp  start
+data:
+    .word lib_data
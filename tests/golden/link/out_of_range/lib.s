@@ -0,0 +1,6 @@
+;
+.extension functions
+.org 0x9000
+.global far_func
+far_func:
+    ret
@@ -0,0 +1,5 @@
+;
+; Without .relax, the near call has to reach its target once it is linked
+.extension functions
+    call far_func
+    hlt
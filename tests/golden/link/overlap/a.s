@@ -0,0 +1,5 @@
+;
+.global first
+first:
+    mov %r0, 1
+    hlt
@@ -0,0 +1,6 @@
+;
+; Assembled at the same address as a.s
+.global second
+second:
+    mov %r0, 2
+    hlt
@@ -0,0 +1,9 @@
+;
+.extension functions
+.relax %r7
+.org 0x8200
+.global far_loop, far_end
+far_loop:
+    jz   start
+far_end:
+    hlt
@@ -0,0 +1,9 @@
+;
+; Branches too far for the near form take the relaxed long form
+.extension functions
+.relax %r7
+.global start
+start:
+    jnz  far_loop
+    jmp  far_end
+    .word far_loop
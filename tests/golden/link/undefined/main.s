@@ -0,0 +1,4 @@
+;
+.extension functions
+    call missing
+    hlt
@@ -0,0 +1,25 @@
+;
+.macro load 2
+            mov %r{0}, {1}
+.endmacro
+
+.macro store_here 1
+            load {0}, $
+            mov [%r{0}], %r{0}
+.endmacro
+
+.macro pair 2
+            mov %r0, {}
+            mov %r1, {}
+.endmacro
+
+start:
+            store_here 2
+            load 3, 'A'
+            load 4, LATER
+            pair 5, .local
+            store_here 2
+.local:
+            pair start, -3
+LATER:
+            hlt
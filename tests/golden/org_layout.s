@@ -0,0 +1,10 @@
+;
+.org 0x8010
+late:
+    nop
+    jmp early
+.org 0x8000, 0xFF   ; going backwards, placed before the code above
+early:
+    jmp late
+.org 0x8008, 0xAA
+    halt
@@ -0,0 +1,18 @@
+;-mnaked-reg
+.extension functions
+.relax r7
+start:
+    jnz  edge       ; in range until the jump below grows
+    jz   far        ; out of range
+    call far
+    jmp  start
+    .qword 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0 0
+edge:
+    jnz  start
+.org 0x8400, 0
+far:
+    jmp  start
+    call start
+.norelax
+    call start
+    ret